@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""UUID4文字列の主キーと、UUIDv7を16バイトで保存する主キーの比較ベンチマーク
+
+    PYTHONPATH=src python benchmarks/bench_ids.py [行数]
+"""
+import os
+import sys
+import time
+import uuid
+import random
+import tempfile
+from sqlalchemy import Column, MetaData, String, Table, create_engine, select
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from application.ids import new_id
+from infrastructure.models import CompactId
+
+def run(label: str, id_type, make_id, rows: int, lookups: int = 10000) -> None:
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    engine = create_engine(f"sqlite:///{path}")
+    metadata = MetaData()
+    devices = Table("devices", metadata, Column("device_id", id_type, primary_key=True), Column("device_name", String))
+    schedules = Table(
+        "schedules", metadata,
+        Column("schedule_id", id_type, primary_key=True),
+        Column("device_id", id_type, index=True),
+    )
+    metadata.create_all(engine)
+    
+    device_ids = [make_id() for _ in range(rows)]
+    schedule_ids = [make_id() for _ in range(rows)]
+    
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        for offset in range(0, rows, 1000):
+            conn.execute(devices.insert(), [
+                {"device_id": device_id, "device_name": "device"} for device_id in device_ids[offset:offset + 1000]
+            ])
+            conn.execute(schedules.insert(), [
+                {"schedule_id": schedule_id, "device_id": device_id}
+                for schedule_id, device_id in zip(schedule_ids[offset:offset + 1000], device_ids[offset:offset + 1000])
+            ])
+    insert_time = time.perf_counter() - start
+    
+    targets = random.sample(device_ids, min(lookups, rows))
+    start = time.perf_counter()
+    with engine.connect() as conn:
+        for device_id in targets:
+            conn.execute(select(devices.c.device_name).where(devices.c.device_id == device_id)).one()
+            conn.execute(select(schedules.c.schedule_id).where(schedules.c.device_id == device_id)).all()
+    lookup_time = time.perf_counter() - start
+    
+    engine.dispose()
+    size_mb = os.path.getsize(path) / 1024 / 1024
+    print(f"{label:<28} insert {rows} x2: {insert_time:7.2f}s  "
+          f"lookup {len(targets)}: {lookup_time:6.2f}s ({lookup_time / len(targets) * 1e6:6.1f}us/op)  "
+          f"db size: {size_mb:6.1f}MB")
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    run("uuid4 string (String)", String, lambda: str(uuid.uuid4()), rows)
+    run("uuid7 16 bytes (CompactId)", CompactId, new_id, rows)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""デバイス名の前方一致検索のベンチマーク（式インデックス・ソート済み索引と全件走査の比較）
+
+    PYTHONPATH=src python benchmarks/bench_name_search.py [デバイス数]
+"""
+import os
+import sys
+import time
+import random
+import string
+import tempfile
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from application.ids import new_id
+from infrastructure.models import Base, Device
+from infrastructure.repositories import SQLAlchemyDeviceRepository
+from infrastructure.memory_repositories import InMemoryDeviceRepository, memory_unit_of_work_scope, open_memory_store
+
+def measure(label: str, operation, count: int) -> None:
+    start = time.perf_counter()
+    operation()
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<34} {elapsed:7.3f}s ({elapsed / count * 1e6:8.1f}us/op)")
+
+def random_name() -> str:
+    return "".join(random.choices(string.ascii_letters, k=3)) + " " + "".join(random.choices(string.ascii_lowercase, k=8))
+
+if __name__ == "__main__":
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    searches = 1000
+    names = [random_name() for _ in range(devices)]
+    prefixes = [random.choice(names)[:3] for _ in range(searches)]
+    directory = tempfile.mkdtemp()
+
+    print("SQLAlchemy (SQLite file)")
+    engine = create_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+    Base.metadata.create_all(engine)
+    with sessionmaker(bind=engine)() as session:
+        session.add_all(Device(device_id=new_id(), device_name=name, gpio_number=i) for i, name in enumerate(names))
+        session.commit()
+        repository = SQLAlchemyDeviceRepository(session)
+
+        def indexed():
+            for prefix in prefixes:
+                repository.search_by_name(prefix, 20)
+
+        def full_scan():
+            # 式インデックスを使わないLIKEのみの検索（NOT INDEXEDで全件走査させる）
+            for prefix in prefixes:
+                session.execute(text(
+                    "SELECT * FROM devices NOT INDEXED WHERE site_id = 'default' AND lower(device_name) LIKE :p "
+                    "ORDER BY lower(device_name), device_id LIMIT 20"
+                ), {"p": prefix.lower() + "%"}).all()
+
+        plan = session.execute(text(
+            "EXPLAIN QUERY PLAN SELECT * FROM devices WHERE site_id = 'default' "
+            "AND lower(device_name) >= :lower AND lower(device_name) < :upper"
+        ), {"lower": "abc", "upper": "abd"}).all()
+        print(f"  plan: {' / '.join(str(row[-1]) for row in plan)}")
+        measure(f"search_by_name {searches} (index)", indexed, searches)
+        measure(f"search {searches} (full scan)", full_scan, searches)
+    engine.dispose()
+
+    print("In-memory")
+    store = open_memory_store(os.path.join(directory, "store"))
+    with memory_unit_of_work_scope(store) as unit_of_work:
+        for i, name in enumerate(names):
+            unit_of_work.devices.create(new_id(), name, i)
+        unit_of_work.commit()
+    repository = InMemoryDeviceRepository(store)
+
+    def sorted_index():
+        for prefix in prefixes:
+            repository.search_by_name(prefix, 20)
+
+    def linear_scan():
+        for prefix in prefixes:
+            prefix = prefix.lower()
+            sorted((d for d in store.devices.rows.values() if d.device_name.lower().startswith(prefix)),
+                   key=lambda d: (d.device_name.lower(), d.device_id))[:20]
+
+    measure(f"search_by_name {searches} (sorted)", sorted_index, searches)
+    measure(f"search {searches} (linear scan)", linear_scan, searches)
+    store.close()
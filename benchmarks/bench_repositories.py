@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""SQLAlchemy（SQLiteファイル）のリポジトリと、インメモリ＋ジャーナルのリポジトリの比較ベンチマーク
+
+    PYTHONPATH=src python benchmarks/bench_repositories.py [デバイス数]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+from contextlib import contextmanager
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from application.ids import new_id
+from infrastructure.models import Base
+from infrastructure.repositories import SQLAlchemyUnitOfWork
+from infrastructure.memory_repositories import memory_unit_of_work_scope, open_memory_store
+
+def measure(label: str, operation, count: int) -> None:
+    start = time.perf_counter()
+    operation()
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<34} {elapsed:7.3f}s ({elapsed / count * 1e6:8.1f}us/op)")
+
+def run(label: str, unit_of_work_factory, devices: int, lookups: int = 10000) -> None:
+    """コマンド1件=1コミットを想定して、登録・参照・状態更新・一覧の時間を計測する"""
+    print(label)
+    device_ids = [new_id() for _ in range(devices)]
+
+    def create():
+        for gpio_number, device_id in enumerate(device_ids):
+            with unit_of_work_factory() as unit_of_work:
+                unit_of_work.devices.create(device_id, "device", gpio_number)
+                unit_of_work.commit()
+
+    targets = [random.choice(device_ids) for _ in range(lookups)]
+
+    def find_by_id():
+        for device_id in targets:
+            with unit_of_work_factory() as unit_of_work:
+                unit_of_work.devices.find_by_id(device_id)
+
+    def turn_on():
+        for device_id in targets[:devices]:
+            with unit_of_work_factory() as unit_of_work:
+                unit_of_work.devices.find_by_id(device_id)
+                unit_of_work.devices.update_timestamp(device_id)
+                unit_of_work.commit()
+
+    def find_all():
+        for _ in range(10):
+            with unit_of_work_factory() as unit_of_work:
+                unit_of_work.devices.find_all()
+
+    measure(f"create {devices} (1 commit each)", create, devices)
+    measure(f"find_by_id {lookups}", find_by_id, lookups)
+    measure(f"find + update {min(devices, lookups)} (1 commit each)", turn_on, min(devices, lookups))
+    measure(f"find_all {devices} x10", find_all, 10)
+
+if __name__ == "__main__":
+    devices = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+    directory = tempfile.mkdtemp()
+    engine = create_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+    Base.metadata.create_all(engine)
+    SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
+
+    @contextmanager
+    def sqlalchemy_unit_of_work():
+        with SessionLocal() as session, SQLAlchemyUnitOfWork(session) as unit_of_work:
+            yield unit_of_work
+
+    run("SQLAlchemy (SQLite file)", sqlalchemy_unit_of_work, devices)
+    engine.dispose()
+
+    store_dir = os.path.join(directory, "store")
+    store = open_memory_store(store_dir)
+    run("In-memory + journal", lambda: memory_unit_of_work_scope(store), devices)
+    store.close()
+
+    start = time.perf_counter()
+    store = open_memory_store(store_dir)
+    print(f"  {'replay journal':<34} {time.perf_counter() - start:7.3f}s ({len(store.devices.rows)} devices)")
+    store.compact()
+    store.close()
+    start = time.perf_counter()
+    store = open_memory_store(store_dir)
+    print(f"  {'load snapshot':<34} {time.perf_counter() - start:7.3f}s ({len(store.devices.rows)} devices)")
+    store.close()
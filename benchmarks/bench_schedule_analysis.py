@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""スケジュールの分析（NumPyによるベクトル化）と、分ごとのPythonのループの比較ベンチマーク
+
+    PYTHONPATH=src python benchmarks/bench_schedule_analysis.py [スケジュール数]
+"""
+import os
+import sys
+import time
+import random
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from application.ids import new_id
+from application.repositories import ScheduleLoadRow
+from application.schedule_analysis import MINUTES_PER_DAY, analyze_schedules
+
+DEVICES = 2000
+
+def measure(label: str, operation):
+    start = time.perf_counter()
+    result = operation()
+    print(f"  {label:<34} {time.perf_counter() - start:7.3f}s")
+    return result
+
+def analyze_naive(rows):
+    """デバイスごとに1日の分を順に走査して求める（比較用）"""
+    by_device = defaultdict(dict)
+    conflicts = 0
+    for row in sorted(rows, key=lambda row: row.schedule_id):
+        hour, minute = map(int, row.schedule.split(":"))
+        actions = by_device[row.device_id]
+        slot = hour * 60 + minute
+        if slot in actions and actions[slot] != row.is_on:
+            conflicts += 1
+        actions[slot] = row.is_on
+    switches = {}
+    on_minutes = {}
+    for device_id, actions in by_device.items():
+        state = actions[max(actions)]
+        count = minutes_on = 0
+        for slot in range(MINUTES_PER_DAY):
+            if slot in actions and actions[slot] != state:
+                state = actions[slot]
+                count += 1
+            minutes_on += state
+        switches[device_id] = count
+        on_minutes[device_id] = minutes_on
+    return switches, on_minutes, conflicts
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    device_ids = [new_id() for _ in range(DEVICES)]
+    rows = [
+        ScheduleLoadRow(new_id(), random.choice(device_ids), i % 40, f"{random.randrange(24)}:{random.randrange(60):02d}", random.random() < 0.5)
+        for i in range(count)
+    ]
+
+    print(f"{count} schedules, {DEVICES} devices")
+    analysis = measure("vectorized (NumPy)", lambda: analyze_schedules(rows))
+    switches, on_minutes, _ = measure("per-minute loop (Python)", lambda: analyze_naive(rows))
+    assert dict(zip(analysis.device_ids, analysis.switch_counts)) == switches
+    assert dict(zip(analysis.device_ids, analysis.on_minutes)) == on_minutes
+    print(f"  conflicts: {len(analysis.conflicts)}, max switches/day: {max(analysis.switch_counts)}")
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""スケジュールごとのCronTriggerのジョブと、タイミングホイール（同じ分のスケジュールをまとめて実行）の比較ベンチマーク
+
+    PYTHONPATH=src python benchmarks/bench_schedule_engine.py [スケジュール数]
+"""
+import os
+import sys
+import logging
+import time
+import random
+from datetime import datetime, timedelta
+import pytz
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from application.ids import new_id
+from application.services import ScheduleExecutorService, TimingWheelScheduleExecutorService
+from hardware.gpio_controller import MockGPIOController
+from infrastructure.memory_repositories import InMemoryDeviceRepository, memory_unit_of_work_scope, open_memory_store
+
+DEVICES = 1000
+
+def measure(label: str, operation, count: int) -> None:
+    start = time.perf_counter()
+    operation()
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<34} {elapsed:7.3f}s ({elapsed / max(count, 1) * 1e6:8.1f}us/op)")
+
+def run(label: str, executor: ScheduleExecutorService, schedules, prepare_dispatch) -> None:
+    """登録・1分ぶんの実行・削除の時間を計測する（prepare_dispatchは登録後に、実行した件数を返す1分ぶんの実行処理を返す）"""
+    print(label)
+    # 実行はジョブを起動させずに計測するため、一時停止した状態でスケジューラーを開始する
+    executor.scheduler.start(paused=True)
+
+    def add():
+        for schedule_id, device_id, schedule_time, is_on in schedules:
+            executor.add_schedule(schedule_id, device_id, schedule_time, is_on)
+
+    removed = random.sample(schedules, len(schedules) // 10)
+
+    def remove():
+        for schedule_id, *_ in removed:
+            executor.remove_schedule(schedule_id)
+
+    measure(f"add {len(schedules)}", add, len(schedules))
+    dispatch = prepare_dispatch()
+    executed = []
+    measure(f"dispatch {target:%H:%M}", lambda: executed.append(dispatch()), 1)
+    print(f"  {'  executed':<34} {executed[0]}")
+    measure(f"remove {len(removed)}", remove, len(removed))
+    executor.scheduler.shutdown(wait=False)
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    # スケジュールごとの追加・削除のログを計測に含めない
+    logging.disable(logging.INFO)
+
+    store = open_memory_store(None)
+    with memory_unit_of_work_scope(store) as unit_of_work:
+        device_ids = [new_id() for _ in range(DEVICES)]
+        for gpio_number, device_id in enumerate(device_ids):
+            unit_of_work.devices.create(device_id, "device", gpio_number)
+        unit_of_work.commit()
+    repository = InMemoryDeviceRepository(store)
+    gpio_controller = MockGPIOController()
+    schedules = [
+        (new_id(), random.choice(device_ids), f"{random.randrange(24)}:{random.randrange(60):02d}", random.random() < 0.5)
+        for _ in range(count)
+    ]
+
+    # 両方式で同じ分（数分後）のスケジュールを実行する
+    target = (datetime.now(pytz.timezone('Asia/Tokyo')) + timedelta(minutes=3)).replace(second=0, microsecond=0)
+
+    cron = ScheduleExecutorService(repository, gpio_controller)
+
+    def cron_dispatch():
+        # APSchedulerが毎分行う処理: 先頭の実行時刻に達したジョブを取り出して実行し、
+        # 次回の実行時刻を再計算してソート済みのジョブ一覧に戻す
+        jobstore = cron.scheduler._jobstores["default"]
+        now = target
+        # 対象の分より前のジョブは実行済みとして除く
+        due = [job for job in jobstore.get_due_jobs(now) if job.next_run_time == now]
+
+        def dispatch():
+            for job in due:
+                cron._execute_schedule(*job.args)
+                job._modify(next_run_time=job.trigger.get_next_fire_time(now, now))
+                jobstore.update_job(job)
+            return len(due)
+        return dispatch
+
+    run("CronTrigger per schedule", cron, schedules, cron_dispatch)
+
+    wheel = TimingWheelScheduleExecutorService(repository, gpio_controller)
+
+    def wheel_dispatch():
+        slot = target.hour * 60 + target.minute
+        return lambda: len(wheel.dispatch(slot))
+
+    run("Timing wheel", wheel, schedules, wheel_dispatch)
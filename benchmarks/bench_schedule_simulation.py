@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""仮想時間のシミュレーションで、スケジュールの1年分の実行を早送りする速さのベンチマーク
+
+    PYTHONPATH=src python benchmarks/bench_schedule_simulation.py [スケジュール数] [日数]
+"""
+import os
+import sys
+import logging
+import time
+import random
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from application.repositories import ScheduleLoadRow
+from application.schedule_simulation import ScheduleSimulator
+
+DEVICES = 100
+
+if __name__ == "__main__":
+    schedules = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 365
+    # 実行ごとの集計ログを出さない
+    logging.disable(logging.INFO)
+
+    random.seed(0)
+    rows = [
+        ScheduleLoadRow(
+            f"schedule-{i:06d}", f"device-{i % DEVICES:03d}", i % DEVICES,
+            f"{random.randrange(24):02d}:{random.randrange(60):02d}", random.random() < 0.5
+        )
+        for i in range(schedules)
+    ]
+    start = datetime(2026, 1, 1)
+    simulator = ScheduleSimulator(start)
+    simulator.load(rows)
+
+    started_at = time.perf_counter()
+    simulator.run_until(start + timedelta(days=days) - timedelta(minutes=1))
+    elapsed = time.perf_counter() - started_at
+    print(f"{schedules} schedules, {DEVICES} devices, {days} days")
+    print(f"  ticks {simulator.ticks}, executions {simulator.executions}, transitions {len(simulator.transitions)}")
+    print(f"  {elapsed:.3f}s ({days * 86400 / elapsed:,.0f}x real time)")
@@ -0,0 +1,43 @@
+"""Add keyset pagination indexes
+
+Revision ID: a1c3e5f7b9d2
+Revises: 5eb42bb3018f
+Create Date: 2026-10-19 09:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a1c3e5f7b9d2'
+down_revision: Union[str, None] = '5eb42bb3018f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 初期マイグレーションにはschedulesテーブルが含まれていないため、未作成の場合のみ作成する
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('schedules'):
+        op.create_table('schedules',
+        sa.Column('schedule_id', sa.String(), nullable=False),
+        sa.Column('device_id', sa.String(), nullable=False),
+        sa.Column('schedule', sa.String(), nullable=False),
+        sa.Column('is_on', sa.Boolean(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['device_id'], ['devices.device_id'], ),
+        sa.PrimaryKeyConstraint('schedule_id')
+        )
+    op.create_index('ix_devices_created_at_device_id', 'devices', ['created_at', 'device_id'], unique=False)
+    op.create_index('ix_schedules_device_id_schedule', 'schedules', ['device_id', 'schedule', 'schedule_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_schedules_device_id_schedule', table_name='schedules')
+    op.drop_index('ix_devices_created_at_device_id', table_name='devices')
@@ -0,0 +1,55 @@
+"""Cascade schedule deletes with their device
+
+Revision ID: a7c9e1f3b5d8
+Revises: f6b8d0e2a4c7
+Create Date: 2026-10-19 16:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7c9e1f3b5d8'
+down_revision: Union[str, None] = 'f6b8d0e2a4c7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# SQLiteの外部キーは名前を持たないため、バッチ処理で名前を付けて置き換える
+NAMING_CONVENTION = {"fk": "%(table_name)s_%(column_0_name)s_fkey"}
+FOREIGN_KEY = 'schedules_device_id_fkey'
+
+
+def _replace_foreign_key(ondelete: Union[str, None]) -> None:
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.drop_constraint(FOREIGN_KEY, 'schedules', type_='foreignkey')
+        op.create_foreign_key(FOREIGN_KEY, 'schedules', 'devices', ['device_id'], ['device_id'], ondelete=ondelete)
+        return
+    
+    with op.batch_alter_table('schedules', naming_convention=NAMING_CONVENTION) as batch_op:
+        batch_op.drop_constraint(FOREIGN_KEY, type_='foreignkey')
+        batch_op.create_foreign_key(FOREIGN_KEY, 'devices', ['device_id'], ['device_id'], ondelete=ondelete)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # これまでのデバイス削除で残ったスケジュールを削除し、変更履歴を墓標に置き換える
+    op.execute(
+        "DELETE FROM change_log WHERE entity_type = 'schedule' AND entity_id IN ("
+        "SELECT schedule_id FROM schedules WHERE device_id NOT IN (SELECT device_id FROM devices))"
+    )
+    op.execute(
+        "INSERT INTO change_log (entity_type, entity_id, deleted, changed_at) "
+        "SELECT 'schedule', schedule_id, true, CURRENT_TIMESTAMP FROM schedules "
+        "WHERE device_id NOT IN (SELECT device_id FROM devices)"
+    )
+    op.execute("DELETE FROM schedules WHERE device_id NOT IN (SELECT device_id FROM devices)")
+    _replace_foreign_key('CASCADE')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    _replace_foreign_key(None)
@@ -0,0 +1,62 @@
+"""Partition devices, schedules and change log by site
+
+Revision ID: b8d0f2a4c6e9
+Revises: a7c9e1f3b5d8
+Create Date: 2026-10-19 17:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b8d0f2a4c6e9'
+down_revision: Union[str, None] = 'a7c9e1f3b5d8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# 既存の行は単一サイト構成のサイトに属する
+DEFAULT_SITE_ID = 'default'
+# SQLiteのユニーク制約は名前を持たないため、PostgreSQLの既定の名前に合わせて置き換える
+NAMING_CONVENTION = {"uq": "%(table_name)s_%(column_0_name)s_key"}
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    with op.batch_alter_table('devices', naming_convention=NAMING_CONVENTION) as batch_op:
+        batch_op.add_column(sa.Column('site_id', sa.String(), nullable=False, server_default=DEFAULT_SITE_ID))
+        # GPIO番号はサイトごとに一意にする
+        batch_op.drop_constraint('devices_gpio_number_key', type_='unique')
+        batch_op.create_unique_constraint('uq_devices_site_id_gpio_number', ['site_id', 'gpio_number'])
+    op.drop_index('ix_devices_created_at_device_id', table_name='devices')
+    op.create_index('ix_devices_site_id_created_at_device_id', 'devices', ['site_id', 'created_at', 'device_id'], unique=False)
+    
+    with op.batch_alter_table('schedules') as batch_op:
+        batch_op.add_column(sa.Column('site_id', sa.String(), nullable=False, server_default=DEFAULT_SITE_ID))
+    op.drop_index('ix_schedules_device_id_schedule', table_name='schedules')
+    op.create_index('ix_schedules_site_id_device_id_schedule', 'schedules', ['site_id', 'device_id', 'schedule', 'schedule_id'], unique=False)
+    
+    with op.batch_alter_table('change_log') as batch_op:
+        batch_op.add_column(sa.Column('site_id', sa.String(), nullable=False, server_default=DEFAULT_SITE_ID))
+    op.create_index('ix_change_log_site_id_revision', 'change_log', ['site_id', 'revision'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_change_log_site_id_revision', table_name='change_log')
+    with op.batch_alter_table('change_log') as batch_op:
+        batch_op.drop_column('site_id')
+    
+    op.drop_index('ix_schedules_site_id_device_id_schedule', table_name='schedules')
+    op.create_index('ix_schedules_device_id_schedule', 'schedules', ['device_id', 'schedule', 'schedule_id'], unique=False)
+    with op.batch_alter_table('schedules') as batch_op:
+        batch_op.drop_column('site_id')
+    
+    op.drop_index('ix_devices_site_id_created_at_device_id', table_name='devices')
+    op.create_index('ix_devices_created_at_device_id', 'devices', ['created_at', 'device_id'], unique=False)
+    with op.batch_alter_table('devices', naming_convention=NAMING_CONVENTION) as batch_op:
+        batch_op.drop_constraint('uq_devices_site_id_gpio_number', type_='unique')
+        batch_op.create_unique_constraint('devices_gpio_number_key', ['gpio_number'])
+        batch_op.drop_column('site_id')
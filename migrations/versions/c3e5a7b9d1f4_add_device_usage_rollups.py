@@ -0,0 +1,42 @@
+"""Add device usage rollup tables
+
+Revision ID: c3e5a7b9d1f4
+Revises: b2d4f6a8c0e1
+Create Date: 2026-10-19 11:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c3e5a7b9d1f4'
+down_revision: Union[str, None] = 'b2d4f6a8c0e1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('device_usage',
+    sa.Column('device_id', sa.String(), nullable=False),
+    sa.Column('granularity', sa.String(), nullable=False),
+    sa.Column('bucket_start', sa.DateTime(), nullable=False),
+    sa.Column('on_seconds', sa.Float(), nullable=False),
+    sa.Column('switch_count', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('device_id', 'granularity', 'bucket_start')
+    )
+    op.create_table('device_usage_states',
+    sa.Column('device_id', sa.String(), nullable=False),
+    sa.Column('is_on', sa.Boolean(), nullable=False),
+    sa.Column('since', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('device_id')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('device_usage_states')
+    op.drop_table('device_usage')
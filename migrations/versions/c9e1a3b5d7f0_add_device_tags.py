@@ -0,0 +1,40 @@
+"""Add device_tags table for device groups
+
+Revision ID: c9e1a3b5d7f0
+Revises: b8d0f2a4c6e9
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c9e1a3b5d7f0'
+down_revision: Union[str, None] = 'b8d0f2a4c6e9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    # devices.device_idと同じ型（PostgreSQLはuuid型、その他は16バイトのバイナリ）
+    id_type = postgresql.UUID(as_uuid=True) if bind.dialect.name == 'postgresql' else sa.LargeBinary(16)
+    op.create_table('device_tags',
+    sa.Column('site_id', sa.String(), nullable=False),
+    sa.Column('tag', sa.String(), nullable=False),
+    sa.Column('device_id', id_type, nullable=False),
+    sa.ForeignKeyConstraint(['device_id'], ['devices.device_id'], name='device_tags_device_id_fkey', ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('site_id', 'tag', 'device_id')
+    )
+    op.create_index('ix_device_tags_device_id', 'device_tags', ['device_id'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_device_tags_device_id', table_name='device_tags')
+    op.drop_table('device_tags')
@@ -0,0 +1,85 @@
+"""Store device and schedule ids as 16-byte UUIDs
+
+Revision ID: d4f6b8c0e2a5
+Revises: c3e5a7b9d1f4
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+import uuid
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd4f6b8c0e2a5'
+down_revision: Union[str, None] = 'c3e5a7b9d1f4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# 変換対象の (テーブル, カラム)
+ID_COLUMNS = [
+    ('devices', 'device_id'),
+    ('schedules', 'schedule_id'),
+    ('schedules', 'device_id'),
+    ('state_events', 'device_id'),
+    ('device_usage', 'device_id'),
+    ('device_usage_states', 'device_id'),
+]
+
+
+def _convert_values(bind, table: str, column: str, to_binary: bool) -> None:
+    """既存のIDを文字列⇔16バイトに変換する（UUIDとして解釈できないIDはそのまま残す）"""
+    rows = bind.execute(sa.text(f"SELECT DISTINCT {column} FROM {table}")).fetchall()
+    for (value,) in rows:
+        if to_binary:
+            # テーブル再作成時にBLOBへキャストされた文字列も元の文字列として扱う
+            text_value = value.decode() if isinstance(value, bytes) else value
+            try:
+                new_value = uuid.UUID(text_value).bytes
+            except ValueError:
+                new_value = text_value
+        else:
+            if not isinstance(value, bytes) or len(value) != 16:
+                continue
+            new_value = str(uuid.UUID(bytes=value))
+        if new_value == value:
+            continue
+        bind.execute(
+            sa.text(f"UPDATE {table} SET {column} = :new_value WHERE {column} = :old_value"),
+            {"new_value": new_value, "old_value": value}
+        )
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.drop_constraint('schedules_device_id_fkey', 'schedules', type_='foreignkey')
+        for table, column in ID_COLUMNS:
+            op.alter_column(table, column, type_=postgresql.UUID(as_uuid=True), postgresql_using=f'{column}::uuid')
+        op.create_foreign_key('schedules_device_id_fkey', 'schedules', 'devices', ['device_id'], ['device_id'])
+        return
+    
+    for table, column in ID_COLUMNS:
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(column, type_=sa.LargeBinary(16))
+        _convert_values(bind, table, column, to_binary=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    bind = op.get_bind()
+    if bind.dialect.name == 'postgresql':
+        op.drop_constraint('schedules_device_id_fkey', 'schedules', type_='foreignkey')
+        for table, column in ID_COLUMNS:
+            op.alter_column(table, column, type_=sa.String(), postgresql_using=f'{column}::text')
+        op.create_foreign_key('schedules_device_id_fkey', 'schedules', 'devices', ['device_id'], ['device_id'])
+        return
+    
+    for table, column in ID_COLUMNS:
+        _convert_values(bind, table, column, to_binary=False)
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(column, type_=sa.String())
@@ -0,0 +1,32 @@
+"""Add change_log_watermarks table for tombstone pruning
+
+Revision ID: e1a3c5b7d9f2
+Revises: d0f2b4c6e8a1
+Create Date: 2026-10-19 20:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e1a3c5b7d9f2'
+down_revision: Union[str, None] = 'd0f2b4c6e8a1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('change_log_watermarks',
+    sa.Column('site_id', sa.String(), nullable=False),
+    sa.Column('pruned_revision', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('site_id')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('change_log_watermarks')
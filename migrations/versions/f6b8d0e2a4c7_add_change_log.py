@@ -0,0 +1,52 @@
+"""Add change_log table for delta sync
+
+Revision ID: f6b8d0e2a4c7
+Revises: e5a7c9d1f3b6
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f6b8d0e2a4c7'
+down_revision: Union[str, None] = 'e5a7c9d1f3b6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    # PostgreSQLはuuid型、その他はCompactIdと同じく16バイトのバイナリ（既存のID列と同じ型）
+    id_type = postgresql.UUID(as_uuid=True) if bind.dialect.name == 'postgresql' else sa.LargeBinary(16)
+    op.create_table('change_log',
+    sa.Column('revision', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('entity_type', sa.String(), nullable=False),
+    sa.Column('entity_id', id_type, nullable=False),
+    sa.Column('deleted', sa.Boolean(), nullable=False),
+    sa.Column('changed_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('revision'),
+    sqlite_autoincrement=True
+    )
+    op.create_index('ix_change_log_entity', 'change_log', ['entity_type', 'entity_id'], unique=True)
+    
+    # 既存のデバイス・スケジュールを初回同期（since=0）で取得できるように登録する
+    op.execute(
+        "INSERT INTO change_log (entity_type, entity_id, deleted, changed_at) "
+        "SELECT 'device', device_id, false, CURRENT_TIMESTAMP FROM devices"
+    )
+    op.execute(
+        "INSERT INTO change_log (entity_type, entity_id, deleted, changed_at) "
+        "SELECT 'schedule', schedule_id, false, CURRENT_TIMESTAMP FROM schedules"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_change_log_entity', table_name='change_log')
+    op.drop_table('change_log')
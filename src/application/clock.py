@@ -0,0 +1,57 @@
+"""スケジュール実行で使う時計（実時間と、シミュレーション用の仮想時間）"""
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, tzinfo
+import pytz
+
+# スケジュールの時刻（HH:MM）を解釈するタイムゾーン
+DEFAULT_TIMEZONE = pytz.timezone('Asia/Tokyo')
+
+def localize(value: datetime, timezone: tzinfo) -> datetime:
+    """タイムゾーンなしの時刻をtimezoneの現地時刻とみなす（タイムゾーン付きはそのまま返す）"""
+    if value.tzinfo is not None:
+        return value
+    if hasattr(timezone, "localize"):
+        return timezone.localize(value)
+    return value.replace(tzinfo=timezone)
+
+class Clock(ABC):
+    """現在時刻とスケジュールのタイムゾーンを提供する"""
+
+    def __init__(self, timezone: tzinfo = DEFAULT_TIMEZONE):
+        self.timezone = timezone
+
+    @abstractmethod
+    def now(self) -> datetime:
+        """タイムゾーン付きの現在時刻"""
+        pass
+
+class SystemClock(Clock):
+    """実時間の時計"""
+
+    def now(self) -> datetime:
+        return datetime.now(self.timezone)
+
+class VirtualClock(Clock):
+    """advanceで進める仮想時間の時計
+
+    内部ではUTCで保持し、nowでタイムゾーンの時刻に変換する。
+    そのため夏時間の切り替えでは、実時間と同じく現地時刻が飛んだり戻ったりする。
+    """
+
+    def __init__(self, start: datetime, timezone: tzinfo = DEFAULT_TIMEZONE):
+        super().__init__(timezone)
+        self._utc = localize(start, timezone).astimezone(pytz.utc)
+        self._lock = threading.Lock()
+
+    def now(self) -> datetime:
+        with self._lock:
+            utc = self._utc
+        return utc.astimezone(self.timezone)
+
+    def advance(self, delta: timedelta) -> None:
+        """時刻をdeltaだけ進める"""
+        if delta < timedelta(0):
+            raise ValueError("VirtualClock cannot go backwards")
+        with self._lock:
+            self._utc += delta
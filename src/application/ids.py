@@ -0,0 +1,43 @@
+import os
+import time
+import uuid
+import threading
+
+# 同一ミリ秒内で発行したIDの順序を保つためのカウンタ
+_lock = threading.Lock()
+_last_timestamp_ms = 0
+_counter = 0
+
+def uuid7() -> uuid.UUID:
+    """時刻順に並ぶUUID（RFC 9562 UUIDv7）を生成する
+
+    先頭48bitがUNIXミリ秒、続く12bitが同一ミリ秒内の連番のため、
+    発行順にソートされ、B-treeインデックスの末尾に追記される。
+    """
+    global _last_timestamp_ms, _counter
+    
+    with _lock:
+        timestamp_ms = time.time_ns() // 1_000_000
+        if timestamp_ms <= _last_timestamp_ms:
+            # 同一ミリ秒（または時計の巻き戻り）の場合は連番を進める
+            timestamp_ms = _last_timestamp_ms
+            _counter += 1
+            if _counter > 0xFFF:
+                timestamp_ms += 1
+                _counter = 0
+        else:
+            _counter = 0
+        _last_timestamp_ms = timestamp_ms
+        counter = _counter
+    
+    rand_b = int.from_bytes(os.urandom(8), "big") & 0x3FFFFFFFFFFFFFFF
+    value = (timestamp_ms & 0xFFFFFFFFFFFF) << 80
+    value |= 0x7 << 76
+    value |= counter << 64
+    value |= 0x2 << 62
+    value |= rand_b
+    return uuid.UUID(int=value)
+
+def new_id() -> str:
+    """デバイス・スケジュールなどの新しいIDを発行する"""
+    return str(uuid7())
@@ -1,6 +1,6 @@
 from datetime import datetime
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, Field
+from typing import Dict, List, Optional
 
 class DeviceRegisterRequest(BaseModel):
     device_name: str
@@ -12,6 +12,7 @@ class DeviceRegisterResponse(BaseModel):
     gpio_number: int
     created_at: datetime
     updated_at: datetime
+    version: int
 
 class DeviceModel(BaseModel):
     device_id: str
@@ -20,15 +21,19 @@ class DeviceModel(BaseModel):
     is_on: bool
     created_at: datetime
     updated_at: datetime
+    version: int
 
 class DeviceListResponse(BaseModel):
     devices: List[DeviceModel]
+    # 続きがある場合のみ設定される（次ページ取得時にcursorとして渡す）
+    next_cursor: Optional[str] = None
 
 class DeviceStatusResponse(BaseModel):
     device_id: str
     device_name: str
     gpio_number: int
     is_on: bool
+    version: int
 
 class GPIOStatusResponse(BaseModel):
     gpio_number: int
@@ -38,6 +43,35 @@ class DeviceDeleteResponse(BaseModel):
     message: str
     device_id: str
 
+class DeviceBulkDeleteRequest(BaseModel):
+    device_ids: List[str] = Field(min_length=1, max_length=1000)
+    # デバイスID -> 削除の前提となるバージョン（指定したデバイスはバージョンが一致する場合だけ削除する）
+    expected_versions: Dict[str, int] = Field(default_factory=dict)
+
+class DeviceBulkDeleteResponse(BaseModel):
+    message: str
+    device_ids: List[str]
+    # 存在しなかった（削除済みの）デバイスのID
+    not_found: List[str]
+    # expected_versionsとバージョンが一致しなかったため削除しなかったデバイスのID
+    conflicts: List[str] = []
+
+class DeviceTagsRequest(BaseModel):
+    tags: List[str] = Field(max_length=100)
+
+class DeviceTagsResponse(BaseModel):
+    device_id: str
+    tags: List[str]
+
+class DeviceGroupRequest(BaseModel):
+    # 指定したタグをすべて持つデバイスが対象
+    tags: List[str] = Field(min_length=1, max_length=20)
+
+class DeviceGroupStateResponse(BaseModel):
+    tags: List[str]
+    is_on: bool
+    devices: List[DeviceStatusResponse]
+
 class DeviceUpdateRequest(BaseModel):
     device_name: Optional[str] = None
     gpio_number: Optional[int] = None
@@ -48,6 +82,7 @@ class DeviceUpdateResponse(BaseModel):
     gpio_number: int
     created_at: datetime
     updated_at: datetime
+    version: int
 
 class ScheduleCreateRequest(BaseModel):
     schedule: str
@@ -57,6 +92,7 @@ class ScheduleModel(BaseModel):
     schedule_id: str
     schedule: str
     is_on: bool
+    version: int
 
 class ScheduleCreateResponse(BaseModel):
     schedule_id: str
@@ -64,6 +100,104 @@ class ScheduleCreateResponse(BaseModel):
     schedule: str
     is_on: bool
     created_at: datetime
+    version: int
+
+class ScheduleUpdateRequest(BaseModel):
+    schedule: Optional[str] = None
+    is_on: Optional[bool] = None
+
+class ScheduleUpdateResponse(BaseModel):
+    schedule_id: str
+    device_id: str
+    schedule: str
+    is_on: bool
+    created_at: datetime
+    updated_at: datetime
+    version: int
 
 class ScheduleListResponse(BaseModel):
-    schedules: List[ScheduleModel]
\ No newline at end of file
+    schedules: List[ScheduleModel]
+    next_cursor: Optional[str] = None
+
+class ScheduleChangeModel(BaseModel):
+    schedule_id: str
+    device_id: str
+    schedule: str
+    is_on: bool
+    version: int
+
+class ChangeModel(BaseModel):
+    revision: int
+    entity_type: str
+    entity_id: str
+    # 削除された場合はTrue（device・scheduleは設定されない）
+    deleted: bool
+    device: Optional[DeviceModel] = None
+    schedule: Optional[ScheduleChangeModel] = None
+
+class ChangesResponse(BaseModel):
+    changes: List[ChangeModel]
+    # 次回のsinceに渡すリビジョン
+    revision: int
+    # limitを超える変更が残っている場合はTrue（revisionをsinceにして続きを取得する）
+    has_more: bool
+
+class ExpectedStateModel(BaseModel):
+    device_id: str
+    gpio_number: int
+    # スケジュールから期待される状態と、その元になった直近のスケジュール（スケジュールがなければNone）
+    expected_is_on: Optional[bool] = None
+    schedule_id: Optional[str] = None
+    schedule: Optional[str] = None
+    # 実際のGPIOの状態
+    is_on: bool
+    matches: Optional[bool] = None
+
+class DeviceExpectedStateResponse(ExpectedStateModel):
+    at: str
+
+class ExpectedStateListResponse(BaseModel):
+    at: str
+    devices: List[ExpectedStateModel]
+
+class ScheduleConflictModel(BaseModel):
+    device_id: str
+    schedule: str
+    # 同じ分にON/OFFの両方を指定しているスケジュール
+    schedule_ids: List[str]
+
+class DeviceScheduleAnalysisModel(BaseModel):
+    device_id: str
+    gpio_number: int
+    schedules: int
+    # 1日のON/OFFの切り替え回数と、ONの時間（分）
+    switches: int
+    on_minutes: int
+
+class ScheduleAnalysisResponse(BaseModel):
+    devices: List[DeviceScheduleAnalysisModel]
+    conflicts: List[ScheduleConflictModel]
+    # 1日の切り替え回数がswitch_threshold以上のデバイス
+    switch_threshold: int
+    frequent_switching: List[str]
+
+class StateEventModel(BaseModel):
+    device_id: str
+    gpio_number: int
+    is_on: bool
+    source: str
+    ts: datetime
+
+class StateEventListResponse(BaseModel):
+    device_id: str
+    events: List[StateEventModel]
+
+class UsageBucketModel(BaseModel):
+    bucket_start: datetime
+    on_seconds: float
+    switch_count: int
+
+class DeviceUsageResponse(BaseModel):
+    device_id: str
+    granularity: str
+    buckets: List[UsageBucketModel]
@@ -1,6 +1,16 @@
 from abc import ABC, abstractmethod
-from typing import List, Optional
-from infrastructure.models import Device, Schedule
+from collections import namedtuple
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from infrastructure.models import Device, Schedule, StateEvent, DeviceUsage, DeviceUsageState, ChangeLog
+
+# 変更履歴（change_log）のエンティティ種別
+CHANGE_ENTITY_DEVICE = "device"
+CHANGE_ENTITY_SCHEDULE = "schedule"
+
+class VersionConflictError(Exception):
+    """楽観的排他制御で、更新・削除対象のバージョンが一致しなかった"""
+    pass
 
 class DeviceRepository(ABC):
     @abstractmethod
@@ -11,21 +21,61 @@ class DeviceRepository(ABC):
     def find_all(self) -> List[Device]:
         pass
     
+    @abstractmethod
+    def find_page(self, limit: int, after: Optional[Tuple[datetime, str]] = None) -> List[Device]:
+        """(created_at, device_id) の昇順で、afterより後ろのデバイスを最大limit件取得する"""
+        pass
+    
+    @abstractmethod
+    def iter_all(self, batch_size: int = 500) -> Iterator[Device]:
+        """全デバイスを (created_at, device_id) の昇順でbatch_size件ずつ読み出しながら返す"""
+        pass
+    
     @abstractmethod
     def find_by_id(self, device_id: str) -> Optional[Device]:
         pass
     
+    @abstractmethod
+    def find_by_ids(self, device_ids: Iterable[str]) -> List[Device]:
+        """指定したIDのデバイスをまとめて取得する（存在しないIDは無視）"""
+        pass
+    
+    @abstractmethod
+    def search_by_name(self, prefix: str, limit: int) -> List[Device]:
+        """名前が前方一致するデバイスを大文字小文字を区別せずに (小文字の名前, device_id) の昇順で最大limit件取得する"""
+        pass
+    
     @abstractmethod
     def update_timestamp(self, device_id: str) -> None:
+        """updated_atのみ更新する（バージョンは変えない）"""
         pass
     
     @abstractmethod
-    def delete(self, device_id: str) -> bool:
+    def update_timestamps(self, device_ids: Iterable[str]) -> None:
+        """複数のデバイスのupdated_atをまとめて更新する（バージョンは変えない）"""
         pass
     
     @abstractmethod
-    def update_device(self, device_id: str, device_name: Optional[str] = None, gpio_number: Optional[int] = None) -> bool:
+    def delete(self, device_id: str, expected_version: Optional[int] = None) -> bool:
+        """デバイスとそのスケジュールを削除する。expected_versionを指定した場合、バージョンが一致しなければVersionConflictError"""
         pass
+    
+    @abstractmethod
+    def delete_many(self, device_ids: Iterable[str], expected_versions: Optional[Dict[str, int]] = None) -> List[str]:
+        """指定したデバイスとそのスケジュールをまとめて削除し、削除できたデバイスのIDを返す
+
+        expected_versionsに含まれるデバイスは、バージョンが一致する場合だけ削除する（一致しなければ削除せず、戻り値に含まれない）。
+        """
+        pass
+    
+    @abstractmethod
+    def update_device(self, device_id: str, device_name: Optional[str] = None, gpio_number: Optional[int] = None, expected_version: Optional[int] = None) -> bool:
+        """バージョンを1増やして更新する。expected_versionを指定した場合、バージョンが一致しなければVersionConflictError"""
+        pass
+
+# 起動時にスケジューラーへ一括登録するための、スケジュールとデバイスを結合した行（ORMのオブジェクトを作らない）
+# versionはスケジュールのバージョン（実行中のスケジュールとの差分の検出用）
+ScheduleLoadRow = namedtuple("ScheduleLoadRow", ["schedule_id", "device_id", "gpio_number", "schedule", "is_on", "version"], defaults=[None])
 
 class ScheduleRepository(ABC):
     @abstractmethod
@@ -36,14 +86,147 @@ class ScheduleRepository(ABC):
     def find_all(self) -> List[Schedule]:
         pass
     
+    @abstractmethod
+    def find_all_with_devices(self) -> List['ScheduleLoadRow']:
+        """全スケジュールを対象のデバイスのGPIO番号と結合して1回の問い合わせで取得する（起動時の一括読み込み用）"""
+        pass
+    
     @abstractmethod
     def find_by_device_id(self, device_id: str) -> List[Schedule]:
         pass
     
+    @abstractmethod
+    def find_page_by_device_id(self, device_id: str, limit: int, after: Optional[Tuple[str, str]] = None) -> List[Schedule]:
+        """(schedule, schedule_id) の昇順で、afterより後ろのスケジュールを最大limit件取得する"""
+        pass
+    
     @abstractmethod
     def find_by_id(self, schedule_id: str) -> Optional[Schedule]:
         pass
     
     @abstractmethod
-    def delete(self, schedule_id: str) -> bool:
-        pass
\ No newline at end of file
+    def find_by_ids(self, schedule_ids: Iterable[str]) -> List[Schedule]:
+        """指定したIDのスケジュールをまとめて取得する（存在しないIDは無視）"""
+        pass
+    
+    @abstractmethod
+    def update(self, schedule_id: str, schedule: Optional[str] = None, is_on: Optional[bool] = None, expected_version: Optional[int] = None) -> bool:
+        """バージョンを1増やして更新する。expected_versionを指定した場合、バージョンが一致しなければVersionConflictError"""
+        pass
+    
+    @abstractmethod
+    def delete(self, schedule_id: str, expected_version: Optional[int] = None) -> bool:
+        """expected_versionを指定した場合、バージョンが一致しなければVersionConflictError"""
+        pass
+
+class DeviceTagRepository(ABC):
+    """デバイスのタグ（グループ）。デバイスを削除するとそのタグも削除される"""
+    @abstractmethod
+    def set_tags(self, device_id: str, tags: List[str]) -> None:
+        """デバイスのタグを指定したタグで置き換える"""
+        pass
+    
+    @abstractmethod
+    def find_tags(self, device_id: str) -> List[str]:
+        """デバイスのタグを昇順で取得する"""
+        pass
+    
+    @abstractmethod
+    def find_devices_by_tags(self, tags: List[str]) -> List[Device]:
+        """指定したタグをすべて持つデバイスを (created_at, device_id) の昇順で1回の問い合わせで取得する"""
+        pass
+
+class ChangeLogRepository(ABC):
+    """デバイス・スケジュールの変更履歴（変更の記録はDevice/ScheduleRepositoryの更新時に行われる）"""
+    @abstractmethod
+    def find_since(self, since: int, limit: int) -> List[ChangeLog]:
+        """sinceより大きいリビジョンの変更をリビジョンの昇順で最大limit件取得する"""
+        pass
+    
+    @abstractmethod
+    def find_latest_revision(self) -> int:
+        """最新のリビジョン（変更がなければ0）"""
+        pass
+    
+    @abstractmethod
+    def find_pruned_revision(self) -> int:
+        """削除済みのトゥームストーンの最大リビジョン（削除していなければ0）"""
+        pass
+    
+    @abstractmethod
+    def prune_tombstones(self, before: datetime) -> int:
+        """beforeより前に記録されたトゥームストーンを削除し、削除した件数を返す（コミットは呼び出し側で行う）"""
+        pass
+
+class StateEventRepository(ABC):
+    @abstractmethod
+    def add_all(self, events: List[StateEvent]) -> None:
+        """状態変化イベントをまとめて1トランザクションで追加する"""
+        pass
+    
+    @abstractmethod
+    def find_by_device_id(self, device_id: str, start: Optional[datetime] = None, end: Optional[datetime] = None, limit: int = 1000) -> List[StateEvent]:
+        """start以上end未満の状態変化をts昇順で取得する"""
+        pass
+    
+    @abstractmethod
+    def find_oldest_timestamp(self) -> Optional[datetime]:
+        pass
+    
+    @abstractmethod
+    def delete_between(self, start: datetime, end: datetime) -> int:
+        """start以上end未満の状態変化を削除し、削除件数を返す"""
+        pass
+
+class UsageRollupRepository(ABC):
+    @abstractmethod
+    def find_states(self, device_ids: Iterable[str]) -> List[DeviceUsageState]:
+        pass
+    
+    @abstractmethod
+    def apply_rollups(
+        self,
+        increments: Dict[Tuple[str, str, datetime], Tuple[float, int]],
+        states: Dict[str, Tuple[bool, datetime]],
+        expected_states: Optional[Dict[str, Optional[Tuple[bool, datetime]]]] = None
+    ) -> None:
+        """集計値の加算（キーは (device_id, granularity, bucket_start)）と最新状態の更新を1トランザクションで行う
+        
+        加算はDB上の値への加算として行う。expected_statesを指定した場合、デバイスの最新状態が
+        読み込み時の値（未集計はNone）と一致しなければ何も反映せずVersionConflictError。
+        """
+        pass
+    
+    @abstractmethod
+    def find_usage(self, device_id: str, granularity: str, start: datetime, end: datetime) -> List[DeviceUsage]:
+        """start以上end未満のバケットの集計値を取得する"""
+        pass
+
+class UnitOfWork(ABC):
+    """1リクエスト（または1回のバッチ処理）の更新をまとめて1回でコミットする
+
+    devices / schedules / tags は同じトランザクションを共有し、各リポジトリのメソッドは
+    コミットしない。commit() を呼ばずに抜けた場合の変更はすべて破棄される。
+    state_events / usage は状態履歴・使用量の読み取り用（書き込みはStateEventRecorderが別に行う）。
+    """
+    devices: DeviceRepository
+    schedules: ScheduleRepository
+    tags: DeviceTagRepository
+    changes: ChangeLogRepository
+    state_events: StateEventRepository
+    usage: UsageRollupRepository
+    
+    def __enter__(self) -> 'UnitOfWork':
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is not None:
+            self.rollback()
+    
+    @abstractmethod
+    def commit(self) -> None:
+        pass
+    
+    @abstractmethod
+    def rollback(self) -> None:
+        pass
@@ -0,0 +1,113 @@
+"""スケジュールの1日の動きをNumPyの配列（デバイス × 0時からの分）でシミュレーションして分析する"""
+from collections import defaultdict
+from typing import Dict, List, Sequence, Tuple
+import numpy as np
+from application.repositories import ScheduleLoadRow
+
+MINUTES_PER_DAY = 24 * 60
+# 状態の配列で、その分にスケジュールがないことを表す値
+NO_ACTION = -1
+
+class ScheduleAnalysis:
+    """analyze_schedulesの結果（デバイスはdevice_idの昇順）"""
+
+    def __init__(
+        self,
+        device_ids: List[str],
+        gpio_numbers: List[int],
+        schedule_counts: List[int],
+        switch_counts: List[int],
+        on_minutes: List[int],
+        conflicts: List[Tuple[str, int, List[str]]]
+    ):
+        self.device_ids = device_ids
+        self.gpio_numbers = gpio_numbers
+        self.schedule_counts = schedule_counts
+        self.switch_counts = switch_counts
+        self.on_minutes = on_minutes
+        # (device_id, 0時からの分, 同じ分にON/OFFの両方を指定しているschedule_id)
+        self.conflicts = conflicts
+
+def _parse_minute(schedule: str) -> int:
+    """HH:MMを0時からの分に変換する（不正な形式はNO_ACTION）"""
+    hour, _, minute = schedule.partition(":")
+    if not (hour.isdigit() and len(hour) <= 2 and minute.isdigit() and len(minute) == 2):
+        return NO_ACTION
+    hour, minute = int(hour), int(minute)
+    return hour * 60 + minute if hour < 24 and minute < 60 else NO_ACTION
+
+def analyze_schedules(rows: Sequence[ScheduleLoadRow]) -> ScheduleAnalysis:
+    """全スケジュールから、デバイスごとの1日のスイッチ回数・ON時間と、同じ分のON/OFFの競合を求める
+
+    同じ分に同じデバイスのスケジュールが複数ある場合は、実行時と同じく後に作成されたもの
+    （schedule_idの大きいもの）の状態になるものとしてシミュレーションする。
+    スケジュールは毎日繰り返すため、その日の最初のスケジュールより前は前日の最後の状態とする。
+    """
+    # 時刻の文字列は種類が少ないため、種類ごとに1回だけ変換する
+    parsed = {schedule: _parse_minute(schedule) for schedule in {row.schedule for row in rows}}
+    if NO_ACTION in parsed.values():
+        rows = [row for row in rows if parsed[row.schedule] != NO_ACTION]
+    if not rows:
+        return ScheduleAnalysis([], [], [], [], [], [])
+    count = len(rows)
+
+    # 文字列の列はPythonの辞書で整数に置き換えてから配列にする（文字列の配列のソートより速い）
+    first_seen: Dict[str, int] = {}
+    seen_index = np.fromiter((first_seen.setdefault(row.device_id, len(first_seen)) for row in rows), dtype=np.int64, count=count)
+    device_ids = sorted(first_seen)
+    device_rank = np.empty(len(device_ids), dtype=np.int64)
+    device_rank[[first_seen[device_id] for device_id in device_ids]] = np.arange(len(device_ids))
+    device_index = device_rank[seen_index]
+
+    minutes = np.fromiter((parsed[row.schedule] for row in rows), dtype=np.int64, count=count)
+    is_on = np.fromiter((row.is_on for row in rows), dtype=bool, count=count)
+    gpio_numbers = np.fromiter((row.gpio_number for row in rows), dtype=np.int64, count=count)
+    # 同じ分のスケジュールの順序（schedule_idの昇順）
+    schedule_ids = [row.schedule_id for row in rows]
+    schedule_rank = np.empty(count, dtype=np.int64)
+    schedule_rank[sorted(range(count), key=schedule_ids.__getitem__)] = np.arange(count)
+    devices = len(device_ids)
+    cells = device_index * MINUTES_PER_DAY + minutes
+    # デバイスごとの最初の行（GPIO番号の取得用）
+    first_rows = np.zeros(devices, dtype=np.int64)
+    first_rows[device_index[::-1]] = np.arange(count)[::-1]
+
+    # 同じデバイス・同じ分のON/OFFの競合
+    on_counts = np.bincount(cells, weights=is_on, minlength=devices * MINUTES_PER_DAY)
+    totals = np.bincount(cells, minlength=devices * MINUTES_PER_DAY)
+    conflict_cells = np.flatnonzero((on_counts > 0) & (on_counts < totals))
+
+    # 分ごとの最後のスケジュールの状態（スケジュールがない分はNO_ACTION）
+    order = np.lexsort((schedule_rank, cells))
+    last = order[np.append(cells[order][1:] != cells[order][:-1], True)]
+    actions = np.full(devices * MINUTES_PER_DAY, NO_ACTION, dtype=np.int8)
+    actions[cells[last]] = is_on[last]
+    actions = actions.reshape(devices, MINUTES_PER_DAY)
+
+    # 各分の直前のスケジュールの分を前方に伝播し、最初のスケジュールより前は前日の最後のスケジュールにする
+    source = np.where(actions != NO_ACTION, np.arange(MINUTES_PER_DAY), -1)
+    np.maximum.accumulate(source, axis=1, out=source)
+    source = np.where(source < 0, source[:, -1:], source)
+    states = np.take_along_axis(actions, source, axis=1).astype(bool)
+
+    switch_counts = np.count_nonzero(states != np.roll(states, 1, axis=1), axis=1)
+    on_minutes = np.count_nonzero(states, axis=1)
+    schedule_counts = np.bincount(device_index, minlength=devices)
+
+    # 競合は少数のため、該当するスケジュールだけを集める
+    conflicting: Dict[int, List[str]] = defaultdict(list)
+    for position in np.flatnonzero(np.isin(cells, conflict_cells)).tolist():
+        conflicting[int(cells[position])].append(schedule_ids[position])
+    conflicts = [
+        (device_ids[cell // MINUTES_PER_DAY], cell % MINUTES_PER_DAY, sorted(conflicting[cell]))
+        for cell in conflict_cells.tolist()
+    ]
+
+    return ScheduleAnalysis(
+        device_ids=device_ids,
+        gpio_numbers=gpio_numbers[first_rows].tolist(),
+        schedule_counts=schedule_counts.tolist(),
+        switch_counts=switch_counts.tolist(),
+        on_minutes=on_minutes.tolist(),
+        conflicts=conflicts
+    )
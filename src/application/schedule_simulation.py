@@ -0,0 +1,82 @@
+"""仮想時間の時計でスケジュールの実行を早送りし、ピンの状態の変化を記録するシミュレーション"""
+from collections import namedtuple
+from datetime import datetime, timedelta, tzinfo
+from typing import Dict, Iterable, List, Optional, Tuple
+from application.clock import DEFAULT_TIMEZONE, VirtualClock, localize
+from application.repositories import DeviceRepository, ScheduleLoadRow
+from application.services import SCHEDULE_OUTCOME_APPLIED, ScheduleOutcome, TimingWheelScheduleExecutorService
+from hardware.gpio_controller import GPIOController, MockGPIOController
+
+# ティックの間隔（実際のスケジューラーと同じく毎分0秒）
+TICK_INTERVAL = timedelta(minutes=1)
+
+# ピンの状態の変化（tsは仮想時間の時計の時刻）
+Transition = namedtuple("Transition", ["ts", "schedule_id", "device_id", "gpio_number", "is_on"])
+
+class ScheduleSimulator:
+    """タイミングホイールの実行サービスを仮想時間で動かす
+
+    スケジューラーのスレッドは開始せず、時計を1分ずつ進めて実際と同じティックの処理を呼ぶため、
+    取りこぼした分の遡り・日付の変わり目・夏時間の切り替えも実運用と同じ経路で実行される。
+    ピンは全てOFFから開始し、スケジュールで状態が変わるたびにTransitionを記録する。
+    """
+
+    def __init__(
+        self,
+        start: datetime,
+        timezone: tzinfo = DEFAULT_TIMEZONE,
+        device_repository: Optional[DeviceRepository] = None,
+        gpio_controller: Optional[GPIOController] = None
+    ):
+        self.clock = VirtualClock(start, timezone)
+        self.gpio_controller = gpio_controller or MockGPIOController()
+        self.executor = TimingWheelScheduleExecutorService(device_repository, self.gpio_controller, clock=self.clock)
+        self.transitions: List[Transition] = []
+        # 実行したスケジュール数（置き換えられたもの・失敗したものを含む）とティック数
+        self.executions = 0
+        self.ticks = 0
+        self._states: Dict[int, bool] = {}
+
+    def load(self, rows: Iterable[ScheduleLoadRow], reconcile: bool = True) -> Tuple[int, int]:
+        """スケジュールを登録し、(追加数, 失敗数) を返す
+
+        reconcileがTrueの場合、起動時と同じく開始時刻の直近のスケジュールの状態を反映する。
+        """
+        rows = list(rows)
+        added, failed = self.executor.add_schedules(rows)
+        if reconcile:
+            self._record(self.executor.reconcile_states(rows))
+        return added, failed
+
+    def run_until(self, end: datetime) -> List[Transition]:
+        """endまで1分ごとにティックを実行し、この間の状態の変化を返す（繰り返し呼んで続きを実行できる）"""
+        end = localize(end, self.clock.timezone)
+        first = len(self.transitions)
+        now = self.clock.now()
+        # 最初のティックは開始時刻以降の最初の0秒にそろえる
+        offset = timedelta(seconds=now.second, microseconds=now.microsecond)
+        if offset:
+            self.clock.advance(TICK_INTERVAL - offset)
+            now += TICK_INTERVAL - offset
+        # タイムゾーン付きの時刻の差は実際の経過時間のため、夏時間の切り替えをまたいでも回数は正しい
+        ticks = (end - now) // TICK_INTERVAL + 1 if end >= now else 0
+        for _ in range(ticks):
+            self._record(self.executor._tick())
+            self.clock.advance(TICK_INTERVAL)
+        self.ticks += ticks
+        return self.transitions[first:]
+
+    def states(self) -> Dict[int, bool]:
+        """シミュレーション中に操作されたピンの現在の状態"""
+        return dict(self._states)
+
+    def _record(self, outcomes: List[ScheduleOutcome]) -> None:
+        """反映されたスケジュールのうち、ピンの状態を変えたものを記録する"""
+        self.executions += len(outcomes)
+        for outcome in outcomes:
+            if outcome.outcome != SCHEDULE_OUTCOME_APPLIED or self._states.get(outcome.gpio_number, False) == outcome.is_on:
+                continue
+            self._states[outcome.gpio_number] = outcome.is_on
+            self.transitions.append(Transition(
+                self.clock.now(), outcome.schedule_id, outcome.device_id, outcome.gpio_number, outcome.is_on
+            ))
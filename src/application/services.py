@@ -1,29 +1,637 @@
-import uuid
 import re
+import json
+import base64
+import bisect
 import logging
-from typing import List
-from datetime import datetime
+import threading
+from collections import deque, defaultdict, namedtuple
+from contextlib import nullcontext
+from typing import Any, Callable, ContextManager, Dict, FrozenSet, Iterable, Iterator, List, Optional, Tuple
+from datetime import datetime, timedelta
 from fastapi import HTTPException
+from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
-import pytz
-from application.repositories import DeviceRepository, ScheduleRepository
+from apscheduler.triggers.interval import IntervalTrigger
+from application.clock import Clock, SystemClock
+from application.ids import new_id
+from application.repositories import (
+    DeviceRepository, ScheduleRepository, DeviceTagRepository, StateEventRepository, UsageRollupRepository, UnitOfWork, VersionConflictError,
+    ChangeLogRepository, ScheduleLoadRow, CHANGE_ENTITY_DEVICE, CHANGE_ENTITY_SCHEDULE
+)
 from application.models import (
     DeviceRegisterRequest, DeviceRegisterResponse, DeviceModel,
     DeviceListResponse, DeviceStatusResponse, GPIOStatusResponse,
-    DeviceDeleteResponse, DeviceUpdateRequest, DeviceUpdateResponse,
-    ScheduleCreateRequest, ScheduleCreateResponse, ScheduleListResponse,
-    ScheduleModel
+    DeviceDeleteResponse, DeviceBulkDeleteRequest, DeviceBulkDeleteResponse,
+    DeviceTagsRequest, DeviceTagsResponse, DeviceGroupRequest, DeviceGroupStateResponse,
+    DeviceUpdateRequest, DeviceUpdateResponse,
+    ScheduleCreateRequest, ScheduleCreateResponse, ScheduleUpdateRequest, ScheduleUpdateResponse, ScheduleListResponse,
+    ScheduleModel, StateEventModel, StateEventListResponse, UsageBucketModel,
+    DeviceUsageResponse, ScheduleChangeModel, ChangeModel, ChangesResponse,
+    ExpectedStateModel, DeviceExpectedStateResponse, ExpectedStateListResponse,
+    ScheduleConflictModel, DeviceScheduleAnalysisModel, ScheduleAnalysisResponse
 )
 from hardware.gpio_controller import GPIOController
-from infrastructure.models import Device, Schedule
+from infrastructure.instrumentation import SchedulerMetrics, install_scheduler_instrumentation
+from infrastructure.models import ChangeLog, Device, Schedule, StateEvent
 
 logger = logging.getLogger(__name__)
 
+# 一覧APIのページサイズ
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+# スケジュールの分析で、切り替えが多いとみなす1日の切り替え回数
+DEFAULT_SWITCH_THRESHOLD = 50
+
+def _encode_cursor(*values: str) -> str:
+    """キーセットページネーションのキーを不透明なカーソル文字列に変換する"""
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode()
+
+def _decode_cursor(cursor: str, size: int) -> List[str]:
+    """カーソル文字列をキーに戻す（不正な場合は400）"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != size or not all(isinstance(v, str) for v in values):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def _commit(unit_of_work: Optional[UnitOfWork]) -> None:
+    """UnitOfWork経由の場合、そのリクエストの更新をまとめてコミットする
+    （UnitOfWorkなしのリポジトリは各メソッドでコミット済み）"""
+    if unit_of_work is not None:
+        unit_of_work.commit()
+
+def _check_expected_version(version: int, expected_versions: Optional[FrozenSet[int]]) -> None:
+    """If-Matchで指定されたバージョン（いずれか1つに一致すればよい）と現在のバージョンを比較する（不一致は412）"""
+    if expected_versions is not None and version not in expected_versions:
+        raise HTTPException(status_code=412, detail="Version mismatch")
+
+def _version_conflict(expected_versions: Optional[FrozenSet[int]]) -> HTTPException:
+    """読み込み後に他のリクエストが更新・削除していた場合のエラー（If-Match指定時は412、それ以外は409）"""
+    status_code = 412 if expected_versions is not None else 409
+    return HTTPException(status_code=status_code, detail="Resource was modified concurrently")
+
+# 状態変化の発生元
+STATE_SOURCE_API = "api"
+STATE_SOURCE_SCHEDULE = "schedule"
+STATE_SOURCE_INPUT = "input"
+
+# まとめて実行したスケジュールごとの結果
+SCHEDULE_OUTCOME_APPLIED = "applied"
+# 同じ分に同じピンを操作する後のスケジュールがあり、そちらの状態を採用した
+SCHEDULE_OUTCOME_SUPERSEDED = "superseded"
+SCHEDULE_OUTCOME_FAILED = "failed"
+
+# 停止中に実行されなかったスケジュールの起動時の扱い
+# latest: デバイスごとに直近（現在時刻以前で最も新しい）のスケジュールの状態を反映する / skip: 反映しない
+MISFIRE_POLICY_LATEST = "latest"
+MISFIRE_POLICY_SKIP = "skip"
+
+ScheduleOutcome = namedtuple("ScheduleOutcome", ["schedule_id", "device_id", "gpio_number", "is_on", "outcome", "error"])
+
+# バッファ上の状態変化（永続化前の値）
+StateChange = namedtuple("StateChange", ["device_id", "gpio_number", "is_on", "source", "ts"])
+
+class StateEventRecorder:
+    """デバイスの状態変化をメモリ上のバッファに貯め、バックグラウンドでまとめて永続化する"""
+    
+    def __init__(
+        self,
+        repository_factory: Callable[[], ContextManager[StateEventRepository]],
+        flush_interval: float = 1.0,
+        batch_size: int = 500,
+        max_buffer_size: int = 100000,
+        retention_days: int = 30,
+        prune_interval: float = 3600.0,
+        listeners: Optional[List[Callable[[List[StateChange]], None]]] = None
+    ):
+        self.repository_factory = repository_factory
+        # 書き込み成功後に同じバッチを受け取る処理（使用量の集計など）
+        self.listeners = listeners or []
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_buffer_size = max_buffer_size
+        self.retention_days = retention_days
+        self.prune_interval = prune_interval
+        self.dropped_count = 0
+        self._buffer: deque = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+    
+    def record(self, device_id: str, gpio_number: int, is_on: bool, source: str, ts: Optional[datetime] = None) -> None:
+        """状態変化をバッファに追加する（DBへの書き込みは待たない）"""
+        event = StateChange(device_id, gpio_number, is_on, source, ts or datetime.now())
+        with self._lock:
+            # バッファが溢れた場合は古いものから捨てる
+            if len(self._buffer) >= self.max_buffer_size:
+                self._buffer.popleft()
+                self.dropped_count += 1
+            self._buffer.append(event)
+            pending = len(self._buffer)
+        
+        if pending >= self.batch_size:
+            self._wakeup.set()
+    
+    def flush(self) -> int:
+        """バッファ内のイベントを1トランザクションで書き込み、件数を返す"""
+        with self._flush_lock:
+            with self._lock:
+                events = list(self._buffer)
+                self._buffer.clear()
+            if not events:
+                return 0
+            
+            try:
+                with self.repository_factory() as repository:
+                    repository.add_all([
+                        StateEvent(device_id=e.device_id, gpio_number=e.gpio_number, is_on=e.is_on, source=e.source, ts=e.ts)
+                        for e in events
+                    ])
+            except Exception as e:
+                # 書き込みに失敗した場合はバッファの先頭に戻して次回に再試行する
+                logger.warning(f"Failed to flush state events: count={len(events)}, error={str(e)}")
+                with self._lock:
+                    self._buffer.extendleft(reversed(events))
+                return 0
+            
+            for listener in self.listeners:
+                try:
+                    listener(events)
+                except Exception as e:
+                    logger.warning(f"State event listener failed: count={len(events)}, error={str(e)}")
+            
+            return len(events)
+    
+    def prune(self, now: Optional[datetime] = None) -> int:
+        """保持期間を過ぎたイベントを日単位のバケットごとに削除する"""
+        now = now or datetime.now()
+        cutoff = (now - timedelta(days=self.retention_days)).replace(hour=0, minute=0, second=0, microsecond=0)
+        
+        with self.repository_factory() as repository:
+            oldest = repository.find_oldest_timestamp()
+        if oldest is None or oldest >= cutoff:
+            return 0
+        
+        # 1日分ずつ別トランザクションで削除し、長時間のロックを避ける
+        deleted = 0
+        bucket_start = oldest.replace(hour=0, minute=0, second=0, microsecond=0)
+        while bucket_start < cutoff:
+            bucket_end = min(bucket_start + timedelta(days=1), cutoff)
+            with self.repository_factory() as repository:
+                deleted += repository.delete_between(bucket_start, bucket_end)
+            bucket_start = bucket_end
+        
+        logger.info(f"State events pruned: count={deleted}, before={cutoff.isoformat()}")
+        return deleted
+    
+    def start(self) -> None:
+        """バックグラウンドの書き込みスレッドを開始"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="state-event-recorder", daemon=True)
+        self._thread.start()
+    
+    def stop(self) -> None:
+        """書き込みスレッドを停止し、残りのイベントを書き込む"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+    
+    def _run(self) -> None:
+        next_prune = datetime.now()
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+            
+            if datetime.now() >= next_prune:
+                try:
+                    self.prune()
+                except Exception as e:
+                    logger.warning(f"Failed to prune state events: error={str(e)}")
+                next_prune = datetime.now() + timedelta(seconds=self.prune_interval)
+
+# 使用量の集計単位
+USAGE_GRANULARITIES = ("hour", "day", "month")
+# 1回の問い合わせで返すバケット数の上限
+MAX_USAGE_BUCKETS = 1000
+
+def _local_naive(value: Optional[datetime]) -> Optional[datetime]:
+    """タイムゾーン付きの時刻を、このホストの現地時刻（タイムゾーンなし）に変換する
+
+    状態履歴と使用量の集計の時刻はタイムゾーンなしの現地時刻で記録しているため、
+    問い合わせの期間もそろえてから比較する。
+    """
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone().replace(tzinfo=None)
+
+def _usage_bucket_start(ts: datetime, granularity: str) -> datetime:
+    """tsを含む集計バケットの開始時刻を返す"""
+    if granularity == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    return ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def _usage_next_bucket(bucket_start: datetime, granularity: str) -> datetime:
+    """次の集計バケットの開始時刻を返す"""
+    if granularity == "hour":
+        return bucket_start + timedelta(hours=1)
+    if granularity == "day":
+        return bucket_start + timedelta(days=1)
+    if bucket_start.month == 12:
+        return bucket_start.replace(year=bucket_start.year + 1, month=1)
+    return bucket_start.replace(month=bucket_start.month + 1)
+
+class UsageService:
+    """状態変化からON時間・切り替え回数を増分集計し、集計結果を返す"""
+    
+    def __init__(self, usage_repository: UsageRollupRepository, device_repository: Optional[DeviceRepository] = None):
+        self.usage_repository = usage_repository
+        self.device_repository = device_repository
+    
+    def apply_events(self, events: List[StateChange]) -> None:
+        """状態変化のバッチを集計テーブルに反映する"""
+        if not events:
+            return
+        
+        states = {
+            state.device_id: (state.is_on, state.since)
+            for state in self.usage_repository.find_states({e.device_id for e in events})
+        }
+        # 読み込んだ時点の状態（他のプロセスが先に集計した場合の検出用）
+        read_states = dict(states)
+        increments: dict = defaultdict(lambda: [0.0, 0])
+        changed_states = {}
+        
+        for event in sorted(events, key=lambda e: e.ts):
+            previous = states.get(event.device_id)
+            # 状態が変わらない操作（ON中のONなど）は集計対象外
+            if previous is not None and previous[0] == event.is_on:
+                continue
+            
+            ts = event.ts
+            if previous is not None:
+                # 時刻が前後した場合は直前の状態変化に揃える
+                ts = max(ts, previous[1])
+                if previous[0]:
+                    self._add_on_interval(increments, event.device_id, previous[1], ts)
+            
+            # 初回のOFFは初期状態と同じため切り替えとして数えない
+            if previous is not None or event.is_on:
+                for granularity in USAGE_GRANULARITIES:
+                    increments[(event.device_id, granularity, _usage_bucket_start(ts, granularity))][1] += 1
+            
+            states[event.device_id] = (event.is_on, ts)
+            changed_states[event.device_id] = (event.is_on, ts)
+        
+        if changed_states:
+            self.usage_repository.apply_rollups(
+                {key: (value[0], value[1]) for key, value in increments.items()},
+                changed_states,
+                expected_states={device_id: read_states.get(device_id) for device_id in changed_states}
+            )
+    
+    def _add_on_interval(self, increments: dict, device_id: str, start: datetime, end: datetime) -> None:
+        """ON区間 [start, end) を各集計バケットに振り分けて加算する"""
+        for granularity in USAGE_GRANULARITIES:
+            bucket_start = _usage_bucket_start(start, granularity)
+            current = start
+            while current < end:
+                bucket_end = _usage_next_bucket(bucket_start, granularity)
+                segment_end = min(bucket_end, end)
+                increments[(device_id, granularity, bucket_start)][0] += (segment_end - current).total_seconds()
+                current = segment_end
+                bucket_start = bucket_end
+    
+    def get_usage(self, device_id: str, granularity: str = "day", start: Optional[datetime] = None, end: Optional[datetime] = None, now: Optional[datetime] = None) -> DeviceUsageResponse:
+        if granularity not in USAGE_GRANULARITIES:
+            raise HTTPException(status_code=400, detail=f"Invalid granularity: {granularity}")
+        
+        if self.device_repository is not None and not self.device_repository.find_by_id(device_id):
+            raise HTTPException(status_code=404, detail="Device not found")
+        
+        start, end, now = _local_naive(start), _local_naive(end), _local_naive(now)
+        now = now or datetime.now()
+        # 期間の指定がない場合は直近（24時間 / 7日 / 12ヶ月）を返す
+        end_bucket = _usage_next_bucket(_usage_bucket_start(end or now, granularity), granularity)
+        if start is None:
+            default_span = {"hour": timedelta(hours=23), "day": timedelta(days=6), "month": timedelta(days=334)}
+            start = (end or now) - default_span[granularity]
+        start_bucket = _usage_bucket_start(start, granularity)
+        
+        bucket_starts = []
+        bucket_start = start_bucket
+        while bucket_start < end_bucket:
+            bucket_starts.append(bucket_start)
+            if len(bucket_starts) > MAX_USAGE_BUCKETS:
+                raise HTTPException(status_code=400, detail="Too many buckets requested")
+            bucket_start = _usage_next_bucket(bucket_start, granularity)
+        
+        if not bucket_starts:
+            raise HTTPException(status_code=400, detail="start must be earlier than end")
+        
+        rows = {
+            usage.bucket_start: usage
+            for usage in self.usage_repository.find_usage(device_id, granularity, start_bucket, end_bucket)
+        }
+        
+        # 未確定のON区間（現在ONのデバイス）は問い合わせ時点までを加算する
+        open_since = None
+        states = self.usage_repository.find_states([device_id])
+        if states and states[0].is_on:
+            open_since = states[0].since
+        
+        buckets = []
+        for bucket_start in bucket_starts:
+            usage = rows.get(bucket_start)
+            on_seconds = usage.on_seconds if usage else 0.0
+            switch_count = usage.switch_count if usage else 0
+            if open_since is not None:
+                overlap_start = max(open_since, bucket_start)
+                overlap_end = min(now, _usage_next_bucket(bucket_start, granularity))
+                if overlap_end > overlap_start:
+                    on_seconds += (overlap_end - overlap_start).total_seconds()
+            buckets.append(UsageBucketModel(bucket_start=bucket_start, on_seconds=on_seconds, switch_count=switch_count))
+        
+        return DeviceUsageResponse(device_id=device_id, granularity=granularity, buckets=buckets)
+
+class UsageRollupUpdater:
+    """StateEventRecorderのリスナーとして使用量の集計を更新する
+
+    APIのワーカーごとに記録を書き込むため、他のプロセスが同じデバイスを先に集計した場合は
+    （VersionConflictError）状態を読み込み直してmax_attempts回まで再試行する。
+    それでも反映できなかったバッチは保持しておき、次のバッチと一緒に反映する。
+    """
+    
+    def __init__(
+        self,
+        repository_factory: Callable[[], ContextManager[UsageRollupRepository]],
+        max_attempts: int = 5,
+        max_pending: int = 100000
+    ):
+        self.repository_factory = repository_factory
+        self.max_attempts = max_attempts
+        self.max_pending = max_pending
+        self._pending: List[StateChange] = []
+        self._lock = threading.Lock()
+    
+    def __call__(self, events: List[StateChange]) -> None:
+        with self._lock:
+            batch = self._pending + list(events)
+            self._pending = []
+            try:
+                self._apply(batch)
+            except Exception:
+                if len(batch) > self.max_pending:
+                    logger.warning(f"Usage rollup backlog dropped: count={len(batch) - self.max_pending}")
+                    batch = batch[-self.max_pending:]
+                self._pending = batch
+                raise
+    
+    def _apply(self, events: List[StateChange]) -> None:
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                with self.repository_factory() as repository:
+                    UsageService(repository).apply_events(events)
+                return
+            except VersionConflictError:
+                if attempt == self.max_attempts:
+                    raise
+                logger.info(f"Usage rollup conflicted with another writer; retrying (attempt {attempt})")
+
+class StateHistoryService:
+    def __init__(self, state_event_repository: StateEventRepository, device_repository: DeviceRepository, state_recorder: Optional[StateEventRecorder] = None):
+        self.state_event_repository = state_event_repository
+        self.device_repository = device_repository
+        self.state_recorder = state_recorder
+    
+    def get_device_history(self, device_id: str, start: Optional[datetime] = None, end: Optional[datetime] = None, limit: int = 1000) -> StateEventListResponse:
+        device = self.device_repository.find_by_id(device_id)
+        if not device:
+            raise HTTPException(status_code=404, detail="Device not found")
+        
+        start, end = _local_naive(start), _local_naive(end)
+        if start is not None and end is not None and start >= end:
+            raise HTTPException(status_code=400, detail="start must be earlier than end")
+        
+        # 未書き込みのイベントも結果に含めるため、先にバッファを書き出す
+        if self.state_recorder:
+            self.state_recorder.flush()
+        
+        events = self.state_event_repository.find_by_device_id(device_id, start, end, limit)
+        return StateEventListResponse(
+            device_id=device_id,
+            events=[
+                StateEventModel(
+                    device_id=event.device_id,
+                    gpio_number=event.gpio_number,
+                    is_on=event.is_on,
+                    source=event.source,
+                    ts=event.ts
+                )
+                for event in events
+            ]
+        )
+
+class DeviceSelectorCache:
+    """タグのセレクターから解決したデバイスIDのキャッシュ
+
+    タグの所属が変わる（タグの置き換え・デバイスの削除）たびに全体を無効化する。
+    他のワーカーでの変更は無効化が届かないため、変更履歴のリビジョンが前回と変わっていれば無効化する。
+    無効化より前に問い合わせた結果を後から格納しないよう、世代番号で確認する。
+    """
+    
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: Dict[Tuple[str, ...], List[str]] = {}
+        self._generation = 0
+        self._revision: Optional[int] = None
+        self._lock = threading.Lock()
+    
+    def get(self, key: Tuple[str, ...], revision: Optional[int] = None) -> Tuple[Optional[List[str]], int]:
+        """キャッシュしたデバイスID（なければNone）と、現在の世代番号を返す
+
+        revision（変更履歴の最新リビジョン）が前回の問い合わせと異なる場合は、全体を無効化してから返す。
+        """
+        with self._lock:
+            if revision is not None and revision != self._revision:
+                self._revision = revision
+                self._generation += 1
+                self._entries.clear()
+            return self._entries.get(key), self._generation
+    
+    def put(self, key: Tuple[str, ...], generation: int, device_ids: List[str]) -> None:
+        with self._lock:
+            if generation != self._generation:
+                return
+            if len(self._entries) >= self.max_entries:
+                self._entries.clear()
+            self._entries[key] = device_ids
+    
+    def invalidate(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+# HH:MM（時は1桁も可）
+TIME_OF_DAY_PATTERN = re.compile(r'^([01]?[0-9]|2[0-3]):([0-5][0-9])$')
+
+def _minute_of_day(time_str: str) -> int:
+    """HH:MMを0時からの分に変換する（不正な形式はValueError）"""
+    match = TIME_OF_DAY_PATTERN.match(time_str or "")
+    if not match:
+        raise ValueError(f"Invalid time format: {time_str}. Use HH:MM format (00:00-23:59)")
+    return int(match.group(1)) * 60 + int(match.group(2))
+
+# タイムラインの要素: (0時からの分, schedule_id, ON/OFF)
+TimelineEntry = Tuple[int, str, bool]
+
+class ScheduleTimeline:
+    """デバイスごとのスケジュールによる状態の切り替えを時刻の昇順に並べたインメモリの索引
+
+    初回の問い合わせでスケジュールを一括で読み込み、以降はスケジュールの作成・削除と
+    デバイスの削除に合わせて差分で更新する。ある時刻に期待される状態は、その時刻以前の
+    直近の切り替え（なければ前日の最後の切り替え）を二分探索で求める。
+    読み込み中に更新があった場合は、読み込んだ結果を捨てて次の問い合わせで読み込み直す。
+    他のワーカー・プロセスでの変更は差分で届かないため、変更履歴のリビジョンが読み込み時から変わっていれば読み込み直す。
+    """
+    
+    def __init__(self):
+        self._timelines: Dict[str, List[TimelineEntry]] = {}
+        self._gpio_numbers: Dict[str, int] = {}
+        # schedule_id -> (device_id, 要素)（削除時にタイムラインを引くため）
+        self._entries: Dict[str, Tuple[str, TimelineEntry]] = {}
+        self._loaded = False
+        # 読み込み時の変更履歴のリビジョン
+        self._revision: Optional[int] = None
+        self._generation = 0
+        self._lock = threading.Lock()
+    
+    def ensure_loaded(self, loader: Callable[[], Iterable[ScheduleLoadRow]], revision: Optional[int] = None) -> None:
+        """未読み込み、またはrevision（loaderの前に取得した変更履歴の最新リビジョン）が読み込み時と異なればloaderで全スケジュールを読み込む
+
+        読み込み直す間も、読み込みが終わるまでは以前の索引で問い合わせに答える。
+        """
+        with self._lock:
+            if self._loaded and (revision is None or revision == self._revision):
+                return
+            generation = self._generation
+        rows = loader()
+        with self._lock:
+            if generation != self._generation or (self._loaded and revision == self._revision):
+                return
+            self._clear()
+            for row in rows:
+                try:
+                    self._add(row.schedule_id, row.device_id, row.gpio_number, _minute_of_day(row.schedule), row.is_on)
+                except ValueError:
+                    continue
+            self._revision = revision
+            self._loaded = True
+    
+    def _clear(self) -> None:
+        self._loaded = False
+        self._revision = None
+        self._timelines.clear()
+        self._gpio_numbers.clear()
+        self._entries.clear()
+    
+    def _add(self, schedule_id: str, device_id: str, gpio_number: int, minute: int, is_on: bool) -> None:
+        entry = (minute, schedule_id, is_on)
+        bisect.insort(self._timelines.setdefault(device_id, []), entry)
+        self._gpio_numbers[device_id] = gpio_number
+        self._entries[schedule_id] = (device_id, entry)
+    
+    def _remove(self, schedule_id: str) -> None:
+        device_id, entry = self._entries.pop(schedule_id, (None, None))
+        if device_id is None:
+            return
+        timeline = self._timelines[device_id]
+        del timeline[bisect.bisect_left(timeline, entry)]
+        if not timeline:
+            del self._timelines[device_id]
+            del self._gpio_numbers[device_id]
+    
+    def add(self, schedule_id: str, device_id: str, gpio_number: int, schedule_time: str, is_on: bool) -> None:
+        """作成されたスケジュールを追加する（コミット後に呼ぶ）"""
+        with self._lock:
+            self._generation += 1
+            if self._loaded:
+                self._add(schedule_id, device_id, gpio_number, _minute_of_day(schedule_time), is_on)
+    
+    def update(self, schedule_id: str, schedule_time: str, is_on: bool) -> None:
+        """更新されたスケジュールの時刻・ON/OFFを置き換える（コミット後に呼ぶ）"""
+        with self._lock:
+            self._generation += 1
+            device_id, _ = self._entries.get(schedule_id, (None, None))
+            if device_id is None:
+                return
+            gpio_number = self._gpio_numbers[device_id]
+            self._remove(schedule_id)
+            self._add(schedule_id, device_id, gpio_number, _minute_of_day(schedule_time), is_on)
+    
+    def remove(self, schedule_id: str) -> None:
+        """削除されたスケジュールを取り除く（コミット後に呼ぶ）"""
+        with self._lock:
+            self._generation += 1
+            self._remove(schedule_id)
+    
+    def remove_devices(self, device_ids: Iterable[str]) -> None:
+        """削除されたデバイスのスケジュールをまとめて取り除く（コミット後に呼ぶ）"""
+        with self._lock:
+            self._generation += 1
+            for device_id in device_ids:
+                for _, schedule_id, _ in list(self._timelines.get(device_id, ())):
+                    self._remove(schedule_id)
+    
+    def invalidate(self) -> None:
+        """全体を破棄し、次の問い合わせで読み込み直す"""
+        with self._lock:
+            self._generation += 1
+            self._clear()
+    
+    def _expected(self, timeline: List[TimelineEntry], minute: int) -> TimelineEntry:
+        # minute以前の最後の要素（同じ分に複数ある場合は後のもの）。なければ前日の最後の要素
+        index = bisect.bisect_left(timeline, (minute + 1,)) - 1
+        return timeline[index]
+    
+    def expected(self, device_id: str, minute: int) -> Optional[TimelineEntry]:
+        """デバイスのminute時点で期待される状態の切り替え（スケジュールがなければNone）"""
+        with self._lock:
+            timeline = self._timelines.get(device_id)
+            return self._expected(timeline, minute) if timeline else None
+    
+    def expected_all(self, minute: int) -> List[Tuple[str, int, TimelineEntry]]:
+        """スケジュールを持つ全デバイスの (device_id, GPIO番号, 期待される切り替え) をdevice_idの昇順で返す"""
+        with self._lock:
+            return [
+                (device_id, self._gpio_numbers[device_id], self._expected(timeline, minute))
+                for device_id, timeline in sorted(self._timelines.items())
+            ]
+
 class DeviceService:
-    def __init__(self, device_repository: DeviceRepository, gpio_controller: GPIOController):
+    def __init__(self, device_repository: DeviceRepository, gpio_controller: GPIOController, state_recorder: Optional[StateEventRecorder] = None, unit_of_work: Optional[UnitOfWork] = None, schedule_executor: Optional['ScheduleExecutorService'] = None, selector_cache: Optional[DeviceSelectorCache] = None, timeline: Optional[ScheduleTimeline] = None):
         self.device_repository = device_repository
         self.gpio_controller = gpio_controller
+        self.state_recorder = state_recorder
+        self.unit_of_work = unit_of_work
+        # デバイス削除時に、削除されたスケジュールのジョブを取り除く
+        self.schedule_executor = schedule_executor
+        # デバイス削除時に、タグのセレクターのキャッシュを無効化する
+        self.selector_cache = selector_cache
+        # デバイス削除・GPIO番号の変更時に、期待される状態の索引を更新する
+        self.timeline = timeline
     
     def register_device(self, request: DeviceRegisterRequest) -> DeviceRegisterResponse:
         # GPIOが既に使用されているかチェック
@@ -35,13 +643,14 @@ class DeviceService:
                     detail=f"GPIO {request.gpio_number} is already in use"
                 )
         
-        device_id = str(uuid.uuid4())
+        device_id = new_id()
         self.device_repository.create(device_id, request.device_name, request.gpio_number)
         
         # 作成されたデバイスを取得
         device = self.device_repository.find_by_id(device_id)
         if not device:
             raise HTTPException(status_code=500, detail="Failed to create device")
+        _commit(self.unit_of_work)
         
         # GPIOピンを初期化
         self.gpio_controller.setup_pin(request.gpio_number)
@@ -51,26 +660,59 @@ class DeviceService:
             device_name=device.device_name,
             gpio_number=device.gpio_number,
             created_at=device.created_at,
-            updated_at=device.updated_at
+            updated_at=device.updated_at,
+            version=device.version
         )
     
-    def get_device_list(self) -> DeviceListResponse:
-        devices = self.device_repository.find_all()
-        device_models = []
+    def get_device_list(self, limit: Optional[int] = None, cursor: Optional[str] = None) -> DeviceListResponse:
+        # ページ指定がない場合は従来通り全件を返す
+        if limit is None and cursor is None:
+            devices = self.device_repository.find_all()
+            return DeviceListResponse(devices=[self._to_device_model(device) for device in devices])
         
-        for device in devices:
-            is_on = self.gpio_controller.get_status(device.gpio_number)
-            device_model = DeviceModel(
-                device_id=device.device_id,
-                device_name=device.device_name,
-                gpio_number=device.gpio_number,
-                is_on=is_on,
-                created_at=device.created_at,
-                updated_at=device.updated_at
-            )
-            device_models.append(device_model)
+        limit = limit or DEFAULT_PAGE_LIMIT
+        after = None
+        if cursor is not None:
+            created_at, device_id = _decode_cursor(cursor, 2)
+            try:
+                after = (datetime.fromisoformat(created_at), device_id)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+        
+        # 1件多く取得して次ページの有無を判定する
+        devices = self.device_repository.find_page(limit + 1, after)
+        next_cursor = None
+        if len(devices) > limit:
+            devices = devices[:limit]
+            last = devices[-1]
+            next_cursor = _encode_cursor(last.created_at.isoformat(), last.device_id)
         
-        return DeviceListResponse(devices=device_models)
+        return DeviceListResponse(
+            devices=[self._to_device_model(device) for device in devices],
+            next_cursor=next_cursor
+        )
+    
+    def search_devices(self, query: str, limit: int = DEFAULT_PAGE_LIMIT) -> DeviceListResponse:
+        """デバイス名の前方一致（大文字小文字を区別しない）でデバイスを検索する"""
+        devices = self.device_repository.search_by_name(query, limit)
+        return DeviceListResponse(devices=[self._to_device_model(device) for device in devices])
+    
+    def stream_device_list(self, batch_size: int = 500) -> Iterator[str]:
+        """デバイス一覧をNDJSON（1行1デバイス）で逐次返す"""
+        for device in self.device_repository.iter_all(batch_size):
+            yield self._to_device_model(device).model_dump_json() + "\n"
+    
+    def _to_device_model(self, device: Device) -> DeviceModel:
+        is_on = self.gpio_controller.get_status(device.gpio_number)
+        return DeviceModel(
+            device_id=device.device_id,
+            device_name=device.device_name,
+            gpio_number=device.gpio_number,
+            is_on=is_on,
+            created_at=device.created_at,
+            updated_at=device.updated_at,
+            version=device.version
+        )
     
     def get_device_status(self, device_id: str) -> DeviceStatusResponse:
         device = self.device_repository.find_by_id(device_id)
@@ -83,7 +725,8 @@ class DeviceService:
             device_id=device.device_id,
             device_name=device.device_name,
             gpio_number=device.gpio_number,
-            is_on=is_on
+            is_on=is_on,
+            version=device.version
         )
     
     def turn_device_on(self, device_id: str) -> DeviceStatusResponse:
@@ -91,14 +734,19 @@ class DeviceService:
         if not device:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        self.gpio_controller.turn_on(device.gpio_number)
+        # 先にコミットし、コミットに失敗した場合はピンを切り替えない
         self.device_repository.update_timestamp(device_id)
+        _commit(self.unit_of_work)
+        self.gpio_controller.turn_on(device.gpio_number)
+        if self.state_recorder:
+            self.state_recorder.record(device.device_id, device.gpio_number, True, STATE_SOURCE_API)
         
         return DeviceStatusResponse(
             device_id=device.device_id,
             device_name=device.device_name,
             gpio_number=device.gpio_number,
-            is_on=True
+            is_on=True,
+            version=device.version
         )
     
     def turn_device_off(self, device_id: str) -> DeviceStatusResponse:
@@ -106,31 +754,80 @@ class DeviceService:
         if not device:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        self.gpio_controller.turn_off(device.gpio_number)
+        # 先にコミットし、コミットに失敗した場合はピンを切り替えない
         self.device_repository.update_timestamp(device_id)
+        _commit(self.unit_of_work)
+        self.gpio_controller.turn_off(device.gpio_number)
+        if self.state_recorder:
+            self.state_recorder.record(device.device_id, device.gpio_number, False, STATE_SOURCE_API)
         
         return DeviceStatusResponse(
             device_id=device.device_id,
             device_name=device.device_name,
             gpio_number=device.gpio_number,
-            is_on=False
+            is_on=False,
+            version=device.version
         )
     
-    def delete_device(self, device_id: str) -> DeviceDeleteResponse:
+    def delete_device(self, device_id: str, expected_versions: Optional[FrozenSet[int]] = None) -> DeviceDeleteResponse:
         device = self.device_repository.find_by_id(device_id)
         if not device:
             raise HTTPException(status_code=404, detail="Device not found")
+        _check_expected_version(device.version, expected_versions)
         
-        success = self.device_repository.delete(device_id)
+        try:
+            success = self.device_repository.delete(device_id, expected_version=device.version)
+        except VersionConflictError:
+            raise _version_conflict(expected_versions)
         if not success:
             raise HTTPException(status_code=500, detail="Failed to delete device")
+        _commit(self.unit_of_work)
+        self._invalidate_selectors()
+        self._remove_scheduled_jobs([device_id])
+        if self.timeline:
+            self.timeline.remove_devices([device_id])
         
         return DeviceDeleteResponse(
             message="Device deleted successfully",
             device_id=device_id
         )
     
-    def update_device(self, device_id: str, request: DeviceUpdateRequest) -> DeviceUpdateResponse:
+    def delete_devices(self, request: DeviceBulkDeleteRequest) -> DeviceBulkDeleteResponse:
+        # スケジュールはデバイスと同じトランザクションでまとめて削除される
+        device_ids = list(dict.fromkeys(request.device_ids))
+        deleted_ids = self.device_repository.delete_many(device_ids, request.expected_versions)
+        deleted = set(deleted_ids)
+        # バージョンを指定して削除されなかったデバイスのうち、まだ存在するものはバージョンの不一致
+        versioned = [device_id for device_id in device_ids if device_id not in deleted and device_id in request.expected_versions]
+        conflicts = {device.device_id for device in self.device_repository.find_by_ids(versioned)} if versioned else set()
+        _commit(self.unit_of_work)
+        if deleted_ids:
+            self._invalidate_selectors()
+            if self.timeline:
+                self.timeline.remove_devices(deleted_ids)
+        self._remove_scheduled_jobs(deleted_ids)
+        
+        return DeviceBulkDeleteResponse(
+            message=f"{len(deleted_ids)} devices deleted successfully",
+            device_ids=deleted_ids,
+            not_found=[device_id for device_id in device_ids if device_id not in deleted and device_id not in conflicts],
+            conflicts=[device_id for device_id in device_ids if device_id in conflicts]
+        )
+    
+    def _invalidate_selectors(self) -> None:
+        if self.selector_cache:
+            self.selector_cache.invalidate()
+    
+    def _remove_scheduled_jobs(self, device_ids: List[str]) -> None:
+        if not self.schedule_executor or not device_ids:
+            return
+        try:
+            self.schedule_executor.remove_device_schedules(device_ids)
+        except Exception as e:
+            # DBからは削除済みのため、ジョブが残っても実行時にデバイスなしとして扱われる
+            logger.warning(f"Failed to remove schedules of devices {device_ids} from executor: {str(e)}")
+    
+    def update_device(self, device_id: str, request: DeviceUpdateRequest, expected_versions: Optional[FrozenSet[int]] = None) -> DeviceUpdateResponse:
         # 更新パラメータが何も指定されていない場合はエラー
         if request.device_name is None and request.gpio_number is None:
             raise HTTPException(status_code=400, detail="No update parameters provided")
@@ -139,9 +836,12 @@ class DeviceService:
         device = self.device_repository.find_by_id(device_id)
         if not device:
             raise HTTPException(status_code=404, detail="Device not found")
+        _check_expected_version(device.version, expected_versions)
+        # 更新後はdeviceにも新しい値が反映される場合があるため、変更前のGPIO番号を控えておく
+        gpio_changed = request.gpio_number is not None and request.gpio_number != device.gpio_number
         
         # GPIO番号の競合をチェック（GPIO番号が更新される場合のみ）
-        if request.gpio_number is not None and request.gpio_number != device.gpio_number:
+        if gpio_changed:
             devices = self.device_repository.find_all()
             for existing_device in devices:
                 if existing_device.gpio_number == request.gpio_number and existing_device.device_id != device_id:
@@ -150,19 +850,26 @@ class DeviceService:
                         detail=f"GPIO {request.gpio_number} is already in use"
                     )
         
-        # デバイスを更新
-        success = self.device_repository.update_device(
-            device_id=device_id,
-            device_name=request.device_name,
-            gpio_number=request.gpio_number
-        )
+        # デバイスを更新（読み込み時のバージョンを条件にし、その後の他の更新を上書きしない）
+        try:
+            success = self.device_repository.update_device(
+                device_id=device_id,
+                device_name=request.device_name,
+                gpio_number=request.gpio_number,
+                expected_version=device.version
+            )
+        except VersionConflictError:
+            raise _version_conflict(expected_versions)
         
         if not success:
             raise HTTPException(status_code=500, detail="Failed to update device")
+        _commit(self.unit_of_work)
         
         # GPIO番号が変更された場合、新しいピンを初期化
-        if request.gpio_number is not None and request.gpio_number != device.gpio_number:
+        if gpio_changed:
             self.gpio_controller.setup_pin(request.gpio_number)
+            if self.timeline:
+                self.timeline.invalidate()
         
         # 更新されたデバイスを取得
         updated_device = self.device_repository.find_by_id(device_id)
@@ -174,30 +881,142 @@ class DeviceService:
             device_name=updated_device.device_name,
             gpio_number=updated_device.gpio_number,
             created_at=updated_device.created_at,
-            updated_at=updated_device.updated_at
+            updated_at=updated_device.updated_at,
+            version=updated_device.version
+        )
+
+# タグに使える文字（英数字と . _ : -、64文字まで）
+TAG_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+
+class DeviceGroupService:
+    """タグ（グループ）によるデバイスの選択と、選択したデバイスの一括操作"""
+    def __init__(self, device_repository: DeviceRepository, tag_repository: DeviceTagRepository, gpio_controller: GPIOController, selector_cache: DeviceSelectorCache, state_recorder: Optional[StateEventRecorder] = None, unit_of_work: Optional[UnitOfWork] = None, change_repository: Optional[ChangeLogRepository] = None):
+        self.device_repository = device_repository
+        self.tag_repository = tag_repository
+        self.gpio_controller = gpio_controller
+        self.selector_cache = selector_cache
+        self.state_recorder = state_recorder
+        self.unit_of_work = unit_of_work
+        # 他のワーカーでのタグ・デバイスの変更を検出するための変更履歴（なければこのプロセスでの無効化だけで保つ）
+        self.change_repository = change_repository
+    
+    def _normalize_tags(self, tags: List[str]) -> List[str]:
+        """前後の空白を除き、重複をなくして昇順に並べる（使えない文字を含む場合は400）"""
+        normalized = sorted({tag.strip() for tag in tags})
+        for tag in normalized:
+            if not TAG_PATTERN.match(tag):
+                raise HTTPException(status_code=400, detail=f"Invalid tag: {tag!r}")
+        return normalized
+    
+    def get_device_tags(self, device_id: str) -> DeviceTagsResponse:
+        if not self.device_repository.find_by_id(device_id):
+            raise HTTPException(status_code=404, detail="Device not found")
+        return DeviceTagsResponse(device_id=device_id, tags=self.tag_repository.find_tags(device_id))
+    
+    def set_device_tags(self, device_id: str, request: DeviceTagsRequest) -> DeviceTagsResponse:
+        tags = self._normalize_tags(request.tags)
+        if not self.device_repository.find_by_id(device_id):
+            raise HTTPException(status_code=404, detail="Device not found")
+        
+        self.tag_repository.set_tags(device_id, tags)
+        _commit(self.unit_of_work)
+        # コミット後に無効化し、変更前の所属を再びキャッシュしないようにする
+        self.selector_cache.invalidate()
+        return DeviceTagsResponse(device_id=device_id, tags=tags)
+    
+    def _select(self, tags: List[str]) -> List[Device]:
+        """タグをすべて持つデバイスを取得する（キャッシュがあればIDからまとめて取得する）"""
+        key = tuple(self._normalize_tags(tags))
+        revision = self.change_repository.find_latest_revision() if self.change_repository else None
+        device_ids, generation = self.selector_cache.get(key, revision)
+        if device_ids is not None:
+            devices = self.device_repository.find_by_ids(device_ids)
+            devices.sort(key=lambda device: (device.created_at, device.device_id))
+            return devices
+        
+        devices = self.tag_repository.find_devices_by_tags(list(key))
+        self.selector_cache.put(key, generation, [device.device_id for device in devices])
+        return devices
+    
+    def select_devices(self, tags: List[str]) -> DeviceListResponse:
+        devices = self._select(tags)
+        return DeviceListResponse(devices=[
+            DeviceModel(
+                device_id=device.device_id,
+                device_name=device.device_name,
+                gpio_number=device.gpio_number,
+                is_on=self.gpio_controller.get_status(device.gpio_number),
+                created_at=device.created_at,
+                updated_at=device.updated_at,
+                version=device.version
+            )
+            for device in devices
+        ])
+    
+    def set_group_state(self, request: DeviceGroupRequest, is_on: bool) -> DeviceGroupStateResponse:
+        devices = self._select(request.tags)
+        if not devices:
+            raise HTTPException(status_code=404, detail="No devices match the tags")
+        
+        # updated_atを1回の更新でまとめて記録してコミットしてから、全デバイスのGPIOを1回の操作で切り替える
+        self.device_repository.update_timestamps([device.device_id for device in devices])
+        _commit(self.unit_of_work)
+        self.gpio_controller.apply_states({device.gpio_number: is_on for device in devices})
+        if self.state_recorder:
+            for device in devices:
+                self.state_recorder.record(device.device_id, device.gpio_number, is_on, STATE_SOURCE_API)
+        
+        return DeviceGroupStateResponse(
+            tags=self._normalize_tags(request.tags),
+            is_on=is_on,
+            devices=[
+                DeviceStatusResponse(
+                    device_id=device.device_id,
+                    device_name=device.device_name,
+                    gpio_number=device.gpio_number,
+                    is_on=is_on,
+                    version=device.version
+                )
+                for device in devices
+            ]
         )
 
 class GPIOService:
-    def __init__(self, gpio_controller: GPIOController):
+    def __init__(self, gpio_controller: GPIOController, device_repository: Optional[DeviceRepository] = None, state_recorder: Optional[StateEventRecorder] = None):
         self.gpio_controller = gpio_controller
+        # GPIO番号を直接操作した場合も、そのピンのデバイスの状態変化として履歴に記録する
+        self.device_repository = device_repository
+        self.state_recorder = state_recorder
     
     def turn_gpio_on(self, gpio_number: int) -> GPIOStatusResponse:
         self.gpio_controller.turn_on(gpio_number)
+        self._record(gpio_number, True)
         return GPIOStatusResponse(gpio_number=gpio_number, is_on=True)
     
     def turn_gpio_off(self, gpio_number: int) -> GPIOStatusResponse:
         self.gpio_controller.turn_off(gpio_number)
+        self._record(gpio_number, False)
         return GPIOStatusResponse(gpio_number=gpio_number, is_on=False)
     
+    def _record(self, gpio_number: int, is_on: bool) -> None:
+        """ピンに登録されたデバイスの状態変化を記録する（デバイスが登録されていないピンは履歴の対象外）"""
+        if not self.state_recorder or not self.device_repository:
+            return
+        for device in self.device_repository.find_all():
+            if device.gpio_number == gpio_number:
+                self.state_recorder.record(device.device_id, gpio_number, is_on, STATE_SOURCE_API)
+    
     def get_gpio_status(self, gpio_number: int) -> GPIOStatusResponse:
         is_on = self.gpio_controller.get_status(gpio_number)
         return GPIOStatusResponse(gpio_number=gpio_number, is_on=is_on)
 
 class ScheduleService:
-    def __init__(self, schedule_repository: ScheduleRepository, device_repository: DeviceRepository, schedule_executor: 'ScheduleExecutorService' = None):
+    def __init__(self, schedule_repository: ScheduleRepository, device_repository: DeviceRepository, schedule_executor: 'ScheduleExecutorService' = None, unit_of_work: Optional[UnitOfWork] = None, timeline: Optional[ScheduleTimeline] = None):
         self.schedule_repository = schedule_repository
         self.device_repository = device_repository
         self.schedule_executor = schedule_executor
+        self.unit_of_work = unit_of_work
+        self.timeline = timeline
     
     def _validate_time_format(self, time_str: str) -> bool:
         """時間形式（HH:MM）のバリデーション"""
@@ -215,7 +1034,7 @@ class ScheduleService:
             raise HTTPException(status_code=400, detail="Invalid time format. Use HH:MM format (00:00-23:59)")
         
         # スケジュールを作成
-        schedule_id = str(uuid.uuid4())
+        schedule_id = new_id()
         schedule = Schedule(
             schedule_id=schedule_id,
             device_id=device_id,
@@ -224,73 +1043,355 @@ class ScheduleService:
         )
         
         saved_schedule = self.schedule_repository.save(schedule)
+        _commit(self.unit_of_work)
+        if self.timeline:
+            self.timeline.add(saved_schedule.schedule_id, device_id, device.gpio_number, saved_schedule.schedule, saved_schedule.is_on)
         
-        # ScheduleExecutorServiceにスケジュールを追加
-        if self.schedule_executor:
-            try:
-                self.schedule_executor.add_schedule(
-                    saved_schedule.schedule_id,
-                    saved_schedule.device_id,
-                    saved_schedule.schedule,
-                    saved_schedule.is_on
-                )
-            except Exception as e:
-                # スケジューラー追加に失敗した場合、DBからも削除してロールバック
-                self.schedule_repository.delete(saved_schedule.schedule_id)
-                raise HTTPException(status_code=500, detail="Failed to add schedule to executor")
+        # コミット後に登録する（コミット前に登録すると、並行するresyncが読んだコミット前のDBで取り消されるため）
+        self._sync_executor(
+            "add", saved_schedule.schedule_id, saved_schedule.device_id, saved_schedule.schedule, saved_schedule.is_on, saved_schedule.version
+        )
         
         return ScheduleCreateResponse(
             schedule_id=saved_schedule.schedule_id,
             device_id=saved_schedule.device_id,
             schedule=saved_schedule.schedule,
             is_on=saved_schedule.is_on,
-            created_at=saved_schedule.created_at
+            created_at=saved_schedule.created_at,
+            version=saved_schedule.version
         )
     
-    def get_schedules_by_device_id(self, device_id: str) -> ScheduleListResponse:
+    def _sync_executor(self, action: str, schedule_id: str, device_id: str, schedule_time: str, is_on: bool, version: Optional[int]) -> None:
+        """コミット済みのスケジュールをスケジューラーに登録する
+
+        DBには反映済みのため、登録に失敗してもリクエストは成功とし、resyncを要求して登録し直す。
+        """
+        if not self.schedule_executor:
+            return
+        try:
+            if action == "add":
+                self.schedule_executor.add_schedule(schedule_id, device_id, schedule_time, is_on, version)
+            else:
+                self.schedule_executor.update_schedule(schedule_id, device_id, schedule_time, is_on, version)
+        except Exception as e:
+            logger.error(f"Failed to {action} schedule in executor (a resync will apply it): {schedule_id}, error={str(e)}")
+            self._request_resync()
+    
+    def _request_resync(self) -> None:
+        """スケジューラーに反映できなかった変更を取り込むため、resyncをすぐに要求する（定期的なresyncが無効でも取り込まれる）"""
+        try:
+            requested = self.schedule_executor.request_resync()
+        except Exception as e:
+            logger.warning(f"Failed to request a schedule resync: {str(e)}")
+            return
+        if not requested:
+            logger.warning("Schedule resync is not available; the change will be applied when the scheduler restarts")
+    
+    def get_schedules_by_device_id(self, device_id: str, limit: Optional[int] = None, cursor: Optional[str] = None) -> ScheduleListResponse:
         # デバイスが存在するかチェック
         device = self.device_repository.find_by_id(device_id)
         if not device:
             raise HTTPException(status_code=404, detail="Device not found")
         
-        schedules = self.schedule_repository.find_by_device_id(device_id)
+        next_cursor = None
+        if limit is None and cursor is None:
+            schedules = self.schedule_repository.find_by_device_id(device_id)
+        else:
+            limit = limit or DEFAULT_PAGE_LIMIT
+            after = tuple(_decode_cursor(cursor, 2)) if cursor is not None else None
+            schedules = self.schedule_repository.find_page_by_device_id(device_id, limit + 1, after)
+            if len(schedules) > limit:
+                schedules = schedules[:limit]
+                next_cursor = _encode_cursor(schedules[-1].schedule, schedules[-1].schedule_id)
+        
         schedule_models = []
         
         for schedule in schedules:
             schedule_model = ScheduleModel(
                 schedule_id=schedule.schedule_id,
                 schedule=schedule.schedule,
-                is_on=schedule.is_on
+                is_on=schedule.is_on,
+                version=schedule.version
             )
             schedule_models.append(schedule_model)
         
-        return ScheduleListResponse(schedules=schedule_models)
+        return ScheduleListResponse(schedules=schedule_models, next_cursor=next_cursor)
+    
+    def analyze_schedules(self, switch_threshold: int = DEFAULT_SWITCH_THRESHOLD) -> ScheduleAnalysisResponse:
+        """全スケジュールの1日の動きをシミュレーションし、競合と切り替えの多いデバイスを返す"""
+        # NumPyは分析でのみ使うため、使うときに読み込む
+        from application.schedule_analysis import analyze_schedules
+        
+        analysis = analyze_schedules(self.schedule_repository.find_all_with_devices())
+        devices = [
+            DeviceScheduleAnalysisModel(
+                device_id=device_id, gpio_number=gpio_number, schedules=schedules, switches=switches, on_minutes=on_minutes
+            )
+            for device_id, gpio_number, schedules, switches, on_minutes in zip(
+                analysis.device_ids, analysis.gpio_numbers, analysis.schedule_counts, analysis.switch_counts, analysis.on_minutes
+            )
+        ]
+        return ScheduleAnalysisResponse(
+            devices=devices,
+            conflicts=[
+                ScheduleConflictModel(device_id=device_id, schedule=f"{minute // 60:02d}:{minute % 60:02d}", schedule_ids=schedule_ids)
+                for device_id, minute, schedule_ids in analysis.conflicts
+            ],
+            switch_threshold=switch_threshold,
+            frequent_switching=[device.device_id for device in devices if device.switches >= switch_threshold]
+        )
+    
+    def update_schedule(self, schedule_id: str, request: ScheduleUpdateRequest, expected_versions: Optional[FrozenSet[int]] = None) -> ScheduleUpdateResponse:
+        """スケジュールの時刻・ON/OFFを1回のトランザクションで更新し、スケジューラーのジョブをその場で置き換える"""
+        if request.schedule is None and request.is_on is None:
+            raise HTTPException(status_code=400, detail="No update parameters provided")
+        if request.schedule is not None and not self._validate_time_format(request.schedule):
+            raise HTTPException(status_code=400, detail="Invalid time format. Use HH:MM format (00:00-23:59)")
+        
+        schedule = self.schedule_repository.find_by_id(schedule_id)
+        if not schedule:
+            raise HTTPException(status_code=404, detail="Schedule not found")
+        _check_expected_version(schedule.version, expected_versions)
+        
+        try:
+            success = self.schedule_repository.update(
+                schedule_id, schedule=request.schedule, is_on=request.is_on, expected_version=schedule.version
+            )
+        except VersionConflictError:
+            raise _version_conflict(expected_versions)
+        if not success:
+            raise HTTPException(status_code=500, detail="Failed to update schedule")
+        updated = self.schedule_repository.find_by_id(schedule_id)
+        if not updated:
+            raise HTTPException(status_code=500, detail="Failed to retrieve updated schedule")
+        
+        _commit(self.unit_of_work)
+        if self.timeline:
+            self.timeline.update(schedule_id, updated.schedule, updated.is_on)
+        # 作成時と同じく、コミット後にジョブをその場で置き換える
+        self._sync_executor("update", schedule_id, updated.device_id, updated.schedule, updated.is_on, updated.version)
+        
+        return ScheduleUpdateResponse(
+            schedule_id=updated.schedule_id,
+            device_id=updated.device_id,
+            schedule=updated.schedule,
+            is_on=updated.is_on,
+            created_at=updated.created_at,
+            updated_at=updated.updated_at,
+            version=updated.version
+        )
     
-    def delete_schedule(self, schedule_id: str) -> None:
+    def delete_schedule(self, schedule_id: str, expected_versions: Optional[FrozenSet[int]] = None) -> None:
         # スケジュールが存在するかチェック
         schedule = self.schedule_repository.find_by_id(schedule_id)
         if not schedule:
             raise HTTPException(status_code=404, detail="Schedule not found")
+        _check_expected_version(schedule.version, expected_versions)
         
-        success = self.schedule_repository.delete(schedule_id)
+        try:
+            success = self.schedule_repository.delete(schedule_id, expected_version=schedule.version)
+        except VersionConflictError:
+            raise _version_conflict(expected_versions)
         if not success:
             raise HTTPException(status_code=500, detail="Failed to delete schedule")
+        _commit(self.unit_of_work)
+        if self.timeline:
+            self.timeline.remove(schedule_id)
         
         # ScheduleExecutorServiceからスケジュールを削除
         if self.schedule_executor:
             try:
                 self.schedule_executor.remove_schedule(schedule_id)
             except Exception as e:
-                # スケジューラーからの削除に失敗してもログを出力するだけ（DBからは既に削除済み）
-                logger.warning(f"Failed to remove schedule {schedule_id} from executor: {str(e)}")
-                raise HTTPException(status_code=500, detail="Failed to remove schedule from executor")
+                # DBからは削除済みのため、失敗してもリクエストは成功とし、残ったジョブはresyncで取り除く
+                logger.warning(f"Failed to remove schedule {schedule_id} from executor (a resync will remove it): {str(e)}")
+                self._request_resync()
+
+
+class ExpectedStateService:
+    """スケジュールから期待されるデバイスの状態と、実際のGPIOの状態を返す（監視用）"""
+    def __init__(
+        self,
+        timeline: ScheduleTimeline,
+        schedule_repository: ScheduleRepository,
+        device_repository: DeviceRepository,
+        gpio_controller: GPIOController,
+        change_repository: Optional[ChangeLogRepository] = None,
+        clock: Optional[Clock] = None
+    ):
+        self.timeline = timeline
+        self.schedule_repository = schedule_repository
+        self.device_repository = device_repository
+        self.gpio_controller = gpio_controller
+        # 他のワーカーでのスケジュールの変更を検出するための変更履歴（なければ差分の更新だけで保つ）
+        self.change_repository = change_repository
+        self.clock = clock or SystemClock()
+    
+    def _resolve_time(self, at: Optional[str]) -> Tuple[str, int]:
+        """問い合わせる時刻（省略時は現在時刻）をHH:MMと0時からの分で返す"""
+        if at is None:
+            at = self.clock.now().strftime('%H:%M')
+        try:
+            minute = _minute_of_day(at)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid time format. Use HH:MM format (00:00-23:59)")
+        return f"{minute // 60:02d}:{minute % 60:02d}", minute
+    
+    def _ensure_timeline(self) -> None:
+        revision = self.change_repository.find_latest_revision() if self.change_repository else None
+        self.timeline.ensure_loaded(self.schedule_repository.find_all_with_devices, revision)
+    
+    def _to_model(self, device_id: str, gpio_number: int, entry: Optional[TimelineEntry]) -> ExpectedStateModel:
+        is_on = self.gpio_controller.get_status(gpio_number)
+        if entry is None:
+            return ExpectedStateModel(device_id=device_id, gpio_number=gpio_number, is_on=is_on)
+        minute, schedule_id, expected_is_on = entry
+        return ExpectedStateModel(
+            device_id=device_id,
+            gpio_number=gpio_number,
+            expected_is_on=expected_is_on,
+            schedule_id=schedule_id,
+            schedule=f"{minute // 60:02d}:{minute % 60:02d}",
+            is_on=is_on,
+            matches=is_on == expected_is_on
+        )
+    
+    def get_device_expected(self, device_id: str, at: Optional[str] = None) -> DeviceExpectedStateResponse:
+        at, minute = self._resolve_time(at)
+        device = self.device_repository.find_by_id(device_id)
+        if not device:
+            raise HTTPException(status_code=404, detail="Device not found")
+        self._ensure_timeline()
+        model = self._to_model(device_id, device.gpio_number, self.timeline.expected(device_id, minute))
+        return DeviceExpectedStateResponse(at=at, **model.model_dump())
+    
+    def get_fleet_expected(self, at: Optional[str] = None) -> ExpectedStateListResponse:
+        """スケジュールを持つ全デバイスの期待される状態（スケジュールのテーブルは再走査しない）"""
+        at, minute = self._resolve_time(at)
+        self._ensure_timeline()
+        return ExpectedStateListResponse(at=at, devices=[
+            self._to_model(device_id, gpio_number, entry) for device_id, gpio_number, entry in self.timeline.expected_all(minute)
+        ])
+
+class ChangeLogPruner:
+    """保持期間を過ぎた変更履歴のトゥームストーン（削除されたエンティティの行）を削除する"""
+    def __init__(self, unit_of_work_scope: Callable[[], ContextManager[UnitOfWork]], retention_days: int = 30):
+        self.unit_of_work_scope = unit_of_work_scope
+        self.retention_days = retention_days
+    
+    def prune(self, now: Optional[datetime] = None) -> int:
+        """retention_daysより前に記録されたトゥームストーンを1トランザクションで削除する"""
+        cutoff = (now or datetime.now()) - timedelta(days=self.retention_days)
+        with self.unit_of_work_scope() as unit_of_work:
+            deleted = unit_of_work.changes.prune_tombstones(cutoff)
+            unit_of_work.commit()
+        if deleted:
+            logger.info(f"Change log tombstones pruned: count={deleted}, before={cutoff.isoformat()}")
+        return deleted
+
+class ChangeFeedService:
+    """前回取得したリビジョン以降のデバイス・スケジュールの変更を返す（差分同期用）"""
+    def __init__(self, change_repository: ChangeLogRepository, device_repository: DeviceRepository, schedule_repository: ScheduleRepository, gpio_controller: GPIOController):
+        self.change_repository = change_repository
+        self.device_repository = device_repository
+        self.schedule_repository = schedule_repository
+        self.gpio_controller = gpio_controller
+    
+    def get_changes(self, since: int = 0, limit: Optional[int] = None) -> ChangesResponse:
+        limit = limit or DEFAULT_PAGE_LIMIT
+        # 保持期間を過ぎて削除されたトゥームストーンより前のリビジョンからは、削除を取りこぼすため全件の再取得を促す
+        pruned_revision = self.change_repository.find_pruned_revision()
+        if 0 < since < pruned_revision:
+            raise HTTPException(status_code=410, detail="Revision has been pruned; resync required")
+        # 変更履歴はエンティティごとに最新の1行だけを保持しているため、同じエンティティが重複することはない
+        changes = self.change_repository.find_since(since, limit + 1)
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+        
+        if not changes:
+            # 別のDBのリビジョンなど、存在しないリビジョンから取得しようとした場合は全件の再取得を促す
+            if since > max(self.change_repository.find_latest_revision(), pruned_revision):
+                raise HTTPException(status_code=410, detail="Revision is ahead of the server; resync required")
+            return ChangesResponse(changes=[], revision=max(since, pruned_revision), has_more=False)
+        
+        # 変更があったエンティティの現在の値をまとめて取得する
+        device_ids = [c.entity_id for c in changes if c.entity_type == CHANGE_ENTITY_DEVICE and not c.deleted]
+        schedule_ids = [c.entity_id for c in changes if c.entity_type == CHANGE_ENTITY_SCHEDULE and not c.deleted]
+        devices = {d.device_id: d for d in self.device_repository.find_by_ids(device_ids)} if device_ids else {}
+        schedules = {s.schedule_id: s for s in self.schedule_repository.find_by_ids(schedule_ids)} if schedule_ids else {}
+        
+        return ChangesResponse(
+            changes=[self._to_change_model(change, devices, schedules) for change in changes],
+            # 最後のページでは、削除済みのトゥームストーンのリビジョンまで同期済みとして返す（次回の取得が410にならないように）
+            revision=changes[-1].revision if has_more else max(changes[-1].revision, pruned_revision),
+            has_more=has_more
+        )
+    
+    def _to_change_model(self, change: ChangeLog, devices: dict, schedules: dict) -> ChangeModel:
+        device = devices.get(change.entity_id) if change.entity_type == CHANGE_ENTITY_DEVICE else None
+        schedule = schedules.get(change.entity_id) if change.entity_type == CHANGE_ENTITY_SCHEDULE else None
+        # 変更履歴の読み込み後に削除されたエンティティは削除として返す（削除の変更は後続のリビジョンで届く）
+        deleted = change.deleted or (device is None and schedule is None)
+        return ChangeModel(
+            revision=change.revision,
+            entity_type=change.entity_type,
+            entity_id=change.entity_id,
+            deleted=deleted,
+            device=DeviceModel(
+                device_id=device.device_id,
+                device_name=device.device_name,
+                gpio_number=device.gpio_number,
+                is_on=self.gpio_controller.get_status(device.gpio_number),
+                created_at=device.created_at,
+                updated_at=device.updated_at,
+                version=device.version
+            ) if device is not None else None,
+            schedule=ScheduleChangeModel(
+                schedule_id=schedule.schedule_id,
+                device_id=schedule.device_id,
+                schedule=schedule.schedule,
+                is_on=schedule.is_on,
+                version=schedule.version
+            ) if schedule is not None else None
+        )
 
+# DBのスケジュールとの差分を定期的に反映するジョブのID
+RESYNC_JOB_ID = "schedule-resync"
+RESYNC_NOW_JOB_ID = "schedule-resync-now"
+# スケジュールを実行するスレッドプールのスレッド数（APSchedulerの既定値と同じ）
+SCHEDULER_MAX_WORKERS = 10
 
 class ScheduleExecutorService:
-    def __init__(self, device_repository: DeviceRepository, gpio_controller: GPIOController):
+    def __init__(
+        self,
+        device_repository: Optional[DeviceRepository],
+        gpio_controller: GPIOController,
+        state_recorder: Optional[StateEventRecorder] = None,
+        repository_factory: Optional[Callable[[], ContextManager[DeviceRepository]]] = None,
+        clock: Optional[Clock] = None
+    ):
         self.device_repository = device_repository
         self.gpio_controller = gpio_controller
-        self.scheduler = BackgroundScheduler(timezone=pytz.timezone('Asia/Tokyo'))
+        self.state_recorder = state_recorder
+        # ジョブ実行ごとに短命なセッションのリポジトリを払い出すファクトリ
+        # （スケジューラーのワーカースレッド間でセッションを共有しないため）
+        self.repository_factory = repository_factory
+        # 現在時刻とスケジュールのタイムゾーン（シミュレーションでは仮想時間の時計を渡す）
+        self.clock = clock or SystemClock()
+        self.scheduler = BackgroundScheduler(
+            timezone=self.clock.timezone, executors={"default": ThreadPoolExecutor(SCHEDULER_MAX_WORKERS)}
+        )
+        # 実行の遅延・実行時間・取りこぼしをスケジューラーのイベントから集計する
+        self.metrics = SchedulerMetrics(SCHEDULER_MAX_WORKERS)
+        install_scheduler_instrumentation(self.scheduler, self.metrics)
+        # schedule_id -> (バージョン, GPIO番号)（DBのスケジュールとの差分の検出用）
+        self.registered: Dict[str, Tuple[Optional[int], int]] = {}
+        # 登録・削除のたびに増やす（差分の反映中の読み込みと、並行する登録・削除の競合の検出用）
+        self._generation = 0
+        # registered・_generationの更新と差分の反映を直列化する（差分の反映中に登録・削除を挟まないため、再入可能）
+        self._lock = threading.RLock()
+        # resyncでDBのスケジュールを読み込む関数（start_resyncで設定する）
+        self._resync_loader: Optional[Callable[[], Iterable[ScheduleLoadRow]]] = None
     
     def start(self) -> None:
         """スケジューラーを開始"""
@@ -298,65 +1399,334 @@ class ScheduleExecutorService:
             self.scheduler.start()
             logger.info("Schedule executor started")
     
-    def add_schedule(self, schedule_id: str, device_id: str, schedule_time: str, is_on: bool) -> None:
+    def get_metrics(self) -> dict:
+        """スケジューラーの状態と、実行の遅延・実行時間・取りこぼし・スレッドプールの集計を返す"""
+        return {"running": self.scheduler.running, "jobs": len(self.scheduler.get_jobs()), **self.metrics.snapshot()}
+    
+    def _device_repository_scope(self) -> ContextManager[DeviceRepository]:
+        """呼び出し元のスレッド専用のDeviceRepositoryを取得する"""
+        if self.repository_factory is not None:
+            return self.repository_factory()
+        return nullcontext(self.device_repository)
+    
+    def _find_device(self, device_id: str) -> Tuple[str, int]:
+        """スケジュール対象のデバイスの名前とGPIO番号を取得する（存在しない場合はValueError）"""
+        with self._device_repository_scope() as device_repository:
+            device = device_repository.find_by_id(device_id)
+            if not device:
+                raise ValueError("Device not found")
+            return device.device_name, device.gpio_number
+    
+    def add_schedule(self, schedule_id: str, device_id: str, schedule_time: str, is_on: bool, version: Optional[int] = None) -> None:
         """スケジュールを追加"""
         # デバイスの存在確認
-        device = self.device_repository.find_by_id(device_id)
-        if not device:
-            raise ValueError("Device not found")
+        device_name, gpio_number = self._find_device(device_id)
         
         # 時刻形式の検証とパース
         hour, minute = self._parse_time(schedule_time)
         
-        # 毎日実行するスケジュールを追加
-        trigger = CronTrigger(hour=hour, minute=minute, timezone=pytz.timezone('Asia/Tokyo'))
+        self._register(schedule_id, device_id, gpio_number, hour, minute, is_on, version)
+        
+        logger.info(f"Schedule added: {schedule_id}, device: {device_name}, "
+                   f"time: {schedule_time}, action: {'ON' if is_on else 'OFF'}")
+    
+    def update_schedule(self, schedule_id: str, device_id: str, schedule_time: str, is_on: bool, version: Optional[int] = None) -> None:
+        """登録済みのスケジュールをその場で置き換える（削除と追加を行わない。未登録の場合は追加する）"""
+        device_name, gpio_number = self._find_device(device_id)
+        hour, minute = self._parse_time(schedule_time)
+        
+        self._register(schedule_id, device_id, gpio_number, hour, minute, is_on, version)
+        
+        logger.info(f"Schedule updated: {schedule_id}, device: {device_name}, "
+                   f"time: {schedule_time}, action: {'ON' if is_on else 'OFF'}")
+    
+    def add_schedules(self, rows: Iterable[ScheduleLoadRow]) -> Tuple[int, int]:
+        """デバイスと結合済みのスケジュールをまとめて追加し、(追加数, 失敗数) を返す
+        
+        デバイスの再検索とスケジュールごとのログを行わないため、起動時の一括読み込みに使う。
+        """
+        added = failed = 0
+        for row in rows:
+            try:
+                hour, minute = self._parse_time(row.schedule)
+            except ValueError as e:
+                logger.warning(f"Failed to load schedule {row.schedule_id}: {e}")
+                failed += 1
+                continue
+            self._register(row.schedule_id, row.device_id, row.gpio_number, hour, minute, row.is_on, row.version)
+            added += 1
+        logger.info(f"Schedules loaded: added={added}, failed={failed}")
+        return added, failed
+    
+    def resync(self, loader: Callable[[], Iterable[ScheduleLoadRow]]) -> Optional[Tuple[int, int, int]]:
+        """DBのスケジュールと登録済みのスケジュールをIDとバージョンで比較し、差分だけを反映する
         
+        追加・バージョン（またはデバイスのGPIO番号）が変わったものの置き換え・DBにないものの削除を行い、
+        (追加数, 置き換え数, 削除数) を返す。読み込み中にAPIからの登録・削除があった場合は、
+        読み込んだ行が古い可能性があるため反映せずNoneを返す（次回に持ち越す）。
+        """
+        with self._lock:
+            generation = self._generation
+        rows = loader()
+        with self._lock:
+            if generation != self._generation:
+                logger.info("Schedule resync skipped: schedules changed while loading")
+                return None
+            
+            added = updated = 0
+            seen = set()
+            for row in rows:
+                seen.add(row.schedule_id)
+                current = self.registered.get(row.schedule_id)
+                if current == (row.version, row.gpio_number):
+                    continue
+                try:
+                    hour, minute = self._parse_time(row.schedule)
+                except ValueError:
+                    continue
+                self._register(row.schedule_id, row.device_id, row.gpio_number, hour, minute, row.is_on, row.version)
+                if current is None:
+                    added += 1
+                else:
+                    updated += 1
+            
+            removed = 0
+            for schedule_id in self.registered.keys() - seen:
+                try:
+                    self.remove_schedule(schedule_id)
+                    removed += 1
+                except ValueError:
+                    pass
+        if added or updated or removed:
+            logger.info(f"Schedules resynced: added={added}, updated={updated}, removed={removed}")
+        return added, updated, removed
+    
+    def start_resync(self, loader: Callable[[], Iterable[ScheduleLoadRow]], interval_seconds: int) -> None:
+        """interval_secondsごとにresyncを実行するジョブを登録する（0の場合は定期実行せず、request_resyncでだけ実行する）"""
+        self._resync_loader = loader
+        if not interval_seconds:
+            return
         self.scheduler.add_job(
-            func=self._execute_schedule,
-            trigger=trigger,
-            id=schedule_id,
-            args=[device_id, device.gpio_number, is_on],
+            func=self._resync_job,
+            trigger=IntervalTrigger(seconds=interval_seconds, timezone=self.clock.timezone),
+            args=[loader],
+            id=RESYNC_JOB_ID,
+            replace_existing=True,
+            max_instances=1,
+            coalesce=True
+        )
+    
+    def request_resync(self) -> bool:
+        """他のワーカーから転送できなかった変更を取り込むため、resyncをすぐに1回実行する（loaderがなければFalse）"""
+        if self._resync_loader is None:
+            return False
+        # トリガーなしのジョブはすぐに1回実行される（同じIDの要求は1つにまとめる）
+        self.scheduler.add_job(
+            func=self._resync_job,
+            args=[self._resync_loader],
+            id=RESYNC_NOW_JOB_ID,
             replace_existing=True
         )
+        return True
+    
+    def _resync_job(self, loader: Callable[[], Iterable[ScheduleLoadRow]]) -> None:
+        try:
+            self.resync(loader)
+        except Exception as e:
+            logger.warning(f"Schedule resync failed: {e}")
+    
+    def start_maintenance(self, job_id: str, func: Callable[[], Any], interval_seconds: int) -> None:
+        """リーダーのワーカーだけで行う保守処理（変更履歴の削除など）をinterval_secondsごとに実行するジョブを登録する"""
+        self.scheduler.add_job(
+            func=self._maintenance_job,
+            trigger=IntervalTrigger(seconds=interval_seconds, timezone=self.clock.timezone),
+            args=[job_id, func],
+            id=job_id,
+            replace_existing=True,
+            max_instances=1,
+            coalesce=True
+        )
+    
+    def _maintenance_job(self, job_id: str, func: Callable[[], Any]) -> None:
+        try:
+            func()
+        except Exception as e:
+            logger.warning(f"Maintenance job failed: job_id={job_id}, error={e}")
+    
+    def reconcile_states(
+        self,
+        rows: Iterable[ScheduleLoadRow],
+        now: Optional[datetime] = None,
+        policy: str = MISFIRE_POLICY_LATEST,
+        grace_minutes: Optional[int] = None
+    ) -> List[ScheduleOutcome]:
+        """起動時に、デバイスごとの直近のスケジュールの状態を1回のGPIO操作でまとめて反映する
         
-        logger.info(f"Schedule added: {schedule_id}, device: {device.device_name}, "
-                   f"time: {schedule_time}, action: {'ON' if is_on else 'OFF'}")
+        読み込んだスケジュールを1回走査し、現在時刻以前で最も新しいもの（同じ時刻の場合はschedule_idが大きいもの）を
+        デバイスごとに選ぶ。grace_minutesを指定した場合、それより前のスケジュールは反映しない。
+        """
+        if policy == MISFIRE_POLICY_SKIP:
+            return []
+        if policy != MISFIRE_POLICY_LATEST:
+            raise ValueError(f"Unknown misfire policy: {policy}")
+        now = now or self.clock.now()
+        current = now.hour * 60 + now.minute
+        
+        # device_id -> (経過分, スケジュール)
+        latest: Dict[str, Tuple[int, ScheduleLoadRow]] = {}
+        for row in rows:
+            try:
+                hour, minute = self._parse_time(row.schedule)
+            except ValueError:
+                continue
+            elapsed = (current - (hour * 60 + minute)) % MINUTES_PER_DAY
+            if grace_minutes is not None and elapsed > grace_minutes:
+                continue
+            previous = latest.get(row.device_id)
+            if previous is None or (elapsed, previous[1].schedule_id) < (previous[0], row.schedule_id):
+                latest[row.device_id] = (elapsed, row)
+        
+        entries = [(row.schedule_id, row.device_id, row.gpio_number, row.is_on) for _, row in latest.values()]
+        return self._execute_schedules(entries, "reconcile")
+    
+    def _register(self, schedule_id: str, device_id: str, gpio_number: int, hour: int, minute: int, is_on: bool, version: Optional[int] = None) -> None:
+        """毎日hour:minuteに実行するスケジュールを登録する（同じIDのジョブはその場で置き換える）"""
+        trigger = CronTrigger(hour=hour, minute=minute, timezone=self.clock.timezone)
+        
+        with self._lock:
+            if self._is_stale(schedule_id, version):
+                return
+            self.scheduler.add_job(
+                func=self._execute_schedule,
+                trigger=trigger,
+                id=schedule_id,
+                args=[device_id, gpio_number, is_on],
+                replace_existing=True
+            )
+            self.registered[schedule_id] = (version, gpio_number)
+            self._generation += 1
+    
+    def _is_stale(self, schedule_id: str, version: Optional[int]) -> bool:
+        """登録済みのものより古いバージョンか（並行する更新の登録が前後した場合に、古い内容で上書きしないため。_lockを保持して呼ぶこと）"""
+        current = self.registered.get(schedule_id)
+        return current is not None and current[0] is not None and version is not None and version < current[0]
     
     def remove_schedule(self, schedule_id: str) -> None:
         """スケジュールを削除"""
-        try:
-            self.scheduler.remove_job(schedule_id)
-            logger.info(f"Schedule removed: {schedule_id}")
-        except Exception:
-            raise ValueError("Schedule not found")
+        with self._lock:
+            try:
+                self.scheduler.remove_job(schedule_id)
+                logger.info(f"Schedule removed: {schedule_id}")
+            except Exception:
+                raise ValueError("Schedule not found")
+            finally:
+                self.registered.pop(schedule_id, None)
+                self._generation += 1
+    
+    def remove_device_schedules(self, device_ids: Iterable[str]) -> int:
+        """指定したデバイスのスケジュールのジョブを、ジョブ一覧の1回の走査でまとめて削除する"""
+        targets = set(device_ids)
+        removed = 0
+        with self._lock:
+            for job in self.scheduler.get_jobs():
+                # ジョブの引数は (device_id, gpio_number, is_on)
+                if job.args and job.args[0] in targets:
+                    job.remove()
+                    self.registered.pop(job.id, None)
+                    removed += 1
+            self._generation += 1
+        if removed:
+            logger.info(f"Removed {removed} schedules of {len(targets)} deleted devices")
+        return removed
     
     def _execute_schedule(self, device_id: str, gpio_number: int, is_on: bool) -> None:
         """スケジュール実行"""
+        # デバイス情報を取得（ログ用、失敗時のログでも使い回す）
+        try:
+            with self._device_repository_scope() as device_repository:
+                device = device_repository.find_by_id(device_id)
+                device_name = device.device_name if device else "Unknown"
+        except Exception:
+            device_name = "Unknown"
+        
         try:
-            # デバイス情報を取得（ログ用）
-            device = self.device_repository.find_by_id(device_id)
-            device_name = device.device_name if device else "Unknown"
-            
             # GPIO制御実行
             if is_on:
                 self.gpio_controller.turn_on(gpio_number)
             else:
                 self.gpio_controller.turn_off(gpio_number)
             
+            if self.state_recorder:
+                self.state_recorder.record(device_id, gpio_number, is_on, STATE_SOURCE_SCHEDULE)
+            
             # 実行ログ
-            current_time = datetime.now(pytz.timezone('Asia/Tokyo')).strftime('%Y-%m-%d %H:%M:%S JST')
+            current_time = self.clock.now().strftime('%Y-%m-%d %H:%M:%S %Z')
             logger.info(f"Schedule executed: device={device_name}, gpio={gpio_number}, "
                        f"action={'ON' if is_on else 'OFF'}, time={current_time}")
             
         except Exception as e:
             # エラーログ（WARNING レベル）
-            device = self.device_repository.find_by_id(device_id)
-            device_name = device.device_name if device else "Unknown"
-            current_time = datetime.now(pytz.timezone('Asia/Tokyo')).strftime('%Y-%m-%d %H:%M:%S JST')
+            current_time = self.clock.now().strftime('%Y-%m-%d %H:%M:%S %Z')
             
             logger.warning(f"GPIO control failed: device={device_name}, gpio={gpio_number}, "
                           f"action={'ON' if is_on else 'OFF'}, time={current_time}, error={str(e)}")
     
+    def _execute_schedules(self, entries: List[Tuple[str, str, int, bool]], label: str) -> List[ScheduleOutcome]:
+        """同じ時刻に実行するスケジュール（schedule_id, device_id, gpio_number, is_on）をまとめて実行する
+        
+        ピンごとの最終的な状態（同じピンに複数ある場合はschedule_idが大きい＝後に作成されたスケジュール）を
+        1回のGPIO操作で反映し、デバイス名は1回の検索でまとめて取得して、1行の集計ログとスケジュールごとの結果を返す。
+        """
+        if not entries:
+            return []
+        # 登録順（再起動・resyncで変わる）に依存せず、同じピンで採用されるスケジュールを決める
+        entries = sorted(entries, key=lambda entry: entry[0])
+        winners: Dict[int, int] = {}
+        for i, (_, _, gpio_number, _) in enumerate(entries):
+            winners[gpio_number] = i
+        states = {gpio_number: entries[i][3] for gpio_number, i in winners.items()}
+        
+        try:
+            with self._device_repository_scope() as device_repository:
+                device_names = {
+                    device.device_id: device.device_name
+                    for device in device_repository.find_by_ids({entry[1] for entry in entries})
+                }
+        except Exception as e:
+            # デバイス名はログ用のため、取得できなくてもスケジュールは実行する
+            logger.warning(f"Failed to load device names for schedules: slot={label}, error={str(e)}")
+            device_names = {}
+        
+        error = None
+        try:
+            self.gpio_controller.apply_states(states)
+        except Exception as e:
+            error = str(e)
+        
+        outcomes = []
+        for i, (schedule_id, device_id, gpio_number, is_on) in enumerate(entries):
+            if winners[gpio_number] != i:
+                outcome = SCHEDULE_OUTCOME_SUPERSEDED
+            elif error is not None:
+                outcome = SCHEDULE_OUTCOME_FAILED
+            else:
+                outcome = SCHEDULE_OUTCOME_APPLIED
+                if self.state_recorder:
+                    self.state_recorder.record(device_id, gpio_number, is_on, STATE_SOURCE_SCHEDULE)
+            outcomes.append(ScheduleOutcome(schedule_id, device_id, gpio_number, is_on, outcome, error))
+            logger.debug(f"Schedule {outcome}: {schedule_id}, device={device_names.get(device_id, 'Unknown')}, "
+                         f"gpio={gpio_number}, action={'ON' if is_on else 'OFF'}")
+        
+        turned_on = sum(1 for is_on in states.values() if is_on)
+        current_time = self.clock.now().strftime('%Y-%m-%d %H:%M:%S %Z')
+        summary = (f"schedules={len(entries)}, pins={len(states)}, on={turned_on}, off={len(states) - turned_on}, "
+                   f"superseded={len(entries) - len(states)}, slot={label}, time={current_time}")
+        if error is None:
+            logger.info(f"Schedules executed: {summary}")
+        else:
+            logger.warning(f"GPIO control failed: {summary}, error={error}")
+        return outcomes
+    
     def _parse_time(self, time_str: str) -> tuple[int, int]:
         """時刻文字列をパースして時と分を返す"""
         if not time_str:
@@ -372,4 +1742,132 @@ class ScheduleExecutorService:
         hour = int(match.group(1))
         minute = int(match.group(2))
         
-        return hour, minute
\ No newline at end of file
+        return hour, minute
+
+
+# タイミングホイールの1日の分数（スロット数）
+MINUTES_PER_DAY = 24 * 60
+# ティックが遅れた場合に、取りこぼした分を遡って実行する上限（それより前の分は警告を出して実行しない）
+MAX_CATCH_UP_MINUTES = 5
+WHEEL_TICK_JOB_ID = "timing-wheel-tick"
+
+class TimingWheelScheduleExecutorService(ScheduleExecutorService):
+    """1日の分（0〜1439）を添字とする1,440スロットのタイミングホイールでスケジュールを実行する
+
+    スケジュールはすべて毎日のHH:MMのため、スケジュールごとにAPSchedulerのジョブ（CronTrigger）を
+    作らず、スロットの辞書に登録する。追加・削除はO(1)で、スケジューラーのジョブは毎分0秒の
+    ティック1つだけになり、ティックごとにその分のスロットのスケジュールをまとめて実行する。
+    """
+    
+    def __init__(
+        self,
+        device_repository: Optional[DeviceRepository],
+        gpio_controller: GPIOController,
+        state_recorder: Optional[StateEventRecorder] = None,
+        repository_factory: Optional[Callable[[], ContextManager[DeviceRepository]]] = None,
+        clock: Optional[Clock] = None
+    ):
+        super().__init__(device_repository, gpio_controller, state_recorder, repository_factory, clock)
+        # スロット: schedule_id -> (device_id, gpio_number, is_on)
+        self.wheel: List[Dict[str, Tuple[str, int, bool]]] = [{} for _ in range(MINUTES_PER_DAY)]
+        # schedule_id -> スロットの添字（削除時にスロットを引くため）
+        self.slot_of: Dict[str, int] = {}
+        # device_id -> schedule_id（デバイス削除時にまとめて外すため）
+        self.device_schedules: Dict[str, Dict[str, None]] = defaultdict(dict)
+        # 前回のティックの時刻（分単位に切り捨て。日付をまたぐ遅れと時刻の巻き戻りを区別するため日時で持つ）
+        self._last_tick: Optional[datetime] = None
+    
+    def start(self) -> None:
+        """毎分0秒のティックを登録してスケジューラーを開始"""
+        if self.scheduler.get_job(WHEEL_TICK_JOB_ID) is None:
+            self.scheduler.add_job(
+                func=self._tick,
+                trigger=CronTrigger(second=0, timezone=self.clock.timezone),
+                id=WHEEL_TICK_JOB_ID,
+                max_instances=1,
+                coalesce=True,
+                misfire_grace_time=30
+            )
+        super().start()
+    
+    def _register(self, schedule_id: str, device_id: str, gpio_number: int, hour: int, minute: int, is_on: bool, version: Optional[int] = None) -> None:
+        """スロットにスケジュールを登録する（同じIDのスケジュールは置き換える）"""
+        with self._lock:
+            if self._is_stale(schedule_id, version):
+                return
+            self._discard(schedule_id)
+            slot = hour * 60 + minute
+            self.wheel[slot][schedule_id] = (device_id, gpio_number, is_on)
+            self.slot_of[schedule_id] = slot
+            self.device_schedules[device_id][schedule_id] = None
+            self.registered[schedule_id] = (version, gpio_number)
+            self._generation += 1
+    
+    def remove_schedule(self, schedule_id: str) -> None:
+        """スケジュールを削除"""
+        with self._lock:
+            if not self._discard(schedule_id):
+                raise ValueError("Schedule not found")
+        logger.info(f"Schedule removed: {schedule_id}")
+    
+    def remove_device_schedules(self, device_ids: Iterable[str]) -> int:
+        """指定したデバイスのスケジュールを、デバイスごとの索引からまとめて削除する"""
+        targets = set(device_ids)
+        removed = 0
+        with self._lock:
+            for device_id in targets:
+                for schedule_id in list(self.device_schedules.get(device_id, ())):
+                    removed += self._discard(schedule_id)
+        if removed:
+            logger.info(f"Removed {removed} schedules of {len(targets)} deleted devices")
+        return removed
+    
+    def _discard(self, schedule_id: str) -> bool:
+        """スロットと索引からスケジュールを外す（self._lockを保持して呼ぶこと）"""
+        slot = self.slot_of.pop(schedule_id, None)
+        if slot is None:
+            return False
+        self.registered.pop(schedule_id, None)
+        self._generation += 1
+        device_id, _, _ = self.wheel[slot].pop(schedule_id)
+        schedules = self.device_schedules[device_id]
+        del schedules[schedule_id]
+        if not schedules:
+            del self.device_schedules[device_id]
+        return True
+    
+    def schedule_count(self) -> int:
+        """登録されているスケジュール数"""
+        return len(self.slot_of)
+    
+    def _tick(self) -> List[ScheduleOutcome]:
+        """現在の分のスロットを実行する（前回のティックから飛んだ分は上限まで遡って実行する）"""
+        now = self.clock.now().replace(second=0, microsecond=0)
+        last, self._last_tick = self._last_tick, now
+        if last is None:
+            return self.dispatch(now.hour * 60 + now.minute)
+        missed = int((now - last).total_seconds() // 60)
+        if missed == 0:
+            return []
+        if missed < 0:
+            # 時刻の変更とみなし、遡って実行せずに次のティックから新しい時刻で進める（1日近い遅れとして扱わない）
+            logger.warning(f"Clock moved backward: from={last.isoformat()}, to={now.isoformat()}")
+            return []
+        if missed > MAX_CATCH_UP_MINUTES:
+            skipped_until = now - timedelta(minutes=MAX_CATCH_UP_MINUTES)
+            logger.warning(
+                f"Timing wheel fell behind by {missed} minutes: skipped window "
+                f"{(last + timedelta(minutes=1)).strftime('%Y-%m-%d %H:%M')} - {skipped_until.strftime('%Y-%m-%d %H:%M')}"
+            )
+            missed = MAX_CATCH_UP_MINUTES
+        outcomes = []
+        for offset in range(missed - 1, -1, -1):
+            slot_time = now - timedelta(minutes=offset)
+            outcomes.extend(self.dispatch(slot_time.hour * 60 + slot_time.minute))
+        return outcomes
+    
+    def dispatch(self, slot: int) -> List[ScheduleOutcome]:
+        """スロットのスケジュールを1回のGPIO操作でまとめて実行し、スケジュールごとの結果を返す"""
+        with self._lock:
+            entries = [(schedule_id, *entry) for schedule_id, entry in self.wheel[slot].items()]
+        return self._execute_schedules(entries, f"{slot // 60:02d}:{slot % 60:02d}")
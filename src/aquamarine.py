@@ -1,54 +1,131 @@
 #!/usr/bin/env python3
 """Console script for aquamarine."""
 
+import logging
+import os
+import time
+from typing import List, Optional, Tuple
 import uvicorn
-from infrastructure.database import create_tables, get_db
-from infrastructure.repositories import SQLAlchemyDeviceRepository, SQLAlchemyScheduleRepository
-from application.services import ScheduleExecutorService
-from hardware.gpio_factory import create_gpio_controller
+from infrastructure.database import create_tables
+from infrastructure.repository_factory import (
+    REPOSITORY_BACKEND_MEMORY, create_device_repository_scope, create_unit_of_work_scope, get_repository_backend
+)
+from application.repositories import ScheduleLoadRow
+from application.services import (
+    MISFIRE_POLICY_LATEST, MISFIRE_POLICY_SKIP,
+    ChangeLogPruner, ScheduleExecutorService, StateEventRecorder, TimingWheelScheduleExecutorService
+)
+from hardware.gpio_controller import GPIOController
 
-# グローバル変数として定義
-schedule_executor = None
+logger = logging.getLogger(__name__)
+
+SCHEDULE_ENGINE_CRON = "cron"
+SCHEDULE_ENGINE_WHEEL = "wheel"
+CHANGE_LOG_PRUNE_JOB_ID = "change-log-prune"
+CHANGE_LOG_PRUNE_INTERVAL = 3600
+
+def get_misfire_settings() -> Tuple[str, Optional[int]]:
+    """環境変数から停止中に実行されなかったスケジュールの扱いと、反映する経過時間の上限（分）を取得する"""
+    policy = os.getenv("SCHEDULE_MISFIRE_POLICY", MISFIRE_POLICY_LATEST).lower()
+    if policy not in (MISFIRE_POLICY_LATEST, MISFIRE_POLICY_SKIP):
+        raise ValueError(f"Unknown SCHEDULE_MISFIRE_POLICY: {policy}")
+    grace_minutes = os.getenv("SCHEDULE_MISFIRE_GRACE_MINUTES")
+    return policy, int(grace_minutes) if grace_minutes else None
+
+def get_schedule_engine() -> str:
+    """環境変数SCHEDULE_ENGINEからスケジュールの実行方式を取得する
+
+    既定は同じ分に実行されるスケジュールをまとめて反映するwheel（cronはスケジュールごとに1回ずつ反映する）。
+    """
+    engine = os.getenv("SCHEDULE_ENGINE", SCHEDULE_ENGINE_WHEEL).lower()
+    if engine not in (SCHEDULE_ENGINE_CRON, SCHEDULE_ENGINE_WHEEL):
+        raise ValueError(f"Unknown SCHEDULE_ENGINE: {engine}")
+    return engine
+
+def get_resync_interval() -> int:
+    """環境変数SCHEDULE_RESYNC_INTERVALから、DBとの差分を反映する間隔（秒、0で無効）を取得する"""
+    interval = int(os.getenv("SCHEDULE_RESYNC_INTERVAL", "300"))
+    if interval < 0:
+        raise ValueError(f"Invalid SCHEDULE_RESYNC_INTERVAL: {interval}")
+    return interval
+
+def get_tombstone_retention_days() -> int:
+    """環境変数CHANGE_LOG_TOMBSTONE_RETENTION_DAYSから、削除されたエンティティの変更履歴を残す日数（0で削除しない）を取得する"""
+    days = int(os.getenv("CHANGE_LOG_TOMBSTONE_RETENTION_DAYS", "30"))
+    if days < 0:
+        raise ValueError(f"Invalid CHANGE_LOG_TOMBSTONE_RETENTION_DAYS: {days}")
+    return days
+
+def get_api_workers() -> int:
+    """環境変数API_WORKERSからAPIのワーカープロセス数を取得する"""
+    workers = int(os.getenv("API_WORKERS", "1"))
+    if workers < 1:
+        raise ValueError(f"Invalid API_WORKERS: {workers}")
+    # インメモリのストアはプロセスごとに別になるため、複数のワーカーでは使えない
+    if workers > 1 and get_repository_backend() == REPOSITORY_BACKEND_MEMORY:
+        raise ValueError("API_WORKERS must be 1 with REPOSITORY_BACKEND=memory")
+    return workers
+
+def load_schedules() -> List[ScheduleLoadRow]:
+    """全スケジュールをデバイスと結合した1回の問い合わせで読み込む"""
+    with create_unit_of_work_scope()() as unit_of_work:
+        return unit_of_work.schedules.find_all_with_devices()
+
+def create_schedule_executor(gpio_controller: GPIOController, state_recorder: StateEventRecorder) -> ScheduleExecutorService:
+    """スケジューラーのリーダーに選ばれたワーカーで、既存スケジュールを読み込んだ実行サービスを作って開始する"""
+    # ジョブはスケジューラーのワーカースレッドで並行に動くため、実行ごとに専用のセッションを使う
+    executor_class = (
+        TimingWheelScheduleExecutorService if get_schedule_engine() == SCHEDULE_ENGINE_WHEEL else ScheduleExecutorService
+    )
+    schedule_executor = executor_class(
+        None, gpio_controller, state_recorder,
+        repository_factory=create_device_repository_scope()
+    )
+    # 既存スケジュールをデバイスと結合した1回の問い合わせで読み込み、まとめてスケジューラーに追加する
+    # （開始前に追加しておき、追加のたびにスケジューラーのスレッドを起こさない）
+    started_at = time.perf_counter()
+    rows = load_schedules()
+    queried_at = time.perf_counter()
+    added, failed = schedule_executor.add_schedules(rows)
+    # 停止中に実行されなかったスケジュールの状態をピンに反映してから開始する
+    policy, grace_minutes = get_misfire_settings()
+    reconciled = schedule_executor.reconcile_states(rows, policy=policy, grace_minutes=grace_minutes)
+    # 他のノードやDBへの直接の変更を、再起動せずに差分だけ定期的に反映する
+    # （間隔が0でも、他のワーカーから転送できなかった変更の取り込みの要求では実行する）
+    schedule_executor.start_resync(load_schedules, get_resync_interval())
+    # 変更履歴のトゥームストーンの削除は、ワーカーごとに重複しないようリーダーだけで行う
+    retention_days = get_tombstone_retention_days()
+    if retention_days:
+        pruner = ChangeLogPruner(create_unit_of_work_scope(), retention_days)
+        schedule_executor.start_maintenance(CHANGE_LOG_PRUNE_JOB_ID, pruner.prune, CHANGE_LOG_PRUNE_INTERVAL)
+    schedule_executor.start()
+    finished_at = time.perf_counter()
+    logger.info(f"Loaded {added} schedules ({failed} failed) in {(finished_at - started_at) * 1000:.1f}ms "
+                f"(query {(queried_at - started_at) * 1000:.1f}ms, register {(finished_at - queried_at) * 1000:.1f}ms), "
+                f"reconciled {len(reconciled)} devices")
+    return schedule_executor
 
 def main():
     """アプリケーションのエントリーポイント"""
-    global schedule_executor
-    
     # データベーステーブルを作成
     create_tables()
     
-    # ScheduleExecutorServiceの初期化
-    gpio_controller = create_gpio_controller()
-    db = next(get_db())
-    device_repository = SQLAlchemyDeviceRepository(db)
-    
-    schedule_executor = ScheduleExecutorService(device_repository, gpio_controller)
-    schedule_executor.start()
-    
-    # 既存スケジュールを読み込んでスケジューラーに追加
-    schedule_repository = SQLAlchemyScheduleRepository(db)
-    existing_schedules = schedule_repository.find_all()
-    
-    for schedule in existing_schedules:
-        try:
-            schedule_executor.add_schedule(
-                schedule.schedule_id,
-                schedule.device_id,
-                schedule.schedule,
-                schedule.is_on
-            )
-        except Exception as e:
-            print(f"Warning: Failed to load schedule {schedule.schedule_id}: {str(e)}")
+    # スケジュールの実行サービスはAPIのワーカーの起動時にリーダー選出で1つのワーカーだけが動かす
+    # （presentation.apiのlifespan）。ワーカーを増やしてもスケジュールは1回だけ実行される
+    workers = get_api_workers()
     
     # FastAPIアプリケーションを起動
     uvicorn.run(
         "presentation.api:app",
         host="0.0.0.0",
         port=8080,
-        reload=True,
+        workers=workers,
+        # インメモリのストアは1プロセスで保持する必要があるため、リロード用の子プロセスを使わない
+        # （リロードは複数のワーカーと併用できない）
+        reload=workers == 1 and get_repository_backend() != REPOSITORY_BACKEND_MEMORY,
         log_level="debug",
         access_log=True,
     )
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,5 +1,6 @@
 import os
 from abc import ABC, abstractmethod
+from typing import Dict
 from log import logger
 
 class GPIOController(ABC):
@@ -18,6 +19,14 @@ class GPIOController(ABC):
     @abstractmethod
     def get_status(self, pin_number: int) -> bool:
         pass
+    
+    def apply_states(self, states: Dict[int, bool]) -> None:
+        """複数のピンの状態をまとめて設定する（{ピン番号: ON/OFF}）"""
+        for pin_number, is_on in states.items():
+            if is_on:
+                self.turn_on(pin_number)
+            else:
+                self.turn_off(pin_number)
 
 class RaspberryPiGPIOController(GPIOController):
     def __init__(self):
@@ -45,6 +54,16 @@ class RaspberryPiGPIOController(GPIOController):
         self._GPIO.output(pin_number, self._GPIO.LOW)
         self._pin_states[pin_number] = False
     
+    def apply_states(self, states: Dict[int, bool]) -> None:
+        for pin_number in states:
+            if pin_number not in self._pin_states:
+                self.setup_pin(pin_number)
+        
+        # GPIO.outputはチャンネルと値のリストを受け取り、1回の呼び出しで出力する
+        pins = list(states)
+        self._GPIO.output(pins, [self._GPIO.HIGH if states[pin] else self._GPIO.LOW for pin in pins])
+        self._pin_states.update(states)
+    
     def get_status(self, pin_number: int) -> bool:
         if pin_number not in self._pin_states:
             self.setup_pin(pin_number)
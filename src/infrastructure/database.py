@@ -1,7 +1,9 @@
 import os
-from sqlalchemy import create_engine
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
-from infrastructure.models import Base
+from infrastructure.models import Base, DEFAULT_SITE_ID
+from infrastructure.instrumentation import install_query_instrumentation
 
 # テスト環境の場合は、in-memoryデータベースを使用
 if os.getenv("ENVIRONMENT") == "test":
@@ -9,9 +11,23 @@ if os.getenv("ENVIRONMENT") == "test":
 else:
     DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./aquamarine.db")
 
+# このノードが担当するサイト（デバイス・スケジュールはサイトごとに分けて扱う）
+SITE_ID = os.getenv("SITE_ID", DEFAULT_SITE_ID)
+
 engine = create_engine(DATABASE_URL, echo=False, connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {})
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+        """SQLiteは接続ごとに外部キー制約（ON DELETE CASCADE）を有効にする必要がある"""
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# SQLの発行数・実行時間の計測（閾値を超えたクエリはWARNINGで出力）
+install_query_instrumentation(engine, float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "100")))
+
 def create_tables():
     Base.metadata.create_all(bind=engine)
 
@@ -19,5 +35,18 @@ def get_db():
     db = SessionLocal()
     try:
         yield db
+    finally:
+        db.close()
+
+@contextmanager
+def session_scope():
+    """リクエスト外（バックグラウンド処理など）で使う短命なセッションを提供する"""
+    db = SessionLocal()
+    try:
+        yield db
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
     finally:
         db.close()
\ No newline at end of file
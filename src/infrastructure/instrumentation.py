@@ -0,0 +1,269 @@
+import time
+import bisect
+import logging
+import threading
+from contextvars import ContextVar, Token
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from apscheduler.events import (
+    EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED, EVENT_JOB_REMOVED, EVENT_JOB_SUBMITTED
+)
+from apscheduler.schedulers.base import BaseScheduler
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+class QueryStats:
+    """1リクエスト内で発行されたSQLの集計"""
+    
+    def __init__(self):
+        self.query_count = 0
+        self.commit_count = 0
+        self.total_time = 0.0
+    
+    @property
+    def total_time_ms(self) -> float:
+        return self.total_time * 1000
+
+class QueryStatsRegistry:
+    """エンドポイント別のSQL発行数・DB時間の累計"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints: Dict[str, Dict[str, float]] = {}
+        self.slow_query_count = 0
+    
+    def record(self, endpoint: str, stats: QueryStats) -> None:
+        with self._lock:
+            totals = self._endpoints.setdefault(endpoint, {
+                "requests": 0,
+                "queries": 0,
+                "commits": 0,
+                "db_time_ms": 0.0,
+                "max_queries": 0,
+            })
+            totals["requests"] += 1
+            totals["queries"] += stats.query_count
+            totals["commits"] += stats.commit_count
+            totals["db_time_ms"] += stats.total_time_ms
+            totals["max_queries"] = max(totals["max_queries"], stats.query_count)
+    
+    def record_slow_query(self) -> None:
+        with self._lock:
+            self.slow_query_count += 1
+    
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            endpoints = {}
+            for endpoint, totals in self._endpoints.items():
+                endpoints[endpoint] = dict(totals)
+                endpoints[endpoint]["avg_queries"] = totals["queries"] / totals["requests"]
+                endpoints[endpoint]["avg_db_time_ms"] = totals["db_time_ms"] / totals["requests"]
+            return {"slow_query_count": self.slow_query_count, "endpoints": endpoints}
+    
+    def reset(self) -> None:
+        with self._lock:
+            self._endpoints.clear()
+            self.slow_query_count = 0
+
+query_stats_registry = QueryStatsRegistry()
+
+# リクエスト単位の集計先（スレッドプールで実行される同期エンドポイントにもコンテキストごと引き継がれる）
+_current_stats: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+def start_query_stats() -> Tuple[QueryStats, Token]:
+    """現在のコンテキストでSQLの集計を開始する"""
+    stats = QueryStats()
+    token = _current_stats.set(stats)
+    return stats, token
+
+def stop_query_stats(token: Token) -> None:
+    _current_stats.reset(token)
+
+def get_query_stats() -> Optional[QueryStats]:
+    return _current_stats.get()
+
+def _parameters_shape(parameters: Any) -> str:
+    """ログに値を残さないよう、パラメータを型の並びに変換する"""
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for key, value in parameters.items()) + "}"
+    if isinstance(parameters, (list, tuple)):
+        # executemanyの場合は件数と1件目の形を出す
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return f"{len(parameters)} x {_parameters_shape(parameters[0])}"
+        return "(" + ", ".join(type(value).__name__ for value in parameters) + ")"
+    return type(parameters).__name__
+
+def install_query_instrumentation(engine: Engine, slow_query_threshold_ms: float = 100.0) -> None:
+    """SQLの発行数・実行時間の計測と、スロークエリのログ出力をengineに設定する"""
+    
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+    
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start_time"].pop()
+        
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.query_count += 1
+            stats.total_time += elapsed
+        
+        if elapsed * 1000 >= slow_query_threshold_ms:
+            query_stats_registry.record_slow_query()
+            logger.warning(f"Slow query: time={elapsed * 1000:.1f}ms, statement={' '.join(statement.split())}, "
+                           f"parameters={_parameters_shape(parameters)}")
+    
+    @event.listens_for(engine, "commit")
+    def commit(conn):
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.commit_count += 1
+
+# スケジューラーの遅延・実行時間のヒストグラムのバケットの上限（ms）
+SCHEDULER_LATENCY_BUCKETS_MS = (1, 5, 10, 50, 100, 250, 500, 1000, 5000, 30000, 60000)
+# 取りこぼした実行回数を数えるときに、トリガーを進める回数の上限
+MAX_COALESCED_COUNT = 10000
+
+class Histogram:
+    """固定バケットのヒストグラム（各バケットは上限以下で、前のバケットの上限より大きい値の件数）"""
+    
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # 最後の要素は最大のバケットの上限を超えた値の件数
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        buckets = [{"le": bound, "count": count} for bound, count in zip(self.bounds, self.counts)]
+        buckets.append({"le": "+Inf", "count": self.counts[-1]})
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "buckets": buckets
+        }
+
+class SchedulerMetrics:
+    """APSchedulerのイベントから集計した、スケジュール実行の遅延・実行時間・取りこぼしとスレッドプールの状況
+    
+    - dispatch_lag_ms: 予定時刻からスケジューラーがスレッドプールに投入するまで
+    - execution_ms: 投入から実行の完了まで（スレッドプールの空き待ちを含む）
+    - misfires: 予定時刻からmisfire_grace_timeを過ぎて実行されなかった回数
+    - coalesced: 遅れにより1回にまとめられ、実行されなかった予定時刻の数
+    - max_instances: 前回の実行が終わっておらず実行されなかった回数
+    """
+    
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self.dispatch_lag = Histogram(SCHEDULER_LATENCY_BUCKETS_MS)
+        self.execution = Histogram(SCHEDULER_LATENCY_BUCKETS_MS)
+        self.counters = {"submitted": 0, "executed": 0, "errors": 0, "misfires": 0, "coalesced": 0, "max_instances": 0}
+        # (job_id, 予定時刻) -> 投入時刻（実行中・スレッドプールの空き待ちのもの）
+        self._in_flight: Dict[Tuple[str, datetime], datetime] = {}
+        # 投入のイベントより先に完了のイベントが届いた実行の完了時刻
+        # （投入のイベントはスケジューラーのスレッドで投入後に配信されるため、短いジョブでは前後する）
+        # （実行されなかった場合はNone）
+        self._finished_early: Dict[Tuple[str, datetime], Optional[datetime]] = {}
+        self.peak_in_flight = 0
+        # job_id -> 最後に投入した予定時刻（まとめられた予定時刻を数えるため）
+        self._last_run_times: Dict[str, datetime] = {}
+    
+    def record_submitted(self, job_id: str, run_times: List[datetime], now: datetime, trigger: Any = None) -> None:
+        with self._lock:
+            self.counters["submitted"] += len(run_times)
+            for run_time in run_times:
+                self.dispatch_lag.observe(max((now - run_time).total_seconds() * 1000, 0.0))
+                key = (job_id, run_time)
+                if key not in self._finished_early:
+                    self._in_flight[key] = now
+                    continue
+                finished_at = self._finished_early.pop(key)
+                if finished_at is not None:
+                    self.execution.observe(max((finished_at - now).total_seconds() * 1000, 0.0))
+            self.peak_in_flight = max(self.peak_in_flight, len(self._in_flight))
+            self.counters["coalesced"] += self._count_skipped(job_id, run_times[0], trigger)
+            self._last_run_times[job_id] = run_times[-1]
+    
+    def _count_skipped(self, job_id: str, run_time: datetime, trigger: Any) -> int:
+        """前回投入した予定時刻からrun_timeまでの間に、トリガーが発火するはずだった回数"""
+        last = self._last_run_times.get(job_id)
+        if last is None or trigger is None:
+            return 0
+        skipped = 0
+        fire_time = trigger.get_next_fire_time(last, last)
+        while fire_time is not None and fire_time < run_time and skipped < MAX_COALESCED_COUNT:
+            skipped += 1
+            fire_time = trigger.get_next_fire_time(fire_time, fire_time)
+        return skipped
+    
+    def record_max_instances(self, job_id: str, run_times: List[datetime]) -> None:
+        with self._lock:
+            self.counters["max_instances"] += len(run_times)
+            self._last_run_times[job_id] = run_times[-1]
+    
+    def record_finished(self, job_id: str, run_time: datetime, now: datetime, outcome: str) -> None:
+        """outcomeはexecuted・errors・misfiresのいずれか"""
+        with self._lock:
+            self.counters[outcome] += 1
+            submitted_at = self._in_flight.pop((job_id, run_time), None)
+            if submitted_at is None:
+                self._finished_early[(job_id, run_time)] = now if outcome != "misfires" else None
+            elif outcome != "misfires":
+                self.execution.observe((now - submitted_at).total_seconds() * 1000)
+    
+    def record_removed(self, job_id: str) -> None:
+        with self._lock:
+            self._last_run_times.pop(job_id, None)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            in_flight = len(self._in_flight)
+            return {
+                "counters": dict(self.counters),
+                "dispatch_lag_ms": self.dispatch_lag.snapshot(),
+                "execution_ms": self.execution.snapshot(),
+                "threadpool": {
+                    "max_workers": self.max_workers,
+                    "in_flight": in_flight,
+                    # 空きスレッドを待っている実行の数
+                    "queue_depth": max(in_flight - self.max_workers, 0),
+                    "saturation": min(in_flight, self.max_workers) / self.max_workers,
+                    "peak_in_flight": self.peak_in_flight
+                }
+            }
+
+def install_scheduler_instrumentation(scheduler: BaseScheduler, metrics: SchedulerMetrics) -> None:
+    """スケジュール実行の計測をschedulerのイベントに設定する"""
+    
+    def listener(event) -> None:
+        now = datetime.now(timezone.utc)
+        if event.code == EVENT_JOB_SUBMITTED:
+            job = scheduler.get_job(event.job_id)
+            metrics.record_submitted(event.job_id, event.scheduled_run_times, now, job.trigger if job is not None and job.coalesce else None)
+        elif event.code == EVENT_JOB_MAX_INSTANCES:
+            metrics.record_max_instances(event.job_id, event.scheduled_run_times)
+        elif event.code == EVENT_JOB_EXECUTED:
+            metrics.record_finished(event.job_id, event.scheduled_run_time, now, "executed")
+        elif event.code == EVENT_JOB_ERROR:
+            metrics.record_finished(event.job_id, event.scheduled_run_time, now, "errors")
+        elif event.code == EVENT_JOB_MISSED:
+            metrics.record_finished(event.job_id, event.scheduled_run_time, now, "misfires")
+        elif event.code == EVENT_JOB_REMOVED:
+            metrics.record_removed(event.job_id)
+    
+    scheduler.add_listener(
+        listener,
+        EVENT_JOB_SUBMITTED | EVENT_JOB_MAX_INSTANCES | EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED | EVENT_JOB_REMOVED
+    )
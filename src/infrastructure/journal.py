@@ -0,0 +1,188 @@
+import json
+import logging
+import os
+import threading
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Windowsなどfcntlがない環境では多重起動のチェックを行わない
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE = "journal.log"
+SNAPSHOT_FILE = "snapshot.json"
+LOCK_FILE = "store.lock"
+
+class Journal:
+    """追記専用のジャーナルとスナップショットによる永続化
+
+    ジャーナルは1行1トランザクションのJSON Lines（{"n": 連番, "ops": [...]}）で追記する。
+    fsyncは専用スレッドでまとめて行い（グループコミット）、fsync中に追記された
+    トランザクションは次のfsyncで一括して永続化される。fsyncに失敗した場合は
+    永続化を待つコミットをすべて失敗させる（失敗後のfsyncの成功は信用できないため再試行しない）。
+    スナップショットには取り込み済みの連番を記録し、再生時はそれ以降の行だけを適用する。
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.journal_path = os.path.join(directory, JOURNAL_FILE)
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+
+        # 同じディレクトリを複数プロセスで開くとジャーナルが壊れるため排他ロックを取る
+        self._lock_file = open(os.path.join(directory, LOCK_FILE), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._lock_file.close()
+                raise RuntimeError(f"Journal directory {directory} is already in use by another process")
+
+        self._file = None
+        self._condition = threading.Condition()
+        self._appended_seq = 0
+        self._synced_seq = 0
+        self._snapshot_seq = 0
+        self.records_since_snapshot = 0
+        self._valid_length = 0
+        self._closed = False
+        self._flusher: Optional[threading.Thread] = None
+        # fsyncスレッドが失敗した場合の例外
+        self._error: Optional[Exception] = None
+
+    def read_snapshot(self) -> Dict[str, List[dict]]:
+        """スナップショットのテーブルごとの行を読み込む（なければ空）"""
+        if not os.path.exists(self.snapshot_path):
+            return {}
+        with open(self.snapshot_path, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+        self._snapshot_seq = snapshot.get("seq", 0)
+        self._appended_seq = self._synced_seq = self._snapshot_seq
+        return snapshot.get("tables", {})
+
+    def read_transactions(self) -> Iterator[List[dict]]:
+        """スナップショット以降のトランザクションを順に返す
+
+        書き込み途中で停止した場合の末尾の壊れた行は、コミットされていないものとして無視する。
+        """
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, "rb") as f:
+            for line in f:
+                try:
+                    # 改行まで書き込まれていない行は書き込み途中のもの
+                    if not line.endswith(b"\n"):
+                        raise ValueError("missing newline")
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Ignoring truncated journal record at offset {self._valid_length}")
+                    break
+                self._valid_length += len(line)
+                if record["n"] <= self._snapshot_seq:
+                    continue
+                self._appended_seq = self._synced_seq = record["n"]
+                self.records_since_snapshot += 1
+                yield record["ops"]
+
+    def open(self) -> None:
+        """追記用にジャーナルを開き、fsyncスレッドを開始する（再生後に呼ぶ）"""
+        self._file = open(self.journal_path, "a+", encoding="utf-8")
+        # 再生時に読み飛ばした壊れた末尾の行を切り捨ててから追記する
+        if self._file.tell() > self._valid_length:
+            self._file.truncate(self._valid_length)
+            self._file.seek(0, os.SEEK_END)
+        self._flusher = threading.Thread(target=self._run_flusher, name="journal-fsync", daemon=True)
+        self._flusher.start()
+
+    def append(self, ops: List[dict]) -> int:
+        """1トランザクション分の操作を追記し、その連番を返す（呼び出し側で直列化すること）"""
+        with self._condition:
+            self._appended_seq += 1
+            seq = self._appended_seq
+            self._file.write(json.dumps({"n": seq, "ops": ops}, separators=(",", ":")) + "\n")
+            self._file.flush()
+            self.records_since_snapshot += 1
+            self._condition.notify_all()
+        return seq
+
+    def wait_durable(self, seq: int) -> None:
+        """連番seqまでのトランザクションがfsyncされるまで待つ（fsyncに失敗していればRuntimeError）"""
+        with self._condition:
+            while self._synced_seq < seq and not self._closed and self._error is None:
+                self._condition.wait()
+            if self._synced_seq < seq and self._error is not None:
+                raise RuntimeError(f"Journal fsync failed: {self._error}") from self._error
+
+    def _run_flusher(self) -> None:
+        while True:
+            with self._condition:
+                while self._synced_seq == self._appended_seq and not self._closed:
+                    self._condition.wait()
+                if self._closed and self._synced_seq == self._appended_seq:
+                    return
+                target = self._appended_seq
+                fd = self._file.fileno()
+            # fsync中も追記は受け付け、それらは次のfsyncでまとめて永続化する
+            try:
+                os.fsync(fd)
+            except Exception as e:
+                logger.error(f"Journal fsync failed; commits after seq {self._synced_seq} are not durable: {str(e)}")
+                with self._condition:
+                    self._error = e
+                    self._condition.notify_all()
+                return
+            with self._condition:
+                self._synced_seq = max(self._synced_seq, target)
+                self._condition.notify_all()
+
+    def write_snapshot(self, tables: Dict[str, List[dict]]) -> None:
+        """全テーブルのスナップショットを書き出し、ジャーナルを切り詰める（呼び出し側で追記を止めること）"""
+        with self._condition:
+            seq = self._appended_seq
+
+        temp_path = self.snapshot_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"seq": seq, "tables": tables}, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        self._fsync_directory()
+
+        # 切り詰める前に停止しても、スナップショットの連番以前の行は再生時に読み飛ばされる
+        with self._condition:
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._snapshot_seq = seq
+            self._synced_seq = seq
+            self.records_since_snapshot = 0
+            self._condition.notify_all()
+        logger.info(f"Journal compacted into snapshot at seq {seq}")
+
+    def _fsync_directory(self) -> None:
+        if not hasattr(os, "O_DIRECTORY"):
+            return
+        fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self) -> None:
+        """未fsyncの追記を永続化してからジャーナルを閉じる"""
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        if self._flusher is not None:
+            self._flusher.join()
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        self._lock_file.close()
@@ -0,0 +1,681 @@
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from sqlalchemy import DateTime
+from application.repositories import (
+    DeviceRepository, ScheduleRepository, DeviceTagRepository, ChangeLogRepository, ScheduleLoadRow, UnitOfWork, VersionConflictError,
+    CHANGE_ENTITY_DEVICE, CHANGE_ENTITY_SCHEDULE
+)
+from infrastructure.journal import Journal
+from infrastructure.models import DEFAULT_SITE_ID, Device, DeviceTag, Schedule, ChangeLog, ChangeLogWatermark
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SNAPSHOT_THRESHOLD = 10000
+
+class MemoryTable:
+    """主キーの辞書と、ユニーク索引・グループ索引を持つインメモリのテーブル
+
+    保持する行オブジェクトは変更せず、更新時は新しいオブジェクトに置き換える
+    （ロールバック時に置き換え前のオブジェクトを戻すだけで済むようにするため）。
+    """
+
+    def __init__(self, model, unique: Iterable[Any] = (), group_by: Iterable[str] = (), ordered: bool = False, sorted_by: Optional[Dict[str, Callable[[Any], tuple]]] = None):
+        """
+        Args:
+            unique: ユニーク索引の列名（複合索引の場合は列名のタプル）
+            group_by: グループ索引の列名
+            ordered: Trueの場合、主キーの昇順のリストを保持する（keys_afterで範囲検索できる）
+            sorted_by: 索引名 -> 行から索引のキー（主キーを含め一意になるタプル）を作る関数。キーの昇順のリストを保持する
+        """
+        self.model = model
+        # 複合主キーの場合、主キーは列の値のタプル
+        key_columns = model.__table__.primary_key.columns.keys()
+        self.key = key_columns[0] if len(key_columns) == 1 else tuple(key_columns)
+        self.columns = [column.key for column in model.__table__.columns]
+        self.datetime_columns = {column.key for column in model.__table__.columns if isinstance(column.type, DateTime)}
+        # 列の追加前に書き出されたジャーナル・スナップショットの行を読み込むときの既定値
+        self.defaults = {
+            column.key: column.default.arg
+            for column in model.__table__.columns
+            if column.default is not None and column.default.is_scalar
+        }
+        self.rows: Dict[Any, Any] = {}
+        self.unique: Dict[str, Dict[Any, Any]] = {column: {} for column in unique}
+        # 値 -> {主キー: None}（挿入順を保つ集合として使う）
+        self.groups: Dict[str, Dict[Any, Dict[Any, None]]] = {column: {} for column in group_by}
+        self.sorted_keys: Optional[List[Any]] = [] if ordered else None
+        self.sorted_by = dict(sorted_by or {})
+        self.sorted_indexes: Dict[str, List[tuple]] = {name: [] for name in self.sorted_by}
+
+    @staticmethod
+    def _value(row, column):
+        if isinstance(column, tuple):
+            return tuple(getattr(row, c) for c in column)
+        return getattr(row, column)
+
+    def get(self, key) -> Optional[Any]:
+        return self.rows.get(key)
+
+    def get_unique(self, column, value) -> Optional[Any]:
+        key = self.unique[column].get(value)
+        return self.rows[key] if key is not None else None
+
+    def get_group(self, column: str, value) -> List[Any]:
+        return [self.rows[key] for key in self.groups[column].get(value, ())]
+
+    def put(self, row) -> Optional[Any]:
+        """行を追加または置き換え、置き換え前の行を返す（ユニーク制約違反はValueError）"""
+        key = self._value(row, self.key)
+        for column, index in self.unique.items():
+            owner = index.get(self._value(row, column))
+            if owner is not None and owner != key:
+                raise ValueError(f"{self.model.__tablename__}.{column} {self._value(row, column)} already exists")
+        previous = self._unindex(key)
+        self.rows[key] = row
+        if self.sorted_keys is not None:
+            bisect.insort(self.sorted_keys, key)
+        for column, index in self.unique.items():
+            index[self._value(row, column)] = key
+        for column, groups in self.groups.items():
+            groups.setdefault(getattr(row, column), {})[key] = None
+        for name, index_key in self.sorted_by.items():
+            bisect.insort(self.sorted_indexes[name], index_key(row))
+        return previous
+
+    def remove(self, key) -> Optional[Any]:
+        """行を削除し、削除した行を返す"""
+        previous = self._unindex(key)
+        if previous is not None:
+            del self.rows[key]
+        return previous
+
+    def _unindex(self, key) -> Optional[Any]:
+        previous = self.rows.get(key)
+        if previous is None:
+            return None
+        if self.sorted_keys is not None:
+            del self.sorted_keys[bisect.bisect_left(self.sorted_keys, key)]
+        for column, index in self.unique.items():
+            index.pop(self._value(previous, column), None)
+        for column, groups in self.groups.items():
+            members = groups.get(getattr(previous, column))
+            if members is not None:
+                members.pop(key, None)
+                if not members:
+                    del groups[getattr(previous, column)]
+        for name, index_key in self.sorted_by.items():
+            entries = self.sorted_indexes[name]
+            del entries[bisect.bisect_left(entries, index_key(previous))]
+        return previous
+
+    def keys_after(self, key, limit: int) -> List[Any]:
+        """keyより大きい主キーを昇順で最大limit件返す（ordered=Trueの場合のみ）"""
+        start = bisect.bisect_right(self.sorted_keys, key)
+        return self.sorted_keys[start:start + limit]
+
+    def scan_sorted(self, name: str, start: tuple) -> Iterator[tuple]:
+        """索引nameのキーをstart以上から昇順に返す（呼び出し側でlockを保持すること）"""
+        entries = self.sorted_indexes[name]
+        for i in range(bisect.bisect_left(entries, start), len(entries)):
+            yield entries[i]
+
+    def copy(self, row, **changes):
+        """行のコピーを変更を加えて作成する"""
+        values = {column: getattr(row, column) for column in self.columns}
+        values.update(changes)
+        return self.model(**values)
+
+    def to_dict(self, row) -> dict:
+        values = {}
+        for column in self.columns:
+            value = getattr(row, column)
+            values[column] = value.isoformat() if isinstance(value, datetime) else value
+        return values
+
+    def key_from_json(self, key):
+        """ジャーナルに書き出した主キーを戻す（複合主キーはJSONでは配列になる）"""
+        return tuple(key) if isinstance(self.key, tuple) else key
+
+    def from_dict(self, values: dict):
+        values = {**self.defaults, **values}
+        for column in self.datetime_columns:
+            if values.get(column) is not None:
+                values[column] = datetime.fromisoformat(values[column])
+        return self.model(**values)
+
+class MemoryStore:
+    """デバイス・スケジュールをメモリ上に保持し、ジャーナルで永続化するストア
+
+    更新は write_lock で直列化し、コミットごとにジャーナルへ1行追記する。
+    読み取りはwrite_lockを取らないため、実行中のトランザクションの変更が見える場合がある。
+    同じスレッドでUnitOfWorkの実行中に別の書き込みを行うとデッドロックするため、1リクエストでは1つのUnitOfWorkを使うこと。
+    """
+
+    def __init__(self, journal: Optional[Journal] = None, snapshot_threshold: int = DEFAULT_SNAPSHOT_THRESHOLD, site_id: str = DEFAULT_SITE_ID):
+        # ストアはノードのサイトのパーティションだけを保持する（ジャーナルのディレクトリはノードごと）
+        self.site_id = site_id
+        self.tables = {
+            "devices": MemoryTable(
+                Device,
+                unique=(("site_id", "gpio_number"),),
+                # 名前の前方一致検索用（小文字の名前, device_id）
+                sorted_by={"lower_name": lambda device: (device.device_name.lower(), device.device_id)}
+            ),
+            "schedules": MemoryTable(Schedule, group_by=("device_id",)),
+            # タグごとのグループ索引がタグからデバイスを引く転置索引になる
+            "device_tags": MemoryTable(DeviceTag, group_by=("device_id", "tag")),
+            # エンティティごとに最新の変更1行だけを保持する（リビジョンの昇順で差分を取得する）
+            "changes": MemoryTable(ChangeLog, unique=(("entity_type", "entity_id"),), ordered=True),
+            "change_watermarks": MemoryTable(ChangeLogWatermark),
+        }
+        self.last_revision = 0
+        self.journal = journal
+        self.snapshot_threshold = snapshot_threshold
+        # 索引の更新中に読み取られないようにするロック（短時間のみ保持）
+        self.lock = threading.RLock()
+        # 書き込みトランザクションを直列化するロック（コミットまたはロールバックまで保持）
+        self.write_lock = threading.Lock()
+
+    @property
+    def devices(self) -> MemoryTable:
+        return self.tables["devices"]
+
+    @property
+    def schedules(self) -> MemoryTable:
+        return self.tables["schedules"]
+
+    @property
+    def device_tags(self) -> MemoryTable:
+        return self.tables["device_tags"]
+
+    @property
+    def changes(self) -> MemoryTable:
+        return self.tables["changes"]
+
+    def load(self) -> None:
+        """スナップショットとジャーナルを再生して状態を復元し、追記を開始する"""
+        if self.journal is None:
+            return
+        started_at = datetime.now()
+        for name, rows in self.journal.read_snapshot().items():
+            table = self.tables[name]
+            for values in rows:
+                table.put(table.from_dict(values))
+        transactions = 0
+        for ops in self.journal.read_transactions():
+            self._apply(ops)
+            transactions += 1
+        if self.changes.sorted_keys:
+            self.last_revision = self.changes.sorted_keys[-1]
+        # 最新の変更がトゥームストーンとして削除済みの場合も、そのリビジョンを再利用しない
+        watermark = self.tables["change_watermarks"].get(self.site_id)
+        if watermark is not None:
+            self.last_revision = max(self.last_revision, watermark.pruned_revision)
+        self.journal.open()
+        elapsed = (datetime.now() - started_at).total_seconds()
+        logger.info(
+            f"Memory store loaded {len(self.devices.rows)} devices and {len(self.schedules.rows)} schedules "
+            f"({transactions} journal records replayed in {elapsed:.3f}s)"
+        )
+
+    def _apply(self, ops: List[dict]) -> None:
+        with self.lock:
+            for op in ops:
+                table = self.tables[op["t"]]
+                if "put" in op:
+                    table.put(table.from_dict(op["put"]))
+                else:
+                    table.remove(table.key_from_json(op["del"]))
+
+    def log(self, ops: List[dict]) -> Optional[int]:
+        """1トランザクション分の操作をジャーナルに追記し、その連番を返す（write_lockを保持して呼ぶ）"""
+        if self.journal is None or not ops:
+            return None
+        seq = self.journal.append(ops)
+        if self.journal.records_since_snapshot >= self.snapshot_threshold:
+            try:
+                self.compact()
+            except Exception as e:
+                # ジャーナルには追記済みのため、次回のコミット時に再試行する
+                logger.error(f"Failed to compact memory store: {str(e)}")
+        return seq
+
+    def wait_durable(self, seq: Optional[int]) -> None:
+        if self.journal is not None and seq is not None:
+            self.journal.wait_durable(seq)
+
+    def compact(self) -> None:
+        """スナップショットを書き出してジャーナルを切り詰める（write_lockを保持して呼ぶ）"""
+        with self.lock:
+            tables = {name: [table.to_dict(row) for row in table.rows.values()] for name, table in self.tables.items()}
+        self.journal.write_snapshot(tables)
+
+    def close(self) -> None:
+        if self.journal is not None:
+            self.journal.close()
+
+# 変更履歴を記録するテーブルとエンティティ種別
+CHANGE_ENTITY_TYPES = {"devices": CHANGE_ENTITY_DEVICE, "schedules": CHANGE_ENTITY_SCHEDULE}
+
+@contextmanager
+def _transaction(store: MemoryStore, unit_of_work: Optional['InMemoryUnitOfWork']) -> Iterator['InMemoryUnitOfWork']:
+    """複数行の書き込みを1トランザクションで行う（UnitOfWorkなしの場合はここでコミットする）"""
+    if unit_of_work is not None:
+        yield unit_of_work
+        return
+    unit_of_work = InMemoryUnitOfWork(store)
+    try:
+        yield unit_of_work
+        unit_of_work.commit()
+    except Exception:
+        unit_of_work.rollback()
+        raise
+
+def _check_version(current, expected_version: Optional[int]) -> None:
+    """現在の行のバージョンがexpected_versionと一致しなければVersionConflictError（行がなければ何もしない）"""
+    if current is not None and expected_version is not None and current.version != expected_version:
+        raise VersionConflictError(f"{current.__tablename__} is not at version {expected_version}")
+
+def _delete_build(expected_version: Optional[int]) -> Callable[[Optional[Any]], None]:
+    """バージョンを確認してから行を削除するbuild関数"""
+    def build(current):
+        _check_version(current, expected_version)
+        return None
+    return build
+
+class InMemoryUnitOfWork(UnitOfWork):
+    """MemoryStoreに対するUnitOfWork
+
+    変更はストアに即時反映し、ロールバック用に置き換え前の行を記録する。
+    最初の書き込みからコミット（またはロールバック）までストアのwrite_lockを保持する。
+    """
+
+    def __init__(self, store: MemoryStore, auto_commit: bool = False):
+        self.store = store
+        self.auto_commit = auto_commit
+        self.devices = InMemoryDeviceRepository(store, self)
+        self.schedules = InMemoryScheduleRepository(store, self)
+        self.tags = InMemoryDeviceTagRepository(store, self)
+        self.changes = InMemoryChangeLogRepository(store, self)
+        self._ops: List[dict] = []
+        self._undo: List[Tuple[MemoryTable, Any, Optional[Any]]] = []
+        self._locked = False
+
+    def _write(self, name: str, key, build: Callable[[Optional[Any]], Optional[Any]]) -> Optional[Any]:
+        """現在の行からbuildで新しい行を作って置き換え、置き換え前の行を返す
+
+        buildは現在の行（なければNone）を受け取り、新しい行・None（削除）・現在の行そのもの（変更なし）を返す。
+        write_lockを取得してから呼ぶため、バージョンの比較と更新の間に他の書き込みは入らない。
+        """
+        table = self.store.tables[name]
+        if not self._locked:
+            self.store.write_lock.acquire()
+            self._locked = True
+        try:
+            with self.store.lock:
+                current = table.get(key)
+                row = build(current)
+                if row is not current:
+                    self._replace(name, key, row, current)
+                    if name in CHANGE_ENTITY_TYPES:
+                        self._record_change(CHANGE_ENTITY_TYPES[name], key, deleted=row is None)
+        except Exception:
+            if not self._undo:
+                self._release()
+            raise
+        if self.auto_commit:
+            self.commit()
+        return current
+
+    def _replace(self, name: str, key, row, current) -> None:
+        table = self.store.tables[name]
+        if row is not None:
+            table.put(row)
+            self._ops.append({"t": name, "put": table.to_dict(row)})
+        else:
+            table.remove(key)
+            self._ops.append({"t": name, "del": key})
+        self._undo.append((table, key, current))
+
+    def _record_change(self, entity_type: str, entity_id: str, deleted: bool) -> None:
+        """エンティティの変更を新しいリビジョンで記録し、同じエンティティの古い行を削除する"""
+        changes = self.store.changes
+        previous = changes.get_unique(("entity_type", "entity_id"), (entity_type, entity_id))
+        if previous is not None:
+            self._replace("changes", previous.revision, None, previous)
+        # ロールバックで欠番になっても、リビジョンが単調に増加していればよい
+        self.store.last_revision += 1
+        change = ChangeLog(
+            revision=self.store.last_revision,
+            site_id=self.store.site_id,
+            entity_type=entity_type,
+            entity_id=entity_id,
+            deleted=deleted,
+            changed_at=datetime.now()
+        )
+        self._replace("changes", change.revision, change, None)
+
+    def _release(self) -> None:
+        if self._locked:
+            self._locked = False
+            self.store.write_lock.release()
+
+    def commit(self) -> None:
+        if not self._locked:
+            return
+        try:
+            seq = self.store.log(self._ops)
+        except Exception:
+            # 永続化できなかった変更はメモリ上からも取り消す
+            self.rollback()
+            raise
+        self._ops = []
+        self._undo = []
+        self._release()
+        # fsyncの完了はwrite_lockを解放してから待つ（その間の他のコミットと同じfsyncにまとめるため）
+        self.store.wait_durable(seq)
+
+    def rollback(self) -> None:
+        if not self._locked:
+            return
+        with self.store.lock:
+            for table, key, previous in reversed(self._undo):
+                if previous is None:
+                    table.remove(key)
+                else:
+                    table.put(previous)
+        self._ops = []
+        self._undo = []
+        self._release()
+
+class InMemoryDeviceRepository(DeviceRepository):
+    def __init__(self, store: MemoryStore, unit_of_work: Optional[InMemoryUnitOfWork] = None):
+        self.store = store
+        self.unit_of_work = unit_of_work
+
+    def _writer(self) -> InMemoryUnitOfWork:
+        # UnitOfWorkなしで使う場合は、書き込みごとに個別にコミットする
+        return self.unit_of_work or InMemoryUnitOfWork(self.store, auto_commit=True)
+
+    def _sorted(self) -> List[Device]:
+        with self.store.lock:
+            devices = list(self.store.devices.rows.values())
+        devices.sort(key=lambda device: (device.created_at, device.device_id))
+        return devices
+
+    def create(self, device_id: str, device_name: str, gpio_number: int) -> None:
+        now = datetime.now()
+
+        def build(current):
+            if current is not None:
+                raise ValueError(f"devices.device_id {device_id} already exists")
+            return Device(device_id=device_id, site_id=self.store.site_id, device_name=device_name, gpio_number=gpio_number, created_at=now, updated_at=now, version=1)
+        self._writer()._write("devices", device_id, build)
+
+    def find_all(self) -> List[Device]:
+        return self._sorted()
+
+    def find_page(self, limit: int, after: Optional[Tuple[datetime, str]] = None) -> List[Device]:
+        devices = self._sorted()
+        start = 0
+        if after is not None:
+            start = bisect.bisect_right([(device.created_at, device.device_id) for device in devices], after)
+        return devices[start:start + limit]
+
+    def iter_all(self, batch_size: int = 500) -> Iterator[Device]:
+        yield from self._sorted()
+
+    def find_by_id(self, device_id: str) -> Optional[Device]:
+        return self.store.devices.get(device_id)
+
+    def find_by_ids(self, device_ids: Iterable[str]) -> List[Device]:
+        with self.store.lock:
+            return [device for device in map(self.store.devices.get, device_ids) if device is not None]
+
+    def search_by_name(self, prefix: str, limit: int) -> List[Device]:
+        prefix = prefix.lower()
+        devices = []
+        with self.store.lock:
+            for name, device_id in self.store.devices.scan_sorted("lower_name", (prefix,)):
+                if not name.startswith(prefix) or len(devices) >= limit:
+                    break
+                devices.append(self.store.devices.get(device_id))
+        return devices
+
+    def update_timestamp(self, device_id: str) -> None:
+        now = datetime.now()
+        self._writer()._write("devices", device_id, lambda current: current and self.store.devices.copy(current, updated_at=now))
+
+    def update_timestamps(self, device_ids: Iterable[str]) -> None:
+        now = datetime.now()
+        with _transaction(self.store, self.unit_of_work) as unit_of_work:
+            for device_id in device_ids:
+                unit_of_work._write("devices", device_id, lambda current: current and self.store.devices.copy(current, updated_at=now))
+
+    def delete(self, device_id: str, expected_version: Optional[int] = None) -> bool:
+        return bool(self._delete_cascade([device_id], lambda device_id: _delete_build(expected_version)))
+
+    def delete_many(self, device_ids: Iterable[str], expected_versions: Optional[Dict[str, int]] = None) -> List[str]:
+        expected_versions = expected_versions or {}
+
+        def build_for(device_id: str) -> Callable[[Optional[Any]], Optional[Any]]:
+            expected_version = expected_versions.get(device_id)
+            # バージョンが一致しないデバイスは削除せずにそのまま残す
+            return lambda current: current if (
+                current is not None and expected_version is not None and current.version != expected_version
+            ) else None
+        return self._delete_cascade(device_ids, build_for)
+
+    def _delete_cascade(self, device_ids: Iterable[str], build_for: Callable[[str], Callable[[Optional[Any]], Optional[Any]]]) -> List[str]:
+        """デバイスとそのスケジュール・タグを1トランザクションで削除する（SQLのON DELETE CASCADEに相当）"""
+        deleted_ids = []
+        with _transaction(self.store, self.unit_of_work) as unit_of_work:
+            for device_id in device_ids:
+                if unit_of_work._write("devices", device_id, build_for(device_id)) is None or self.store.devices.get(device_id) is not None:
+                    continue
+                # 最初の書き込みからwrite_lockを保持しているため、ここで読んだスケジュールは変わらない
+                for schedule in self.store.schedules.get_group("device_id", device_id):
+                    unit_of_work._write("schedules", schedule.schedule_id, _delete_build(None))
+                for tag in self.store.device_tags.get_group("device_id", device_id):
+                    unit_of_work._write("device_tags", (tag.site_id, tag.tag, device_id), _delete_build(None))
+                deleted_ids.append(device_id)
+        return deleted_ids
+
+    def update_device(self, device_id: str, device_name: Optional[str] = None, gpio_number: Optional[int] = None, expected_version: Optional[int] = None) -> bool:
+        changes = {"updated_at": datetime.now()}
+        if device_name is not None:
+            changes["device_name"] = device_name
+        if gpio_number is not None:
+            changes["gpio_number"] = gpio_number
+
+        def build(current):
+            if current is None:
+                return None
+            _check_version(current, expected_version)
+            return self.store.devices.copy(current, version=current.version + 1, **changes)
+        return self._writer()._write("devices", device_id, build) is not None
+
+class InMemoryScheduleRepository(ScheduleRepository):
+    def __init__(self, store: MemoryStore, unit_of_work: Optional[InMemoryUnitOfWork] = None):
+        self.store = store
+        self.unit_of_work = unit_of_work
+
+    def _writer(self) -> InMemoryUnitOfWork:
+        # UnitOfWorkなしで使う場合は、書き込みごとに個別にコミットする
+        return self.unit_of_work or InMemoryUnitOfWork(self.store, auto_commit=True)
+
+    def save(self, schedule: Schedule) -> Schedule:
+        now = datetime.now()
+        schedule = self.store.schedules.copy(
+            schedule,
+            site_id=self.store.site_id,
+            created_at=schedule.created_at or now,
+            updated_at=now,
+            version=schedule.version or 1
+        )
+        self._writer()._write("schedules", schedule.schedule_id, lambda current: schedule)
+        return schedule
+
+    def find_all(self) -> List[Schedule]:
+        with self.store.lock:
+            return list(self.store.schedules.rows.values())
+
+    def find_all_with_devices(self) -> List[ScheduleLoadRow]:
+        rows = []
+        with self.store.lock:
+            for schedule in self.store.schedules.rows.values():
+                device = self.store.devices.get(schedule.device_id)
+                if device is not None:
+                    rows.append(ScheduleLoadRow(
+                        schedule.schedule_id, device.device_id, device.gpio_number, schedule.schedule, schedule.is_on, schedule.version
+                    ))
+        return rows
+
+    def find_by_device_id(self, device_id: str) -> List[Schedule]:
+        with self.store.lock:
+            schedules = self.store.schedules.get_group("device_id", device_id)
+        return sorted(schedules, key=lambda schedule: schedule.schedule)
+
+    def find_page_by_device_id(self, device_id: str, limit: int, after: Optional[Tuple[str, str]] = None) -> List[Schedule]:
+        with self.store.lock:
+            schedules = self.store.schedules.get_group("device_id", device_id)
+        schedules.sort(key=lambda schedule: (schedule.schedule, schedule.schedule_id))
+        start = 0
+        if after is not None:
+            start = bisect.bisect_right([(schedule.schedule, schedule.schedule_id) for schedule in schedules], tuple(after))
+        return schedules[start:start + limit]
+
+    def find_by_id(self, schedule_id: str) -> Optional[Schedule]:
+        return self.store.schedules.get(schedule_id)
+
+    def find_by_ids(self, schedule_ids: Iterable[str]) -> List[Schedule]:
+        with self.store.lock:
+            return [schedule for schedule in map(self.store.schedules.get, schedule_ids) if schedule is not None]
+
+    def update(self, schedule_id: str, schedule: Optional[str] = None, is_on: Optional[bool] = None, expected_version: Optional[int] = None) -> bool:
+        changes = {"updated_at": datetime.now()}
+        if schedule is not None:
+            changes["schedule"] = schedule
+        if is_on is not None:
+            changes["is_on"] = is_on
+
+        def build(current):
+            if current is None:
+                return None
+            _check_version(current, expected_version)
+            return self.store.schedules.copy(current, version=current.version + 1, **changes)
+        return self._writer()._write("schedules", schedule_id, build) is not None
+
+    def delete(self, schedule_id: str, expected_version: Optional[int] = None) -> bool:
+        return self._writer()._write("schedules", schedule_id, _delete_build(expected_version)) is not None
+
+class InMemoryDeviceTagRepository(DeviceTagRepository):
+    def __init__(self, store: MemoryStore, unit_of_work: Optional[InMemoryUnitOfWork] = None):
+        self.store = store
+        self.unit_of_work = unit_of_work
+
+    def set_tags(self, device_id: str, tags: List[str]) -> None:
+        site_id = self.store.site_id
+        with _transaction(self.store, self.unit_of_work) as unit_of_work:
+            for tag in self.store.device_tags.get_group("device_id", device_id):
+                if tag.tag not in tags:
+                    unit_of_work._write("device_tags", (site_id, tag.tag, device_id), _delete_build(None))
+            for tag in tags:
+                unit_of_work._write(
+                    "device_tags", (site_id, tag, device_id),
+                    lambda current, tag=tag: current or DeviceTag(site_id=site_id, tag=tag, device_id=device_id)
+                )
+            # タグはデバイスの属性として変更履歴に記録する（デバイスの行を置き換えると記録される）
+            unit_of_work._write("devices", device_id, lambda current: current and self.store.devices.copy(current))
+
+    def find_tags(self, device_id: str) -> List[str]:
+        with self.store.lock:
+            return sorted(tag.tag for tag in self.store.device_tags.get_group("device_id", device_id))
+
+    def find_devices_by_tags(self, tags: List[str]) -> List[Device]:
+        if not tags:
+            return []
+        with self.store.lock:
+            # 件数の少ないタグから積集合を取る
+            members = sorted(
+                ({tag.device_id for tag in self.store.device_tags.get_group("tag", name)} for name in set(tags)),
+                key=len
+            )
+            device_ids = set.intersection(*members)
+            devices = [self.store.devices.get(device_id) for device_id in device_ids]
+        devices = [device for device in devices if device is not None]
+        devices.sort(key=lambda device: (device.created_at, device.device_id))
+        return devices
+
+class InMemoryChangeLogRepository(ChangeLogRepository):
+    def __init__(self, store: MemoryStore, unit_of_work: Optional[InMemoryUnitOfWork] = None):
+        self.store = store
+        self.unit_of_work = unit_of_work
+
+    @contextmanager
+    def _committed(self) -> Iterator[None]:
+        """他の実行中のトランザクションの変更を返さないよう、書き込みの完了を待ってから読む
+
+        同じUnitOfWorkが書き込み中（write_lockを保持）の場合は、待つと解放されないため待たずに
+        自分の変更を含めて読む。
+        """
+        if self.unit_of_work is not None and self.unit_of_work._locked:
+            with self.store.lock:
+                yield
+            return
+        with self.store.write_lock, self.store.lock:
+            yield
+
+    def find_since(self, since: int, limit: int) -> List[ChangeLog]:
+        with self._committed():
+            changes = self.store.changes
+            return [changes.get(revision) for revision in changes.keys_after(since, limit)]
+
+    def find_latest_revision(self) -> int:
+        # ロールバックで欠番になったリビジョンは返さない（再起動後に再利用されるため）
+        with self._committed():
+            keys = self.store.changes.sorted_keys
+            return keys[-1] if keys else 0
+
+    def find_pruned_revision(self) -> int:
+        with self.store.lock:
+            watermark = self.store.tables["change_watermarks"].get(self.store.site_id)
+            return watermark.pruned_revision if watermark is not None else 0
+
+    def prune_tombstones(self, before: datetime) -> int:
+        with _transaction(self.store, self.unit_of_work) as unit_of_work:
+            with self.store.lock:
+                revisions = [
+                    change.revision for change in self.store.changes.rows.values()
+                    if change.deleted and change.changed_at < before
+                ]
+            for revision in revisions:
+                unit_of_work._write("changes", revision, lambda current: None)
+            if not revisions:
+                return 0
+            # 削除したトゥームストーンより前のリビジョンからの差分取得は、全件の再取得が必要になる
+            pruned_revision = max(revisions)
+            unit_of_work._write("change_watermarks", self.store.site_id, lambda current: (
+                current if current is not None and current.pruned_revision >= pruned_revision
+                else ChangeLogWatermark(site_id=self.store.site_id, pruned_revision=pruned_revision)
+            ))
+            return len(revisions)
+
+def open_memory_store(directory: Optional[str], snapshot_threshold: int = DEFAULT_SNAPSHOT_THRESHOLD, site_id: str = DEFAULT_SITE_ID) -> MemoryStore:
+    """ジャーナルを再生してMemoryStoreを開く（directoryがNoneの場合は永続化しない）"""
+    store = MemoryStore(Journal(directory) if directory else None, snapshot_threshold, site_id)
+    store.load()
+    return store
+
+@contextmanager
+def memory_unit_of_work_scope(store: MemoryStore):
+    """MemoryStoreのUnitOfWorkを提供する（コミットされなかった変更は破棄する）"""
+    unit_of_work = InMemoryUnitOfWork(store)
+    try:
+        yield unit_of_work
+    finally:
+        unit_of_work.rollback()
@@ -1,25 +1,195 @@
+import uuid
 from datetime import datetime
-from sqlalchemy import Column, String, Integer, DateTime, Boolean, ForeignKey
+from sqlalchemy import func, Column, String, Integer, Float, DateTime, Boolean, ForeignKey, Index, LargeBinary, UniqueConstraint
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.sql import func
+from sqlalchemy.orm import relationship
+from sqlalchemy.types import TypeDecorator, UserDefinedType
 
 Base = declarative_base()
 
+# SITE_IDが設定されていない（単一サイト構成の）場合のサイト
+DEFAULT_SITE_ID = "default"
+
+class _RawBinaryId(UserDefinedType):
+    """値を変換せずにDBドライバへ渡す16バイトのバイナリ列"""
+    cache_ok = True
+    
+    def get_col_spec(self, **kw):
+        return "BLOB"
+
+class CompactId(TypeDecorator):
+    """UUID形式のIDを16バイトで保存する型（アプリケーション側では文字列として扱う）
+
+    PostgreSQLではネイティブのuuid型、その他のDBでは16バイトのバイナリで保存する。
+    UUIDとして解釈できない既存のID（テストデータなど）は、SQLiteでは文字列のまま保存する。
+    """
+    impl = _RawBinaryId
+    cache_ok = True
+    
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(postgresql.UUID(as_uuid=True))
+        if dialect.name == "sqlite":
+            return dialect.type_descriptor(_RawBinaryId())
+        return dialect.type_descriptor(LargeBinary(16))
+    
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            # ハイフンなし・大文字などの表記揺れもここで正規化される
+            parsed = uuid.UUID(str(value))
+        except ValueError:
+            if dialect.name == "postgresql":
+                # uuid型に保存できないIDは、どの行にも一致しない値として扱う
+                return uuid.UUID(int=0)
+            return value
+        if dialect.name == "postgresql":
+            return parsed
+        return parsed.bytes
+    
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, uuid.UUID):
+            return str(value)
+        if isinstance(value, (bytes, memoryview)):
+            return str(uuid.UUID(bytes=bytes(value)))
+        return value
+
 class Device(Base):
     __tablename__ = "devices"
     
-    device_id = Column(String, primary_key=True)
+    device_id = Column(CompactId, primary_key=True)
+    # デバイスを制御するノード（Raspberry Pi）のサイト
+    site_id = Column(String, nullable=False, default=DEFAULT_SITE_ID, server_default=DEFAULT_SITE_ID)
     device_name = Column(String, nullable=False)
-    gpio_number = Column(Integer, nullable=False, unique=True)
-    created_at = Column(DateTime, default=func.now())
-    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+    gpio_number = Column(Integer, nullable=False)
+    # キーセットページネーションの比較精度を揃えるため、タイムスタンプはアプリ側で採番する
+    created_at = Column(DateTime, default=datetime.now)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+    # 楽観的排他制御用のバージョン（名前・GPIO番号の更新ごとに1増える。ETagとして公開）
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    
+    # スケジュールはDB側のON DELETE CASCADEで削除する（ORMから個別にDELETEを発行しない）
+    schedules = relationship("Schedule", cascade="all, delete-orphan", passive_deletes=True)
+    tags = relationship("DeviceTag", cascade="all, delete-orphan", passive_deletes=True)
+    
+    __table_args__ = (
+        # GPIO番号はサイト（ノード）ごとに一意
+        UniqueConstraint("site_id", "gpio_number", name="uq_devices_site_id_gpio_number"),
+        # サイト内のデバイス一覧のキーセットページネーション用 (site_id, created_at, device_id)
+        Index("ix_devices_site_id_created_at_device_id", "site_id", "created_at", "device_id"),
+        # 名前の前方一致検索（大文字小文字を区別しない）用の式インデックス
+        Index("ix_devices_site_id_lower_device_name", "site_id", func.lower(device_name)),
+    )
 
 class Schedule(Base):
     __tablename__ = "schedules"
     
-    schedule_id = Column(String, primary_key=True)
-    device_id = Column(String, ForeignKey("devices.device_id"), nullable=False)
+    schedule_id = Column(CompactId, primary_key=True)
+    # デバイスと同じサイト（起動時にノードのサイトのスケジュールだけを読み込むため）
+    site_id = Column(String, nullable=False, default=DEFAULT_SITE_ID, server_default=DEFAULT_SITE_ID)
+    device_id = Column(CompactId, ForeignKey("devices.device_id", ondelete="CASCADE"), nullable=False)
     schedule = Column(String, nullable=False)
     is_on = Column(Boolean, nullable=False)
-    created_at = Column(DateTime, default=func.now())
-    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
\ No newline at end of file
+    created_at = Column(DateTime, default=datetime.now)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+    # 楽観的排他制御用のバージョン
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    
+    __table_args__ = (
+        # サイト内のデバイス別スケジュール一覧のキーセットページネーション用 (site_id, device_id, schedule, schedule_id)
+        Index("ix_schedules_site_id_device_id_schedule", "site_id", "device_id", "schedule", "schedule_id"),
+    )
+
+class DeviceTag(Base):
+    """デバイスとタグ（グループ）の多対多の関連
+
+    主キー (site_id, tag, device_id) がタグからデバイスを引く転置索引を兼ねる。
+    """
+    __tablename__ = "device_tags"
+    
+    site_id = Column(String, primary_key=True, default=DEFAULT_SITE_ID)
+    tag = Column(String, primary_key=True)
+    device_id = Column(CompactId, ForeignKey("devices.device_id", ondelete="CASCADE"), primary_key=True)
+    
+    __table_args__ = (
+        # デバイスのタグの置き換え用
+        Index("ix_device_tags_device_id", "device_id"),
+    )
+
+class StateEvent(Base):
+    """デバイスのON/OFF状態変化の履歴（追記のみ）"""
+    __tablename__ = "state_events"
+    
+    event_id = Column(Integer, primary_key=True, autoincrement=True)
+    device_id = Column(CompactId, nullable=False)
+    gpio_number = Column(Integer, nullable=False)
+    is_on = Column(Boolean, nullable=False)
+    # 状態変化の発生元（api / schedule / input）
+    source = Column(String, nullable=False)
+    ts = Column(DateTime, nullable=False)
+    
+    __table_args__ = (
+        # デバイス別の時間範囲検索用
+        Index("ix_state_events_device_id_ts", "device_id", "ts"),
+        # 保持期間による削除用
+        Index("ix_state_events_ts", "ts"),
+    )
+
+
+class DeviceUsage(Base):
+    """デバイスのON時間と切り替え回数の集計（時間/日/月単位）"""
+    __tablename__ = "device_usage"
+    
+    device_id = Column(CompactId, primary_key=True)
+    # 集計単位（hour / day / month）
+    granularity = Column(String, primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    on_seconds = Column(Float, nullable=False, default=0.0)
+    switch_count = Column(Integer, nullable=False, default=0)
+
+class DeviceUsageState(Base):
+    """集計済みの最新状態（ONの場合は未確定の区間の開始時刻を保持する）"""
+    __tablename__ = "device_usage_states"
+    
+    device_id = Column(CompactId, primary_key=True)
+    is_on = Column(Boolean, nullable=False)
+    since = Column(DateTime, nullable=False)
+
+class ChangeLog(Base):
+    """デバイス・スケジュールの変更履歴（差分同期用）
+
+    エンティティごとに最新の変更1行だけを保持し、変更のたびに古い行を削除して新しいリビジョンで追加する。
+    削除されたエンティティはdeleted=Trueの行（トゥームストーン）として残り、保持期間を過ぎると削除される。
+    """
+    __tablename__ = "change_log"
+    
+    # AUTOINCREMENTにより、削除された行のリビジョンが再利用されない
+    revision = Column(Integer, primary_key=True, autoincrement=True)
+    site_id = Column(String, nullable=False, default=DEFAULT_SITE_ID, server_default=DEFAULT_SITE_ID)
+    # device / schedule
+    entity_type = Column(String, nullable=False)
+    entity_id = Column(CompactId, nullable=False)
+    deleted = Column(Boolean, nullable=False, default=False)
+    changed_at = Column(DateTime, default=datetime.now)
+    
+    __table_args__ = (
+        # エンティティごとの最新行の置き換え用
+        Index("ix_change_log_entity", "entity_type", "entity_id", unique=True),
+        # サイトごとの差分取得用
+        Index("ix_change_log_site_id_revision", "site_id", "revision"),
+        {"sqlite_autoincrement": True},
+    )
+
+class ChangeLogWatermark(Base):
+    """サイトごとに削除済みのトゥームストーンの最大リビジョン
+
+    これより前のリビジョンから差分を取得すると削除を取りこぼすため、全件の再取得が必要になる。
+    """
+    __tablename__ = "change_log_watermarks"
+    
+    site_id = Column(String, primary_key=True)
+    pruned_revision = Column(Integer, nullable=False, default=0)
@@ -1,84 +1,522 @@
+from contextlib import contextmanager
 from datetime import datetime
+from sqlalchemy import and_, or_, func, delete, insert, select, update, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from typing import List, Optional
-from application.repositories import DeviceRepository, ScheduleRepository
-from infrastructure.models import Device, Schedule
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from application.repositories import (
+    DeviceRepository, ScheduleRepository, DeviceTagRepository, ChangeLogRepository, StateEventRepository, UsageRollupRepository,
+    ScheduleLoadRow, UnitOfWork, VersionConflictError, CHANGE_ENTITY_DEVICE, CHANGE_ENTITY_SCHEDULE
+)
+from infrastructure.database import SITE_ID, SessionLocal, session_scope
+from infrastructure.models import DEFAULT_SITE_ID, Device, DeviceTag, Schedule, StateEvent, DeviceUsage, DeviceUsageState, ChangeLog, ChangeLogWatermark
+
+# PostgreSQLで変更履歴の書き込みを直列化するアドバイザリロックのキー
+CHANGE_LOG_LOCK_KEY = 0x6171756100
+
+def _record_change(session: Session, site_id: str, entity_type: str, entity_id: str, deleted: bool = False) -> None:
+    """エンティティの変更を新しいリビジョンで記録し、同じエンティティの古い行を削除する"""
+    _record_changes(session, site_id, {entity_type: [entity_id]}, deleted)
+
+def _record_changes(session: Session, site_id: str, entity_ids: Dict[str, List[str]], deleted: bool = False) -> None:
+    """エンティティ種別ごとのIDの変更をまとめて記録する（古い行の削除と追加をそれぞれ1文で行う）"""
+    entity_ids = {entity_type: ids for entity_type, ids in entity_ids.items() if ids}
+    if not entity_ids:
+        return
+    if session.get_bind().dialect.name == "postgresql":
+        # シーケンスの採番順とコミット順がずれると、差分取得で変更を取りこぼすため
+        # トランザクション終了まで変更履歴の書き込みを直列化する（SQLiteは書き込みが常に直列）
+        session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": CHANGE_LOG_LOCK_KEY})
+    session.execute(delete(ChangeLog).where(or_(*(
+        and_(ChangeLog.entity_type == entity_type, ChangeLog.entity_id.in_(ids))
+        for entity_type, ids in entity_ids.items()
+    ))))
+    changed_at = datetime.now()
+    session.execute(insert(ChangeLog), [
+        {"site_id": site_id, "entity_type": entity_type, "entity_id": entity_id, "deleted": deleted, "changed_at": changed_at}
+        for entity_type, ids in entity_ids.items()
+        for entity_id in ids
+    ])
+
+def _prefix_upper_bound(prefix: str) -> Optional[str]:
+    """prefixで始まる文字列より大きい最小の文字列（末尾の文字を1つ進めたもの）"""
+    if not prefix or ord(prefix[-1]) >= 0x10FFFF:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
 
 class SQLAlchemyDeviceRepository(DeviceRepository):
-    def __init__(self, session: Session):
+    def __init__(self, session: Session, auto_commit: bool = True, site_id: str = DEFAULT_SITE_ID):
         self.session = session
+        # Falseの場合はflushのみ行い、コミットはUnitOfWorkに任せる
+        self.auto_commit = auto_commit
+        # 他のサイトのデバイスは存在しないものとして扱う
+        self.site_id = site_id
+
+    def _commit(self) -> None:
+        if self.auto_commit:
+            self.session.commit()
+        else:
+            self.session.flush()
 
     def create(self, device_id: str, device_name: str, gpio_number: int) -> None:
         device = Device(
             device_id=device_id,
+            site_id=self.site_id,
             device_name=device_name,
             gpio_number=gpio_number
         )
         self.session.add(device)
-        self.session.commit()
-        self.session.refresh(device)
+        _record_change(self.session, self.site_id, CHANGE_ENTITY_DEVICE, device_id)
+        self._commit()
+        if self.auto_commit:
+            self.session.refresh(device)
+
+    def _query(self):
+        return self.session.query(Device).filter(Device.site_id == self.site_id)
+
+    def _get(self, device_id: str) -> Optional[Device]:
+        device = self.session.get(Device, device_id)
+        return device if device is not None and device.site_id == self.site_id else None
 
     def find_all(self) -> List[Device]:
-        return self.session.query(Device).all()
+        return self._query().order_by(Device.created_at, Device.device_id).all()
+
+    def find_page(self, limit: int, after: Optional[Tuple[datetime, str]] = None) -> List[Device]:
+        query = self._query()
+        if after is not None:
+            created_at, device_id = after
+            query = query.filter(or_(
+                Device.created_at > created_at,
+                and_(Device.created_at == created_at, Device.device_id > device_id)
+            ))
+        return query.order_by(Device.created_at, Device.device_id).limit(limit).all()
+
+    def iter_all(self, batch_size: int = 500) -> Iterator[Device]:
+        query = self._query().order_by(Device.created_at, Device.device_id)
+        for device in query.yield_per(batch_size):
+            yield device
 
     def find_by_id(self, device_id: str) -> Optional[Device]:
-        return self.session.query(Device).filter(Device.device_id == device_id).first()
+        # 同じUnitOfWork内で作成・取得済みのデバイスはSQLを発行せずに返す
+        return self._get(device_id)
+
+    def find_by_ids(self, device_ids: Iterable[str]) -> List[Device]:
+        device_ids = list(device_ids)
+        if not device_ids:
+            return []
+        return self._query().filter(Device.device_id.in_(device_ids)).all()
+
+    def search_by_name(self, prefix: str, limit: int) -> List[Device]:
+        prefix = prefix.lower()
+        name = func.lower(Device.device_name)
+        # 式インデックスを範囲検索で使えるよう、前方一致を「prefix以上、prefixの次の文字列未満」で表す
+        query = self._query().filter(name >= prefix)
+        upper = _prefix_upper_bound(prefix)
+        if upper is not None:
+            query = query.filter(name < upper)
+        # 照合順序がバイト順でないDB（PostgreSQLのロケールなど）でも結果が前方一致になるよう、LIKEでも絞り込む
+        escaped = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        query = query.filter(name.like(escaped + "%", escape="\\"))
+        return query.order_by(name, Device.device_id).limit(limit).all()
 
     def update_timestamp(self, device_id: str) -> None:
-        device = self.session.query(Device).filter(Device.device_id == device_id).first()
+        # 直前に取得済みのデバイスはセッションから返し、再検索のSQLを発行しない
+        device = self._get(device_id)
         if device:
             device.updated_at = datetime.now()
-            self.session.commit()
+            _record_change(self.session, self.site_id, CHANGE_ENTITY_DEVICE, device_id)
+            self._commit()
 
-    def delete(self, device_id: str) -> bool:
-        device = self.session.query(Device).filter(Device.device_id == device_id).first()
-        if device:
-            self.session.delete(device)
-            self.session.commit()
-            return True
-        return False
+    def update_timestamps(self, device_ids: Iterable[str]) -> None:
+        device_ids = list(device_ids)
+        if not device_ids:
+            return
+        self.session.execute(
+            update(Device).where(Device.site_id == self.site_id, Device.device_id.in_(device_ids)).values(updated_at=datetime.now())
+        )
+        _record_changes(self.session, self.site_id, {CHANGE_ENTITY_DEVICE: device_ids})
+        self._commit()
 
-    def update_device(self, device_id: str, device_name: Optional[str] = None, gpio_number: Optional[int] = None) -> bool:
-        device = self.session.query(Device).filter(Device.device_id == device_id).first()
-        if device:
-            if device_name is not None:
-                device.device_name = device_name
-            if gpio_number is not None:
-                device.gpio_number = gpio_number
-            device.updated_at = datetime.now()
-            self.session.commit()
-            return True
-        return False
+    def delete(self, device_id: str, expected_version: Optional[int] = None) -> bool:
+        statement = delete(Device).where(Device.site_id == self.site_id, Device.device_id == device_id)
+        if expected_version is not None:
+            statement = statement.where(Device.version == expected_version)
+        if not self._delete_cascade(statement, [device_id]):
+            if expected_version is not None and self._get(device_id) is not None:
+                raise VersionConflictError(f"Device {device_id} is not at version {expected_version}")
+            return False
+        self._commit()
+        return True
+
+    def delete_many(self, device_ids: Iterable[str], expected_versions: Optional[Dict[str, int]] = None) -> List[str]:
+        device_ids = list(device_ids)
+        if not device_ids:
+            return []
+        versioned = {device_id: version for device_id, version in (expected_versions or {}).items() if device_id in device_ids}
+        # バージョンの指定がないデバイスはIDだけ、指定があるデバイスはバージョンも一致する場合だけ削除する
+        condition = Device.device_id.in_([device_id for device_id in device_ids if device_id not in versioned])
+        if versioned:
+            condition = or_(condition, *(
+                and_(Device.device_id == device_id, Device.version == version) for device_id, version in versioned.items()
+            ))
+        deleted_ids = self._delete_cascade(delete(Device).where(Device.site_id == self.site_id, condition), device_ids)
+        if deleted_ids:
+            self._commit()
+        return deleted_ids
+
+    def _delete_cascade(self, statement, device_ids: List[str]) -> List[str]:
+        """デバイスを削除し、ON DELETE CASCADEで一緒に削除されるスケジュールも含めて墓標を記録する"""
+        schedules = self.session.execute(
+            select(Schedule.schedule_id, Schedule.device_id).where(Schedule.device_id.in_(device_ids))
+        ).all()
+        if self.session.get_bind().dialect.delete_returning:
+            deleted_ids = list(self.session.execute(statement.returning(Device.device_id)).scalars())
+        else:
+            # DELETE ... RETURNINGのないDB（SQLite 3.35未満など）では、同じ条件で削除対象を読んでから削除する
+            # （SQLiteでは読み取り後に他の書き込みがコミットされると削除がSQLITE_BUSYで失敗するため、読んだ行と削除した行は一致する）
+            deleted_ids = list(self.session.execute(
+                select(Device.device_id).where(statement.whereclause).with_for_update()
+            ).scalars())
+            if deleted_ids:
+                self.session.execute(statement.where(Device.device_id.in_(deleted_ids)))
+        if deleted_ids:
+            deleted = set(deleted_ids)
+            _record_changes(self.session, self.site_id, {
+                CHANGE_ENTITY_DEVICE: deleted_ids,
+                CHANGE_ENTITY_SCHEDULE: [schedule_id for schedule_id, device_id in schedules if device_id in deleted]
+            }, deleted=True)
+        return deleted_ids
+
+    def update_device(self, device_id: str, device_name: Optional[str] = None, gpio_number: Optional[int] = None, expected_version: Optional[int] = None) -> bool:
+        values = {"updated_at": datetime.now(), "version": Device.version + 1}
+        if device_name is not None:
+            values["device_name"] = device_name
+        if gpio_number is not None:
+            values["gpio_number"] = gpio_number
+        # 読み込み後に他の更新が入っていれば0件になる（UPDATE ... WHERE version = ?）
+        statement = update(Device).where(Device.site_id == self.site_id, Device.device_id == device_id)
+        if expected_version is not None:
+            statement = statement.where(Device.version == expected_version)
+        if self.session.execute(statement.values(**values)).rowcount == 0:
+            if expected_version is not None and self._get(device_id) is not None:
+                raise VersionConflictError(f"Device {device_id} is not at version {expected_version}")
+            return False
+        _record_change(self.session, self.site_id, CHANGE_ENTITY_DEVICE, device_id)
+        self._commit()
+        return True
 
 class SQLAlchemyScheduleRepository(ScheduleRepository):
-    def __init__(self, session: Session):
+    def __init__(self, session: Session, auto_commit: bool = True, site_id: str = DEFAULT_SITE_ID):
         self.session = session
+        # Falseの場合はflushのみ行い、コミットはUnitOfWorkに任せる
+        self.auto_commit = auto_commit
+        self.site_id = site_id
+    
+    def _commit(self) -> None:
+        if self.auto_commit:
+            self.session.commit()
+        else:
+            self.session.flush()
     
     def save(self, schedule: Schedule) -> Schedule:
+        schedule.site_id = self.site_id
         self.session.add(schedule)
-        self.session.commit()
-        self.session.refresh(schedule)
+        _record_change(self.session, self.site_id, CHANGE_ENTITY_SCHEDULE, schedule.schedule_id)
+        self._commit()
+        if self.auto_commit:
+            self.session.refresh(schedule)
         return schedule
     
+    def _query(self):
+        return self.session.query(Schedule).filter(Schedule.site_id == self.site_id)
+    
+    def _get(self, schedule_id: str) -> Optional[Schedule]:
+        schedule = self.session.get(Schedule, schedule_id)
+        return schedule if schedule is not None and schedule.site_id == self.site_id else None
+    
     def find_all(self) -> List[Schedule]:
-        return self.session.query(Schedule).all()
+        return self._query().all()
+    
+    def find_all_with_devices(self) -> List[ScheduleLoadRow]:
+        # 件数が多いため、ORMのオブジェクトを作らず必要な列だけを取得する
+        rows = self.session.execute(
+            select(Schedule.schedule_id, Schedule.device_id, Device.gpio_number, Schedule.schedule, Schedule.is_on, Schedule.version)
+            .join(Device, Device.device_id == Schedule.device_id)
+            .where(Schedule.site_id == self.site_id)
+        )
+        return [ScheduleLoadRow(*row) for row in rows]
     
     def find_by_device_id(self, device_id: str) -> List[Schedule]:
-        return self.session.query(Schedule).filter(
+        return self._query().filter(
             Schedule.device_id == device_id
         ).order_by(Schedule.schedule).all()
     
+    def find_page_by_device_id(self, device_id: str, limit: int, after: Optional[Tuple[str, str]] = None) -> List[Schedule]:
+        query = self._query().filter(Schedule.device_id == device_id)
+        if after is not None:
+            schedule, schedule_id = after
+            query = query.filter(or_(
+                Schedule.schedule > schedule,
+                and_(Schedule.schedule == schedule, Schedule.schedule_id > schedule_id)
+            ))
+        return query.order_by(Schedule.schedule, Schedule.schedule_id).limit(limit).all()
+    
     def find_by_id(self, schedule_id: str) -> Optional[Schedule]:
-        return self.session.query(Schedule).filter(
-            Schedule.schedule_id == schedule_id
-        ).first()
-    
-    def delete(self, schedule_id: str) -> bool:
-        schedule = self.session.query(Schedule).filter(
-            Schedule.schedule_id == schedule_id
-        ).first()
-        if schedule:
-            self.session.delete(schedule)
+        return self._get(schedule_id)
+    
+    def find_by_ids(self, schedule_ids: Iterable[str]) -> List[Schedule]:
+        schedule_ids = list(schedule_ids)
+        if not schedule_ids:
+            return []
+        return self._query().filter(Schedule.schedule_id.in_(schedule_ids)).all()
+    
+    def update(self, schedule_id: str, schedule: Optional[str] = None, is_on: Optional[bool] = None, expected_version: Optional[int] = None) -> bool:
+        values = {"updated_at": datetime.now(), "version": Schedule.version + 1}
+        if schedule is not None:
+            values["schedule"] = schedule
+        if is_on is not None:
+            values["is_on"] = is_on
+        # 読み込み後に他の更新が入っていれば0件になる（UPDATE ... WHERE version = ?）
+        statement = update(Schedule).where(Schedule.site_id == self.site_id, Schedule.schedule_id == schedule_id)
+        if expected_version is not None:
+            statement = statement.where(Schedule.version == expected_version)
+        if self.session.execute(statement.values(**values)).rowcount == 0:
+            if expected_version is not None and self._get(schedule_id) is not None:
+                raise VersionConflictError(f"Schedule {schedule_id} is not at version {expected_version}")
+            return False
+        _record_change(self.session, self.site_id, CHANGE_ENTITY_SCHEDULE, schedule_id)
+        self._commit()
+        return True
+    
+    def delete(self, schedule_id: str, expected_version: Optional[int] = None) -> bool:
+        statement = delete(Schedule).where(Schedule.site_id == self.site_id, Schedule.schedule_id == schedule_id)
+        if expected_version is not None:
+            statement = statement.where(Schedule.version == expected_version)
+        if self.session.execute(statement).rowcount == 0:
+            if expected_version is not None and self._get(schedule_id) is not None:
+                raise VersionConflictError(f"Schedule {schedule_id} is not at version {expected_version}")
+            return False
+        _record_change(self.session, self.site_id, CHANGE_ENTITY_SCHEDULE, schedule_id, deleted=True)
+        self._commit()
+        return True
+
+class SQLAlchemyDeviceTagRepository(DeviceTagRepository):
+    def __init__(self, session: Session, auto_commit: bool = True, site_id: str = DEFAULT_SITE_ID):
+        self.session = session
+        # Falseの場合はflushのみ行い、コミットはUnitOfWorkに任せる
+        self.auto_commit = auto_commit
+        self.site_id = site_id
+    
+    def _commit(self) -> None:
+        if self.auto_commit:
             self.session.commit()
-            return True
-        return False
\ No newline at end of file
+        else:
+            self.session.flush()
+    
+    def set_tags(self, device_id: str, tags: List[str]) -> None:
+        self.session.execute(delete(DeviceTag).where(DeviceTag.site_id == self.site_id, DeviceTag.device_id == device_id))
+        if tags:
+            self.session.execute(insert(DeviceTag), [
+                {"site_id": self.site_id, "tag": tag, "device_id": device_id} for tag in tags
+            ])
+        # タグはデバイスの属性として変更履歴に記録する（他のワーカーのセレクターのキャッシュの無効化にも使う）
+        _record_change(self.session, self.site_id, CHANGE_ENTITY_DEVICE, device_id)
+        self._commit()
+    
+    def find_tags(self, device_id: str) -> List[str]:
+        return list(self.session.execute(
+            select(DeviceTag.tag).where(DeviceTag.site_id == self.site_id, DeviceTag.device_id == device_id).order_by(DeviceTag.tag)
+        ).scalars())
+    
+    def find_devices_by_tags(self, tags: List[str]) -> List[Device]:
+        tags = list(set(tags))
+        if not tags:
+            return []
+        # 転置索引 (site_id, tag, device_id) からすべてのタグを持つデバイスを絞り込む
+        matched = select(DeviceTag.device_id).where(
+            DeviceTag.site_id == self.site_id, DeviceTag.tag.in_(tags)
+        ).group_by(DeviceTag.device_id).having(func.count() == len(tags))
+        return self.session.query(Device).filter(
+            Device.site_id == self.site_id, Device.device_id.in_(matched)
+        ).order_by(Device.created_at, Device.device_id).all()
+
+class SQLAlchemyChangeLogRepository(ChangeLogRepository):
+    def __init__(self, session: Session, site_id: str = DEFAULT_SITE_ID):
+        self.session = session
+        self.site_id = site_id
+    
+    def find_since(self, since: int, limit: int) -> List[ChangeLog]:
+        return self.session.query(ChangeLog).filter(
+            ChangeLog.site_id == self.site_id,
+            ChangeLog.revision > since
+        ).order_by(ChangeLog.revision).limit(limit).all()
+    
+    def find_latest_revision(self) -> int:
+        return self.session.query(func.max(ChangeLog.revision)).filter(ChangeLog.site_id == self.site_id).scalar() or 0
+    
+    def find_pruned_revision(self) -> int:
+        watermark = self.session.get(ChangeLogWatermark, self.site_id)
+        return watermark.pruned_revision if watermark is not None else 0
+    
+    def prune_tombstones(self, before: datetime) -> int:
+        tombstones = (
+            ChangeLog.site_id == self.site_id,
+            ChangeLog.deleted.is_(True),
+            ChangeLog.changed_at < before
+        )
+        revision = self.session.query(func.max(ChangeLog.revision)).filter(*tombstones).scalar()
+        if revision is None:
+            return 0
+        deleted = self.session.query(ChangeLog).filter(*tombstones).delete(synchronize_session=False)
+        # 削除したトゥームストーンより前のリビジョンからの差分取得は、全件の再取得が必要になる
+        watermark = self.session.get(ChangeLogWatermark, self.site_id)
+        if watermark is None:
+            self.session.add(ChangeLogWatermark(site_id=self.site_id, pruned_revision=revision))
+        elif watermark.pruned_revision < revision:
+            watermark.pruned_revision = revision
+        return deleted
+
+class SQLAlchemyStateEventRepository(StateEventRepository):
+    def __init__(self, session: Session):
+        self.session = session
+    
+    def add_all(self, events: List[StateEvent]) -> None:
+        self.session.add_all(events)
+        self.session.commit()
+    
+    def find_by_device_id(self, device_id: str, start: Optional[datetime] = None, end: Optional[datetime] = None, limit: int = 1000) -> List[StateEvent]:
+        query = self.session.query(StateEvent).filter(StateEvent.device_id == device_id)
+        if start is not None:
+            query = query.filter(StateEvent.ts >= start)
+        if end is not None:
+            query = query.filter(StateEvent.ts < end)
+        return query.order_by(StateEvent.ts, StateEvent.event_id).limit(limit).all()
+    
+    def find_oldest_timestamp(self) -> Optional[datetime]:
+        return self.session.query(func.min(StateEvent.ts)).scalar()
+    
+    def delete_between(self, start: datetime, end: datetime) -> int:
+        deleted = self.session.query(StateEvent).filter(
+            StateEvent.ts >= start,
+            StateEvent.ts < end
+        ).delete(synchronize_session=False)
+        self.session.commit()
+        return deleted
+
+class SQLAlchemyUsageRollupRepository(UsageRollupRepository):
+    def __init__(self, session: Session):
+        self.session = session
+    
+    def find_states(self, device_ids: Iterable[str]) -> List[DeviceUsageState]:
+        device_ids = list(device_ids)
+        if not device_ids:
+            return []
+        return self.session.query(DeviceUsageState).filter(DeviceUsageState.device_id.in_(device_ids)).all()
+    
+    def apply_rollups(
+        self,
+        increments: Dict[Tuple[str, str, datetime], Tuple[float, int]],
+        states: Dict[str, Tuple[bool, datetime]],
+        expected_states: Optional[Dict[str, Optional[Tuple[bool, datetime]]]] = None
+    ) -> None:
+        try:
+            # 最新状態を読み込み時の値を条件に更新し、他のプロセスの集計との重複を検出する
+            for device_id, (is_on, since) in states.items():
+                expected = expected_states.get(device_id) if expected_states is not None else None
+                if expected_states is None:
+                    self.session.merge(DeviceUsageState(device_id=device_id, is_on=is_on, since=since))
+                elif expected is None:
+                    self.session.execute(insert(DeviceUsageState).values(device_id=device_id, is_on=is_on, since=since))
+                else:
+                    result = self.session.execute(
+                        update(DeviceUsageState)
+                        .where(
+                            DeviceUsageState.device_id == device_id,
+                            DeviceUsageState.is_on == expected[0],
+                            DeviceUsageState.since == expected[1]
+                        )
+                        .values(is_on=is_on, since=since)
+                    )
+                    if result.rowcount == 0:
+                        raise VersionConflictError(f"Usage state of {device_id} was updated concurrently")
+            
+            # 集計値はDB上の値に加算する（読み込んだ値を書き戻さない）
+            for (device_id, granularity, bucket_start), (on_seconds, switch_count) in increments.items():
+                result = self.session.execute(
+                    update(DeviceUsage)
+                    .where(
+                        DeviceUsage.device_id == device_id,
+                        DeviceUsage.granularity == granularity,
+                        DeviceUsage.bucket_start == bucket_start
+                    )
+                    .values(on_seconds=DeviceUsage.on_seconds + on_seconds, switch_count=DeviceUsage.switch_count + switch_count)
+                )
+                if result.rowcount == 0:
+                    self.session.execute(insert(DeviceUsage).values(
+                        device_id=device_id, granularity=granularity, bucket_start=bucket_start,
+                        on_seconds=on_seconds, switch_count=switch_count
+                    ))
+            self.session.commit()
+        except IntegrityError:
+            # 他のプロセスが同じ行を先に追加した
+            self.session.rollback()
+            raise VersionConflictError("Usage rollups were updated concurrently")
+        except VersionConflictError:
+            self.session.rollback()
+            raise
+    
+    def find_usage(self, device_id: str, granularity: str, start: datetime, end: datetime) -> List[DeviceUsage]:
+        return self.session.query(DeviceUsage).filter(
+            DeviceUsage.device_id == device_id,
+            DeviceUsage.granularity == granularity,
+            DeviceUsage.bucket_start >= start,
+            DeviceUsage.bucket_start < end
+        ).order_by(DeviceUsage.bucket_start).all()
+
+@contextmanager
+def device_repository_scope():
+    """バックグラウンドのジョブ1回分の短命なセッションでDeviceRepositoryを提供する"""
+    with session_scope() as db:
+        yield SQLAlchemyDeviceRepository(db, site_id=SITE_ID)
+
+@contextmanager
+def state_event_repository_scope():
+    """状態履歴の書き込みスレッド用のリポジトリを提供する"""
+    with session_scope() as db:
+        yield SQLAlchemyStateEventRepository(db)
+
+@contextmanager
+def usage_rollup_repository_scope():
+    """使用量集計の更新用のリポジトリを提供する"""
+    with session_scope() as db:
+        yield SQLAlchemyUsageRollupRepository(db)
+
+class SQLAlchemyUnitOfWork(UnitOfWork):
+    def __init__(self, session: Session, site_id: str = DEFAULT_SITE_ID):
+        self.session = session
+        self.devices = SQLAlchemyDeviceRepository(session, auto_commit=False, site_id=site_id)
+        self.schedules = SQLAlchemyScheduleRepository(session, auto_commit=False, site_id=site_id)
+        self.tags = SQLAlchemyDeviceTagRepository(session, auto_commit=False, site_id=site_id)
+        self.changes = SQLAlchemyChangeLogRepository(session, site_id)
+        self.state_events = SQLAlchemyStateEventRepository(session)
+        self.usage = SQLAlchemyUsageRollupRepository(session)
+    
+    def commit(self) -> None:
+        self.session.commit()
+    
+    def rollback(self) -> None:
+        self.session.rollback()
+
+@contextmanager
+def unit_of_work_scope():
+    """1リクエスト（または1回のバッチ処理）分のUnitOfWorkを提供する
+
+    コミットは呼び出し側が明示的に行う。例外時はロールバックし、常にセッションを閉じる。
+    コミット後にレスポンスを組み立てられるよう、コミット時に属性を失効させない。
+    """
+    db = SessionLocal(expire_on_commit=False)
+    try:
+        with SQLAlchemyUnitOfWork(db, SITE_ID) as unit_of_work:
+            yield unit_of_work
+    finally:
+        db.close()
@@ -0,0 +1,72 @@
+import atexit
+import os
+import threading
+from contextlib import contextmanager
+from typing import Callable, ContextManager, Optional
+from application.repositories import DeviceRepository, UnitOfWork
+from infrastructure.memory_repositories import (
+    DEFAULT_SNAPSHOT_THRESHOLD, InMemoryDeviceRepository, MemoryStore, memory_unit_of_work_scope, open_memory_store
+)
+from infrastructure.database import SITE_ID, session_scope
+from infrastructure.repositories import (
+    SQLAlchemyStateEventRepository, SQLAlchemyUsageRollupRepository, device_repository_scope, unit_of_work_scope
+)
+
+REPOSITORY_BACKEND_SQLALCHEMY = "sqlalchemy"
+REPOSITORY_BACKEND_MEMORY = "memory"
+
+_memory_store: Optional[MemoryStore] = None
+_memory_store_lock = threading.Lock()
+
+def get_repository_backend() -> str:
+    """環境変数REPOSITORY_BACKENDからデバイス・スケジュールの保存先を取得する"""
+    backend = os.getenv("REPOSITORY_BACKEND", REPOSITORY_BACKEND_SQLALCHEMY).lower()
+    if backend not in (REPOSITORY_BACKEND_SQLALCHEMY, REPOSITORY_BACKEND_MEMORY):
+        raise ValueError(f"Unknown REPOSITORY_BACKEND: {backend}")
+    return backend
+
+def get_memory_store() -> MemoryStore:
+    """プロセスで共有するMemoryStoreを取得する（初回にジャーナルを再生する）"""
+    global _memory_store
+    with _memory_store_lock:
+        if _memory_store is None:
+            _memory_store = open_memory_store(
+                os.getenv("MEMORY_STORE_DIR", "./aquamarine_store"),
+                int(os.getenv("MEMORY_SNAPSHOT_THRESHOLD", str(DEFAULT_SNAPSHOT_THRESHOLD))),
+                SITE_ID
+            )
+            atexit.register(_memory_store.close)
+        return _memory_store
+
+def create_unit_of_work_scope() -> Callable[[], ContextManager[UnitOfWork]]:
+    """
+    設定されたバックエンドのUnitOfWorkを提供するファクトリを作成する
+
+    Returns:
+        Callable: memoryならMemoryStore、そうでなければSQLAlchemyのUnitOfWorkを提供するファクトリ
+    """
+    if get_repository_backend() == REPOSITORY_BACKEND_MEMORY:
+        store = get_memory_store()
+
+        @contextmanager
+        def memory_scope():
+            # 状態履歴・使用量はmemoryの場合もデータベースにある（セッションは最初の問い合わせまで接続しない）
+            with session_scope() as db, memory_unit_of_work_scope(store) as unit_of_work:
+                unit_of_work.state_events = SQLAlchemyStateEventRepository(db)
+                unit_of_work.usage = SQLAlchemyUsageRollupRepository(db)
+                yield unit_of_work
+        return memory_scope
+    return unit_of_work_scope
+
+def create_device_repository_scope() -> Callable[[], ContextManager[DeviceRepository]]:
+    """
+    バックグラウンドのジョブ用に、設定されたバックエンドのDeviceRepositoryを提供するファクトリを作成する
+    """
+    if get_repository_backend() == REPOSITORY_BACKEND_MEMORY:
+        store = get_memory_store()
+
+        @contextmanager
+        def memory_device_repository_scope():
+            yield InMemoryDeviceRepository(store)
+        return memory_device_repository_scope
+    return device_repository_scope
@@ -0,0 +1,295 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import tempfile
+import threading
+from typing import Any, Callable, List, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Windowsなどfcntlがない環境では1プロセスで動かす前提で常にリーダーになる
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# 他のワーカーからリーダーに転送できる実行サービスのメソッド
+SCHEDULE_CHANNEL_OPERATIONS = (
+    "add_schedule", "update_schedule", "remove_schedule", "remove_device_schedules", "get_metrics", "request_resync"
+)
+
+class SchedulerUnavailableError(RuntimeError):
+    """リーダーの実行サービスに変更を転送できなかった（リーダーの交代中など）"""
+
+def runtime_path(name: str) -> str:
+    """ロックファイル・ソケットを置くランタイム用ディレクトリのパス
+
+    XDG_RUNTIME_DIR（なければ一時ディレクトリにユーザーごとに作るディレクトリ）を使う。
+    他のユーザーがソケットに接続できないよう、所有者だけが使える（0700）ディレクトリでなければRuntimeError。
+    """
+    directory = os.getenv("XDG_RUNTIME_DIR")
+    if not directory:
+        directory = os.path.join(tempfile.gettempdir(), f"aquamarine-{os.getuid()}")
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) & 0o077:
+        raise RuntimeError(f"Runtime directory is not private to the current user: {directory}")
+    return os.path.join(directory, name)
+
+class FileLeaderLock:
+    """同じホストのプロセスのうち1つだけが取得できるファイルロック（fcntl.flock）
+
+    ロックはプロセスの終了時にOSが解放するため、リーダーが異常終了しても他のプロセスが引き継げる。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    @property
+    def held(self) -> bool:
+        return self._file is not None
+
+    def try_acquire(self) -> bool:
+        """待たずにロックを取得し、取得できたかを返す"""
+        if self._file is not None:
+            return True
+        lock_file = open(self.path, "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+        self._file = lock_file
+        return True
+
+    def release(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class _ChannelHandler(socketserver.StreamRequestHandler):
+    """1行1リクエストのJSON（{"op": メソッド名, "args": [...]}）を受け取り、1行のJSONで結果を返す"""
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                operation = request["op"]
+                if operation not in SCHEDULE_CHANNEL_OPERATIONS:
+                    raise ValueError(f"Unknown operation: {operation}")
+                result = getattr(self.server.executor, operation)(*request.get("args", []))
+                response = {"result": result}
+            except Exception as e:
+                response = {"error": str(e)}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+class ScheduleChannelServer:
+    """リーダーのプロセスで、他のワーカーから転送されたスケジュールの変更を実行サービスに反映する（Unixドメインソケット）"""
+
+    def __init__(self, path: str, executor: Any):
+        self.path = path
+        self.executor = executor
+        self._server: Optional[socketserver.ThreadingUnixStreamServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        # 前のリーダーが異常終了して残ったソケットを消す（ロックを持つリーダーだけが呼ぶ）
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = socketserver.ThreadingUnixStreamServer(self.path, _ChannelHandler)
+        # 同じユーザーのプロセスだけが変更を転送できるようにする
+        os.chmod(self.path, 0o600)
+        self._server.daemon_threads = True
+        self._server.executor = self.executor
+        self._thread = threading.Thread(target=self._server.serve_forever, name="schedule-channel", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+class RemoteScheduleExecutor:
+    """リーダー以外のワーカーで、スケジュールの変更をリーダーの実行サービスに転送する
+
+    ScheduleExecutorServiceの変更系のメソッドと同じ呼び出し方ができる。リーダーが処理中に
+    失敗した場合は同じくValueErrorになる。リーダーに接続できない場合（リーダーの交代中など）は
+    次に接続できたときにリーダーにDBとの差分の反映（resync）を要求する。登録・更新は
+    SchedulerUnavailableErrorにし、削除は残ったジョブがresyncで取り除かれるため成功として扱う。
+    変更はDBにコミット済みのため、差分の反映（または新しいリーダーの起動時の読み込み）で取り込まれる。
+    """
+
+    def __init__(self, path: str, timeout: float = 5.0):
+        self.path = path
+        self.timeout = timeout
+        # 転送できなかった変更があり、リーダーにresyncを要求する必要があるか
+        self._resync_pending = False
+        self._lock = threading.Lock()
+
+    def _send(self, operation: str, *args: Any) -> Any:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+                connection.settimeout(self.timeout)
+                connection.connect(self.path)
+                connection.sendall(json.dumps({"op": operation, "args": list(args)}).encode() + b"\n")
+                with connection.makefile("rb") as reader:
+                    line = reader.readline()
+        except OSError as e:
+            raise SchedulerUnavailableError(f"Failed to forward {operation} to the scheduler leader: {e}") from e
+        if not line:
+            raise SchedulerUnavailableError(f"Scheduler leader closed the channel during {operation}")
+        response = json.loads(line)
+        if "error" in response:
+            raise ValueError(response["error"])
+        return response["result"]
+
+    def _call(self, operation: str, *args: Any) -> Any:
+        self.flush()
+        try:
+            return self._send(operation, *args)
+        except SchedulerUnavailableError as e:
+            with self._lock:
+                self._resync_pending = True
+            logger.error(f"{e}; a resync will be requested when the leader is reachable")
+            raise
+
+    def flush(self) -> bool:
+        """転送できなかった変更があれば、リーダーにresyncを要求する（要求が不要か、要求できた場合はTrue）"""
+        with self._lock:
+            if not self._resync_pending:
+                return True
+            self._resync_pending = False
+        try:
+            self._send("request_resync")
+        except (SchedulerUnavailableError, ValueError) as e:
+            with self._lock:
+                self._resync_pending = True
+            logger.warning(f"Failed to request a schedule resync from the leader: {e}")
+            return False
+        logger.info("Requested a schedule resync from the leader after failed forwards")
+        return True
+
+    def add_schedule(self, schedule_id: str, device_id: str, schedule_time: str, is_on: bool, version: Optional[int] = None) -> None:
+        self._call("add_schedule", schedule_id, device_id, schedule_time, is_on, version)
+
+    def update_schedule(self, schedule_id: str, device_id: str, schedule_time: str, is_on: bool, version: Optional[int] = None) -> None:
+        self._call("update_schedule", schedule_id, device_id, schedule_time, is_on, version)
+
+    def remove_schedule(self, schedule_id: str) -> None:
+        try:
+            self._call("remove_schedule", schedule_id)
+        except SchedulerUnavailableError:
+            # DBからは削除済みのため、残ったジョブは要求したresyncで取り除かれる
+            pass
+
+    def remove_device_schedules(self, device_ids: List[str]) -> int:
+        """リーダーで削除したジョブ数（接続できない場合は0とし、resyncで取り除く）"""
+        try:
+            return self._call("remove_device_schedules", list(device_ids))
+        except SchedulerUnavailableError:
+            return 0
+
+    def request_resync(self) -> bool:
+        """リーダーにresyncを要求する（接続できない場合は、次に接続できたときに要求する）"""
+        with self._lock:
+            self._resync_pending = True
+        self.flush()
+        return True
+
+    def get_metrics(self) -> dict:
+        """リーダーのスケジューラーの集計（接続できない場合はrunning=False）"""
+        try:
+            return self._send("get_metrics")
+        except SchedulerUnavailableError:
+            return {"running": False}
+
+class SchedulerLeadership:
+    """複数のワーカープロセスのうち、1つだけがスケジュールの実行サービスを動かすためのリーダー選出
+
+    ファイルロックを取得できたプロセスがリーダーになり、executor_factoryで実行サービスを作って開始し、
+    ローカルのチャネルで他のワーカーからの変更を受け付ける。取得できなかったプロセスは変更をリーダーに
+    転送しながら、retry_interval秒ごとにロックの取得を試み、リーダーが停止した場合は引き継ぐ。
+    """
+
+    def __init__(self, lock_path: str, socket_path: str, executor_factory: Callable[[], Any], retry_interval: float = 5.0):
+        self.lock = FileLeaderLock(lock_path)
+        self.socket_path = socket_path
+        self.executor_factory = executor_factory
+        self.retry_interval = retry_interval
+        # リーダーでは実行サービス、それ以外ではRemoteScheduleExecutor（開始前はNone）
+        self.executor: Optional[Any] = None
+        self._server: Optional[ScheduleChannelServer] = None
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def is_leader(self) -> bool:
+        # ロックの取得後、実行サービスとチャネルの開始までは引き継ぎ中としてリーダーとみなさない
+        return self._server is not None
+
+    def start(self) -> None:
+        self._stopped.clear()
+        try:
+            if self._try_lead():
+                return
+            logger.info(f"Scheduler runs in another worker; forwarding schedule changes to {self.socket_path}")
+        except Exception as e:
+            # リーダーになれなくてもワーカーの起動は続け、他のワーカーへの転送とロックの再取得を試みる
+            logger.error(f"Failed to start the scheduler as leader; retrying every {self.retry_interval}s: {e}")
+        self.executor = RemoteScheduleExecutor(self.socket_path)
+        self._thread = threading.Thread(target=self._retry, name="scheduler-election", daemon=True)
+        self._thread.start()
+
+    def _try_lead(self) -> bool:
+        if not self.lock.try_acquire():
+            return False
+        executor = None
+        try:
+            executor = self.executor_factory()
+            server = ScheduleChannelServer(self.socket_path, executor)
+            server.start()
+        except Exception:
+            if executor is not None and executor.scheduler.running:
+                executor.scheduler.shutdown(wait=False)
+            self.lock.release()
+            raise
+        self.executor = executor
+        self._server = server
+        logger.info(f"Elected as scheduler leader (pid={os.getpid()})")
+        return True
+
+    def _retry(self) -> None:
+        while not self._stopped.wait(self.retry_interval):
+            try:
+                if self._try_lead():
+                    return
+            except Exception as e:
+                logger.warning(f"Failed to take over the scheduler: {e}")
+            # 新しい変更の転送がなくても、転送できなかった変更をリーダーに取り込ませる
+            executor = self.executor
+            if isinstance(executor, RemoteScheduleExecutor):
+                executor.flush()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+            if self.executor.scheduler.running:
+                self.executor.scheduler.shutdown(wait=False)
+        self.lock.release()
+        self.executor = None
@@ -1,85 +1,317 @@
-from fastapi import FastAPI, HTTPException, Depends
-from sqlalchemy.orm import Session
-from application.services import DeviceService, GPIOService, ScheduleService, ScheduleExecutorService
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import FrozenSet, Iterator, List, Literal, Optional
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from application.repositories import UnitOfWork
+from application.services import (
+    ChangeFeedService, DeviceGroupService, DeviceSelectorCache, DeviceService, ExpectedStateService, GPIOService, ScheduleService, ScheduleExecutorService,
+    ScheduleTimeline,
+    StateEventRecorder, StateHistoryService, UsageService, UsageRollupUpdater,
+    DEFAULT_PAGE_LIMIT, DEFAULT_SWITCH_THRESHOLD, MAX_PAGE_LIMIT
+)
 from application.models import (
     DeviceRegisterRequest, DeviceRegisterResponse, DeviceListResponse,
     DeviceStatusResponse, GPIOStatusResponse, DeviceDeleteResponse,
+    DeviceBulkDeleteRequest, DeviceBulkDeleteResponse,
+    DeviceTagsRequest, DeviceTagsResponse, DeviceGroupRequest, DeviceGroupStateResponse,
     DeviceUpdateRequest, DeviceUpdateResponse, ScheduleCreateRequest,
-    ScheduleCreateResponse, ScheduleListResponse
+    ScheduleCreateResponse, ScheduleUpdateRequest, ScheduleUpdateResponse, ScheduleListResponse, StateEventListResponse,
+    DeviceUsageResponse, ChangesResponse, DeviceExpectedStateResponse, ExpectedStateListResponse, ScheduleAnalysisResponse
 )
-from infrastructure.database import get_db
-from infrastructure.repositories import SQLAlchemyDeviceRepository, SQLAlchemyScheduleRepository
+from infrastructure.repositories import state_event_repository_scope, usage_rollup_repository_scope
+from infrastructure.repository_factory import create_unit_of_work_scope
+from infrastructure.instrumentation import query_stats_registry, start_query_stats, stop_query_stats
+from infrastructure.scheduler_leadership import SchedulerLeadership, runtime_path
 from hardware.gpio_factory import create_gpio_controller
 import os
-from aquamarine import schedule_executor
-
-app = FastAPI(title="Aquamarine IoT API", version="1.0.0")
+from aquamarine import create_schedule_executor
 
+state_event_recorder = StateEventRecorder(
+    state_event_repository_scope,
+    retention_days=int(os.getenv("STATE_EVENT_RETENTION_DAYS", "30")),
+    listeners=[UsageRollupUpdater(usage_rollup_repository_scope)]
+)
 
 gpio_controller = create_gpio_controller()
 
-def get_device_service(db: Session = Depends(get_db)) -> DeviceService:
-    device_repository = SQLAlchemyDeviceRepository(db)
-    return DeviceService(device_repository, gpio_controller)
+# ワーカーのうち1つだけがスケジュールを実行し、他のワーカーは変更をリーダーに転送する
+scheduler_leadership = SchedulerLeadership(
+    os.getenv("SCHEDULER_LOCK_FILE") or runtime_path("aquamarine_scheduler.lock"),
+    os.getenv("SCHEDULER_SOCKET") or runtime_path("aquamarine_scheduler.sock"),
+    lambda: create_schedule_executor(gpio_controller, state_event_recorder)
+)
+
+def is_scheduler_enabled() -> bool:
+    """環境変数SCHEDULER_ENABLEDでスケジュールの実行を無効にできる（テストなど）"""
+    return os.getenv("SCHEDULER_ENABLED", "true").lower() == "true"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    state_event_recorder.start()
+    scheduler_enabled = is_scheduler_enabled()
+    if scheduler_enabled:
+        scheduler_leadership.start()
+    yield
+    if scheduler_enabled:
+        scheduler_leadership.stop()
+    state_event_recorder.stop()
+
+app = FastAPI(title="Aquamarine IoT API", version="1.0.0", lifespan=lifespan)
+
+# ルートに一致しないリクエストのSQL集計のキー
+UNMATCHED_ROUTE_KEY = "<unmatched>"
+
+@app.middleware("http")
+async def query_stats_middleware(request: Request, call_next):
+    """リクエストごとのSQL発行数・DB時間を集計し、レスポンスヘッダーに付与する"""
+    stats, token = start_query_stats()
+    try:
+        response = await call_next(request)
+    finally:
+        stop_query_stats(token)
+    
+    response.headers["X-DB-Query-Count"] = str(stats.query_count)
+    response.headers["X-DB-Commit-Count"] = str(stats.commit_count)
+    response.headers["X-DB-Time-Ms"] = f"{stats.total_time_ms:.2f}"
+    
+    route = request.scope.get("route")
+    # ルートに一致しないリクエスト（404の探索など）は1つのキーにまとめ、集計が際限なく増えないようにする
+    key = f"{request.method} {route.path}" if route is not None else UNMATCHED_ROUTE_KEY
+    query_stats_registry.record(key, stats)
+    return response
 
-def get_gpio_service() -> GPIOService:
-    return GPIOService(gpio_controller)
+def require_debug_endpoints() -> None:
+    """環境変数DEBUG_ENDPOINTS_ENABLEDがtrueの場合だけデバッグ用のエンドポイントを公開する（それ以外は404）"""
+    if os.getenv("DEBUG_ENDPOINTS_ENABLED", "false").lower() != "true":
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+# デバイス・スケジュールの保存先（REPOSITORY_BACKEND）に応じたUnitOfWork
+unit_of_work_scope = create_unit_of_work_scope()
+# タグのセレクターから解決したデバイスのキャッシュ（このノードのサイト分のみ）
+device_selector_cache = DeviceSelectorCache()
+# デバイスごとのスケジュールの切り替えの索引（期待される状態の問い合わせ用）
+schedule_timeline = ScheduleTimeline()
+
+def get_unit_of_work() -> Iterator[UnitOfWork]:
+    """リクエスト単位のUnitOfWork（サービスがまとめて1回コミットし、例外時はロールバック）"""
+    with unit_of_work_scope() as unit_of_work:
+        yield unit_of_work
 
 def get_schedule_executor_service() -> ScheduleExecutorService:
-    """ScheduleExecutorServiceを取得"""
-    return schedule_executor
+    """ScheduleExecutorServiceを取得（リーダー以外のワーカーではリーダーへの転送、無効の場合はNone）"""
+    return scheduler_leadership.executor
+
+def get_device_service(unit_of_work: UnitOfWork = Depends(get_unit_of_work), schedule_executor: ScheduleExecutorService = Depends(get_schedule_executor_service)) -> DeviceService:
+    return DeviceService(unit_of_work.devices, gpio_controller, state_event_recorder, unit_of_work, schedule_executor, device_selector_cache, schedule_timeline)
+
+def get_device_group_service(unit_of_work: UnitOfWork = Depends(get_unit_of_work)) -> DeviceGroupService:
+    return DeviceGroupService(unit_of_work.devices, unit_of_work.tags, gpio_controller, device_selector_cache, state_event_recorder, unit_of_work, unit_of_work.changes)
+
+def get_state_history_service(unit_of_work: UnitOfWork = Depends(get_unit_of_work)) -> StateHistoryService:
+    return StateHistoryService(unit_of_work.state_events, unit_of_work.devices, state_event_recorder)
+
+def get_usage_service(unit_of_work: UnitOfWork = Depends(get_unit_of_work)) -> UsageService:
+    # 未集計のイベントを反映してから問い合わせる
+    state_event_recorder.flush()
+    return UsageService(unit_of_work.usage, unit_of_work.devices)
+
+def get_gpio_service(unit_of_work: UnitOfWork = Depends(get_unit_of_work)) -> GPIOService:
+    return GPIOService(gpio_controller, unit_of_work.devices, state_event_recorder)
 
-def get_schedule_service(db: Session = Depends(get_db), schedule_executor: ScheduleExecutorService = Depends(get_schedule_executor_service)) -> ScheduleService:
-    schedule_repository = SQLAlchemyScheduleRepository(db)
-    device_repository = SQLAlchemyDeviceRepository(db)
-    return ScheduleService(schedule_repository, device_repository, schedule_executor)
+def get_schedule_service(unit_of_work: UnitOfWork = Depends(get_unit_of_work), schedule_executor: ScheduleExecutorService = Depends(get_schedule_executor_service)) -> ScheduleService:
+    return ScheduleService(unit_of_work.schedules, unit_of_work.devices, schedule_executor, unit_of_work, schedule_timeline)
+
+def get_expected_state_service(unit_of_work: UnitOfWork = Depends(get_unit_of_work)) -> ExpectedStateService:
+    return ExpectedStateService(schedule_timeline, unit_of_work.schedules, unit_of_work.devices, gpio_controller, unit_of_work.changes)
+
+def get_change_feed_service(unit_of_work: UnitOfWork = Depends(get_unit_of_work)) -> ChangeFeedService:
+    return ChangeFeedService(unit_of_work.changes, unit_of_work.devices, unit_of_work.schedules, gpio_controller)
+
+def get_expected_versions(if_match: Optional[str] = Header(None)) -> Optional[FrozenSet[int]]:
+    """If-Matchヘッダー（ETag: "バージョン" のカンマ区切りのリスト）から更新・削除の前提となるバージョンを取得する
+
+    If-Matchは強い比較のため、弱いETag（W/"3"）はどのバージョンにも一致しない（すべて弱い場合は412になる）。
+    """
+    if if_match is None or if_match.strip() == "*":
+        return None
+    versions = set()
+    for etag in if_match.split(","):
+        etag = etag.strip()
+        weak = etag.startswith("W/")
+        if weak:
+            etag = etag[2:]
+        if len(etag) < 3 or not (etag.startswith('"') and etag.endswith('"')) or not etag[1:-1].isdigit():
+            raise HTTPException(status_code=400, detail="Invalid If-Match header")
+        if not weak:
+            versions.add(int(etag[1:-1]))
+    return frozenset(versions)
+
+def _set_etag(response: Response, version: int) -> None:
+    response.headers["ETag"] = f'"{version}"'
 
 @app.post("/device/register", response_model=DeviceRegisterResponse)
 def register_device(
     request: DeviceRegisterRequest,
+    response: Response,
     service: DeviceService = Depends(get_device_service)
 ):
-    return service.register_device(request)
+    result = service.register_device(request)
+    _set_etag(response, result.version)
+    return result
 
 @app.get("/device/list", response_model=DeviceListResponse)
-def get_device_list(service: DeviceService = Depends(get_device_service)):
-    return service.get_device_list()
+def get_device_list(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    service: DeviceService = Depends(get_device_service)
+):
+    return service.get_device_list(limit, cursor)
+
+@app.get("/device/search", response_model=DeviceListResponse)
+def search_devices(
+    q: str = Query(..., min_length=1, max_length=255),
+    limit: int = Query(DEFAULT_PAGE_LIMIT, ge=1, le=MAX_PAGE_LIMIT),
+    service: DeviceService = Depends(get_device_service)
+):
+    """デバイス名の前方一致（大文字小文字を区別しない）で検索する（例: ?q=living）"""
+    return service.search_devices(q, limit)
+
+@app.get("/device/list/stream")
+def stream_device_list(batch_size: int = Query(500, ge=1, le=MAX_PAGE_LIMIT)):
+    """デバイス一覧をNDJSONでストリーミング返却する"""
+    def generate():
+        # レスポンス送信中も読み出しを続けるため、ストリーム専用のUnitOfWork（セッション）を使う
+        with unit_of_work_scope() as unit_of_work:
+            service = DeviceService(unit_of_work.devices, gpio_controller)
+            yield from service.stream_device_list(batch_size)
+    
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
 
 @app.get("/device/{device_id}/status", response_model=DeviceStatusResponse)
 def get_device_status(
     device_id: str,
+    response: Response,
     service: DeviceService = Depends(get_device_service)
 ):
-    return service.get_device_status(device_id)
+    result = service.get_device_status(device_id)
+    _set_etag(response, result.version)
+    return result
+
+@app.get("/device/{device_id}/history", response_model=StateEventListResponse)
+def get_device_history(
+    device_id: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+    service: StateHistoryService = Depends(get_state_history_service)
+):
+    return service.get_device_history(device_id, start, end, limit)
+
+@app.get("/device/{device_id}/usage", response_model=DeviceUsageResponse)
+def get_device_usage(
+    device_id: str,
+    granularity: Literal["hour", "day", "month"] = "day",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    service: UsageService = Depends(get_usage_service)
+):
+    return service.get_usage(device_id, granularity, start, end)
+
+@app.get("/device/{device_id}/expected", response_model=DeviceExpectedStateResponse)
+def get_device_expected_state(
+    device_id: str,
+    at: Optional[str] = None,
+    service: ExpectedStateService = Depends(get_expected_state_service)
+):
+    """スケジュールからat（HH:MM、省略時は現在時刻）に期待される状態と実際の状態を返す"""
+    return service.get_device_expected(device_id, at)
 
 @app.post("/device/{device_id}/on", response_model=DeviceStatusResponse)
 def turn_device_on(
     device_id: str,
+    response: Response,
     service: DeviceService = Depends(get_device_service)
 ):
-    return service.turn_device_on(device_id)
+    result = service.turn_device_on(device_id)
+    _set_etag(response, result.version)
+    return result
 
 @app.post("/device/{device_id}/off", response_model=DeviceStatusResponse)
 def turn_device_off(
     device_id: str,
+    response: Response,
+    service: DeviceService = Depends(get_device_service)
+):
+    result = service.turn_device_off(device_id)
+    _set_etag(response, result.version)
+    return result
+
+@app.get("/device/select", response_model=DeviceListResponse)
+def select_devices(
+    tags: List[str] = Query(..., min_length=1, max_length=20),
+    service: DeviceGroupService = Depends(get_device_group_service)
+):
+    """指定したタグをすべて持つデバイスを返す（例: ?tags=floor2&tags=light）"""
+    return service.select_devices(tags)
+
+@app.get("/device/{device_id}/tags", response_model=DeviceTagsResponse)
+def get_device_tags(
+    device_id: str,
+    service: DeviceGroupService = Depends(get_device_group_service)
+):
+    return service.get_device_tags(device_id)
+
+@app.put("/device/{device_id}/tags", response_model=DeviceTagsResponse)
+def set_device_tags(
+    device_id: str,
+    request: DeviceTagsRequest,
+    service: DeviceGroupService = Depends(get_device_group_service)
+):
+    return service.set_device_tags(device_id, request)
+
+@app.post("/group/on", response_model=DeviceGroupStateResponse)
+def turn_group_on(
+    request: DeviceGroupRequest,
+    service: DeviceGroupService = Depends(get_device_group_service)
+):
+    return service.set_group_state(request, True)
+
+@app.post("/group/off", response_model=DeviceGroupStateResponse)
+def turn_group_off(
+    request: DeviceGroupRequest,
+    service: DeviceGroupService = Depends(get_device_group_service)
+):
+    return service.set_group_state(request, False)
+
+@app.post("/device/delete", response_model=DeviceBulkDeleteResponse)
+def delete_devices(
+    request: DeviceBulkDeleteRequest,
     service: DeviceService = Depends(get_device_service)
 ):
-    return service.turn_device_off(device_id)
+    """複数のデバイスをスケジュールごとまとめて削除する（存在しないIDはnot_foundで返す）"""
+    return service.delete_devices(request)
 
 @app.delete("/device/{device_id}", response_model=DeviceDeleteResponse)
 def delete_device(
     device_id: str,
+    expected_versions: Optional[FrozenSet[int]] = Depends(get_expected_versions),
     service: DeviceService = Depends(get_device_service)
 ):
-    return service.delete_device(device_id)
+    return service.delete_device(device_id, expected_versions)
 
 @app.put("/device/{device_id}", response_model=DeviceUpdateResponse)
 def update_device(
     device_id: str,
     request: DeviceUpdateRequest,
+    response: Response,
+    expected_versions: Optional[FrozenSet[int]] = Depends(get_expected_versions),
     service: DeviceService = Depends(get_device_service)
 ):
-    return service.update_device(device_id, request)
+    result = service.update_device(device_id, request, expected_versions)
+    _set_etag(response, result.version)
+    return result
 
 @app.post("/GPIO/{gpio_number}/on", response_model=GPIOStatusResponse)
 def turn_gpio_on(
@@ -110,20 +342,73 @@ def create_schedule(
 ):
     return service.create_schedule(device_id, request)
 
+@app.get("/schedule/analysis", response_model=ScheduleAnalysisResponse)
+def analyze_schedules(
+    switch_threshold: int = Query(DEFAULT_SWITCH_THRESHOLD, ge=1),
+    service: ScheduleService = Depends(get_schedule_service)
+):
+    """全スケジュールの1日の動きから、同じ分のON/OFFの競合と切り替えの多いデバイスを返す"""
+    return service.analyze_schedules(switch_threshold)
+
 @app.get("/schedule/{device_id}", response_model=ScheduleListResponse)
 def get_schedules(
     device_id: str,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None,
+    service: ScheduleService = Depends(get_schedule_service)
+):
+    return service.get_schedules_by_device_id(device_id, limit, cursor)
+
+@app.put("/schedule/{schedule_id}", response_model=ScheduleUpdateResponse)
+def update_schedule(
+    schedule_id: str,
+    request: ScheduleUpdateRequest,
+    response: Response,
+    expected_versions: Optional[FrozenSet[int]] = Depends(get_expected_versions),
     service: ScheduleService = Depends(get_schedule_service)
 ):
-    return service.get_schedules_by_device_id(device_id)
+    """スケジュールの時刻・ON/OFFを更新し、実行中のジョブをその場で置き換える"""
+    result = service.update_schedule(schedule_id, request, expected_versions)
+    _set_etag(response, result.version)
+    return result
 
 @app.delete("/schedule/{schedule_id}", status_code=204)
 def delete_schedule(
     schedule_id: str,
+    expected_versions: Optional[FrozenSet[int]] = Depends(get_expected_versions),
     service: ScheduleService = Depends(get_schedule_service)
 ):
-    service.delete_schedule(schedule_id)
+    service.delete_schedule(schedule_id, expected_versions)
+
+@app.get("/changes", response_model=ChangesResponse)
+def get_changes(
+    since: int = Query(0, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_LIMIT),
+    service: ChangeFeedService = Depends(get_change_feed_service)
+):
+    """sinceより後のデバイス・スケジュールの変更（削除は墓標として）を返す"""
+    return service.get_changes(since, limit)
+
+@app.get("/expected", response_model=ExpectedStateListResponse)
+def get_fleet_expected_state(
+    at: Optional[str] = None,
+    service: ExpectedStateService = Depends(get_expected_state_service)
+):
+    """スケジュールを持つ全デバイスについて、at（HH:MM、省略時は現在時刻）に期待される状態と実際の状態を返す"""
+    return service.get_fleet_expected(at)
 
 @app.get("/health")
 def health_check():
     return {"status": "healthy"}
+
+@app.get("/debug/queries", dependencies=[Depends(require_debug_endpoints)])
+def get_query_stats():
+    """エンドポイント別のSQL発行数・DB時間の累計を取得する"""
+    return query_stats_registry.snapshot()
+
+@app.get("/debug/scheduler", dependencies=[Depends(require_debug_endpoints)])
+def get_scheduler_stats(schedule_executor: ScheduleExecutorService = Depends(get_schedule_executor_service)):
+    """スケジュール実行の遅延・実行時間・取りこぼしのヒストグラムと、スレッドプールの状況を取得する"""
+    if schedule_executor is None:
+        return {"running": False}
+    return schedule_executor.get_metrics()
@@ -2,13 +2,17 @@ import pytest
 import os
 from unittest.mock import Mock
 from fastapi.testclient import TestClient
-from presentation.api import app
+from presentation.api import app, device_selector_cache, schedule_timeline, scheduler_leadership
 from infrastructure.database import create_tables, SessionLocal
-from infrastructure.models import Device, Schedule
+from infrastructure.models import Device, DeviceTag, Schedule, StateEvent, DeviceUsage, DeviceUsageState, ChangeLog, ChangeLogWatermark
 from application.services import ScheduleExecutorService
 
 # テスト環境でMockGPIOControllerを使用
 os.environ["ENVIRONMENT"] = "test"
+# テストではスケジューラーのリーダー選出を行わず、実行サービスのモックを使う
+os.environ["SCHEDULER_ENABLED"] = "false"
+# デバッグ用のエンドポイントを有効にする
+os.environ["DEBUG_ENDPOINTS_ENABLED"] = "true"
 
 @pytest.fixture(scope="session", autouse=True)
 def setup_test_database():
@@ -20,12 +24,24 @@ def test_db():
     """テスト用データベースセッション（テストデータ作成用）"""
     db = SessionLocal()
     # テスト前にクリーンアップ（外部キー制約を考慮してScheduleから削除）
+    db.query(ChangeLog).delete()
+    db.query(ChangeLogWatermark).delete()
+    db.query(StateEvent).delete()
+    db.query(DeviceUsage).delete()
+    db.query(DeviceUsageState).delete()
+    db.query(DeviceTag).delete()
     db.query(Schedule).delete()
     db.query(Device).delete()
     db.commit()
     yield db
     # テスト後にもクリーンアップ
     try:
+        db.query(ChangeLog).delete()
+        db.query(ChangeLogWatermark).delete()
+        db.query(StateEvent).delete()
+        db.query(DeviceUsage).delete()
+        db.query(DeviceUsageState).delete()
+        db.query(DeviceTag).delete()
         db.query(Schedule).delete()
         db.query(Device).delete()
         db.commit()
@@ -38,9 +54,13 @@ def test_db():
 def client():
     """FastAPIテストクライアント"""
     # テスト用のScheduleExecutorServiceモックを設定
-    import aquamarine
     mock_schedule_executor = Mock(spec=ScheduleExecutorService)
-    aquamarine.schedule_executor = mock_schedule_executor
+    mock_schedule_executor.get_metrics.return_value = {"running": False}
+    scheduler_leadership.executor = mock_schedule_executor
+    # テストごとにデータを作り直すため、タグのセレクターのキャッシュと期待される状態の索引を破棄する
+    device_selector_cache.invalidate()
+    schedule_timeline.invalidate()
     
     with TestClient(app) as client:
-        yield client
\ No newline at end of file
+        yield client
+    scheduler_leadership.executor = None
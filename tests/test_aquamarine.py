@@ -19,3 +19,11 @@ def test_import_main():
     import aquamarine
     assert hasattr(aquamarine, 'main')
     assert callable(aquamarine.main)
+
+def test_schedule_engine_defaults_to_wheel(monkeypatch):
+    """同じ分のスケジュールをまとめて反映するタイミングホイールが既定の実行方式であることを確認"""
+    import aquamarine
+    monkeypatch.delenv("SCHEDULE_ENGINE", raising=False)
+    assert aquamarine.get_schedule_engine() == aquamarine.SCHEDULE_ENGINE_WHEEL
+    monkeypatch.setenv("SCHEDULE_ENGINE", "cron")
+    assert aquamarine.get_schedule_engine() == aquamarine.SCHEDULE_ENGINE_CRON
@@ -1,7 +1,21 @@
+import os
 import pytest
-from datetime import datetime
-from infrastructure.models import Device, Schedule
-from infrastructure.repositories import SQLAlchemyDeviceRepository, SQLAlchemyScheduleRepository
+import stat
+import time
+from datetime import datetime, timedelta, timezone
+from apscheduler.triggers.cron import CronTrigger
+from infrastructure.models import ChangeLog, Device, Schedule
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import IntegrityError
+from infrastructure.repositories import SQLAlchemyChangeLogRepository, SQLAlchemyDeviceRepository, SQLAlchemyScheduleRepository
+from application.ids import new_id
+from application.repositories import VersionConflictError
+from infrastructure.database import SessionLocal
+from infrastructure.instrumentation import SchedulerMetrics, install_query_instrumentation, start_query_stats, stop_query_stats
+from infrastructure.scheduler_leadership import (
+    FileLeaderLock, RemoteScheduleExecutor, ScheduleChannelServer, SchedulerLeadership, SchedulerUnavailableError, runtime_path
+)
+from unittest.mock import Mock
 
 @pytest.fixture
 def device_repository(test_db):
@@ -195,4 +209,348 @@ def test_schedule_repository_delete(schedule_repository, device_repository):
     
     # 存在しないスケジュールの削除
     result = schedule_repository.delete("non-existent")
-    assert result is False
\ No newline at end of file
+    assert result is False
+def test_find_page_keyset(device_repository):
+    """キーセットページネーションのテスト"""
+    for i in range(5):
+        device_repository.create(f"device-{i}", f"Device {i}", 10 + i)
+    
+    first_page = device_repository.find_page(2)
+    assert [d.device_id for d in first_page] == ["device-0", "device-1"]
+    
+    last = first_page[-1]
+    second_page = device_repository.find_page(2, (last.created_at, last.device_id))
+    assert [d.device_id for d in second_page] == ["device-2", "device-3"]
+    
+    last = second_page[-1]
+    third_page = device_repository.find_page(2, (last.created_at, last.device_id))
+    assert [d.device_id for d in third_page] == ["device-4"]
+
+def test_iter_all_devices(device_repository):
+    """全デバイスの逐次読み出しのテスト"""
+    for i in range(5):
+        device_repository.create(f"device-{i}", f"Device {i}", 10 + i)
+    
+    device_ids = [d.device_id for d in device_repository.iter_all(batch_size=2)]
+    assert device_ids == [f"device-{i}" for i in range(5)]
+
+def test_search_by_name(device_repository, test_db):
+    """デバイス名の前方一致検索が大文字小文字を区別せず、LIKEのワイルドカードをそのまま扱うことを確認"""
+    for i, name in enumerate(["Living Light", "living fan", "Kitchen", "liv_x", "livAx"]):
+        device_repository.create(f"device-{i}", name, 10 + i)
+    
+    assert [d.device_name for d in device_repository.search_by_name("LIVING", 10)] == ["living fan", "Living Light"]
+    assert [d.device_name for d in device_repository.search_by_name("liv", 2)] == ["liv_x", "livAx"]
+    assert [d.device_name for d in device_repository.search_by_name("liv_", 10)] == ["liv_x"]
+    assert device_repository.search_by_name("%", 10) == []
+    
+    plan = " ".join(str(row[-1]) for row in test_db.execute(text(
+        "EXPLAIN QUERY PLAN SELECT * FROM devices WHERE site_id = 'default' AND lower(device_name) >= 'liv' AND lower(device_name) < 'liw'"
+    )))
+    assert "ix_devices_site_id_lower_device_name" in plan
+
+def test_query_instrumentation_slow_query_log(caplog):
+    """閾値を超えたSQLがパラメータの値を含めずにログ出力されることを確認"""
+    engine = create_engine("sqlite:///:memory:")
+    install_query_instrumentation(engine, slow_query_threshold_ms=0)
+    
+    stats, token = start_query_stats()
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT :value"), {"value": "secret"})
+    finally:
+        stop_query_stats(token)
+    
+    assert stats.query_count == 1
+    assert "Slow query" in caplog.text
+    assert "parameters=(str)" in caplog.text
+    assert "secret" not in caplog.text
+
+def test_scheduler_metrics():
+    """投入の遅延・実行時間がバケットに集計され、まとめられた予定時刻・取りこぼし・待ち行列が数えられることを確認"""
+    metrics = SchedulerMetrics(max_workers=1)
+    trigger = CronTrigger(second=0, timezone=timezone.utc)
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    
+    metrics.record_submitted("tick", [start], start + timedelta(milliseconds=3), trigger)
+    metrics.record_submitted("schedule-1", [start], start + timedelta(milliseconds=40), trigger)
+    snapshot = metrics.snapshot()
+    assert snapshot["threadpool"] == {"max_workers": 1, "in_flight": 2, "queue_depth": 1, "saturation": 1.0, "peak_in_flight": 2}
+    
+    metrics.record_finished("tick", start, start + timedelta(milliseconds=8), "executed")
+    metrics.record_finished("schedule-1", start, start + timedelta(seconds=2), "misfires")
+    # 3分遅れた次のティックは1回にまとめられ、間の2回分が数えられる
+    metrics.record_submitted("tick", [start + timedelta(minutes=3)], start + timedelta(minutes=3, seconds=1), trigger)
+    metrics.record_finished("tick", start + timedelta(minutes=3), start + timedelta(minutes=3, seconds=2), "errors")
+    metrics.record_max_instances("tick", [start + timedelta(minutes=4)])
+    
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"] == {"submitted": 3, "executed": 1, "errors": 1, "misfires": 1, "coalesced": 2, "max_instances": 1}
+    lag = {bucket["le"]: bucket["count"] for bucket in snapshot["dispatch_lag_ms"]["buckets"]}
+    assert (lag[5], lag[50], lag[1000], lag["+Inf"]) == (1, 1, 1, 0)
+    assert snapshot["execution_ms"]["count"] == 2
+    assert snapshot["execution_ms"]["max"] == 1000.0
+    assert snapshot["threadpool"]["in_flight"] == 0
+
+def test_file_leader_lock(tmp_path):
+    """リーダーのロックは1つだけが取得でき、解放すると他が取得できる"""
+    path = str(tmp_path / "scheduler.lock")
+    first, second = FileLeaderLock(path), FileLeaderLock(path)
+
+    assert first.try_acquire()
+    assert not second.try_acquire()
+    first.release()
+    assert second.try_acquire()
+    assert second.held and not first.held
+    second.release()
+
+def test_scheduler_leadership_forwards_to_leader(tmp_path):
+    """リーダー以外のワーカーはスケジュールの変更をリーダーの実行サービスに転送し、リーダーの停止後に引き継ぐ"""
+    def executor_factory():
+        executor = Mock()
+        executor.scheduler.running = False
+        executor.add_schedule.return_value = None
+        executor.remove_schedule.return_value = None
+        executor.remove_device_schedules.return_value = 2
+        executor.get_metrics.return_value = {"running": True}
+        return executor
+    lock_path, socket_path = str(tmp_path / "scheduler.lock"), str(tmp_path / "scheduler.sock")
+    leader = SchedulerLeadership(lock_path, socket_path, executor_factory, retry_interval=0.05)
+    follower = SchedulerLeadership(lock_path, socket_path, executor_factory, retry_interval=0.05)
+    leader.start()
+    follower.start()
+    try:
+        assert leader.is_leader and not follower.is_leader
+        assert isinstance(follower.executor, RemoteScheduleExecutor)
+        leader_executor = leader.executor
+
+        follower.executor.add_schedule("schedule-1", "device-1", "10:30", True, 1)
+        assert follower.executor.remove_device_schedules(["device-1"]) == 2
+        assert follower.executor.get_metrics() == {"running": True}
+        leader_executor.add_schedule.assert_called_once_with("schedule-1", "device-1", "10:30", True, 1)
+        leader_executor.remove_device_schedules.assert_called_once_with(["device-1"])
+
+        # リーダーで失敗した変更は転送元でもValueErrorになる
+        leader_executor.remove_schedule.side_effect = ValueError("Invalid schedule")
+        with pytest.raises(ValueError, match="Invalid schedule"):
+            follower.executor.remove_schedule("schedule-1")
+
+        leader.stop()
+        for _ in range(100):
+            if follower.is_leader:
+                break
+            time.sleep(0.05)
+        assert follower.is_leader
+        assert not isinstance(follower.executor, RemoteScheduleExecutor)
+    finally:
+        follower.stop()
+        leader.stop()
+
+def test_scheduler_leadership_falls_back_when_bootstrap_fails(tmp_path):
+    """リーダーの開始に失敗してもワーカーの起動は続け、転送しながらリーダーの取得を再試行する"""
+    attempts = []
+    def executor_factory():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("Bootstrap failed")
+        executor = Mock()
+        executor.scheduler.running = False
+        return executor
+    leadership = SchedulerLeadership(str(tmp_path / "scheduler.lock"), str(tmp_path / "scheduler.sock"), executor_factory, retry_interval=0.2)
+    leadership.start()
+    try:
+        assert not leadership.is_leader
+        assert isinstance(leadership.executor, RemoteScheduleExecutor)
+        for _ in range(100):
+            if leadership.is_leader:
+                break
+            time.sleep(0.05)
+        assert leadership.is_leader
+        assert len(attempts) == 2
+    finally:
+        leadership.stop()
+
+def test_remote_schedule_executor_without_leader(tmp_path):
+    """リーダーに接続できない変更はエラーにし、接続できるようになったらリーダーにresyncを要求する"""
+    socket_path = str(tmp_path / "scheduler.sock")
+    executor = RemoteScheduleExecutor(socket_path, timeout=0.1)
+
+    with pytest.raises(SchedulerUnavailableError):
+        executor.add_schedule("schedule-1", "device-1", "10:30", True)
+    # 削除はコミット済みのため成功とし、残ったジョブはresyncで取り除く
+    executor.remove_schedule("schedule-1")
+    assert executor.remove_device_schedules(["device-1"]) == 0
+    assert executor.get_metrics() == {"running": False}
+
+    leader_executor = Mock()
+    leader_executor.request_resync.return_value = True
+    leader_executor.remove_schedule.return_value = None
+    server = ScheduleChannelServer(socket_path, leader_executor)
+    server.start()
+    try:
+        assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+        executor.remove_schedule("schedule-2")
+        executor.remove_schedule("schedule-3")
+        leader_executor.request_resync.assert_called_once_with()
+        assert [c.args for c in leader_executor.remove_schedule.call_args_list] == [("schedule-2",), ("schedule-3",)]
+    finally:
+        server.stop()
+
+def test_runtime_path_must_be_private(tmp_path, monkeypatch):
+    """ロックファイル・ソケットは所有者だけが使えるランタイム用ディレクトリに置くことを確認"""
+    runtime_dir = tmp_path / "runtime"
+    runtime_dir.mkdir(mode=0o700)
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(runtime_dir))
+    assert runtime_path("scheduler.sock") == str(runtime_dir / "scheduler.sock")
+
+    runtime_dir.chmod(0o755)
+    with pytest.raises(RuntimeError):
+        runtime_path("scheduler.sock")
+
+def test_compact_id_storage(device_repository, test_db):
+    """UUID形式のIDが16バイトで保存され、文字列として読み出されることを確認"""
+    device_id = new_id()
+    device_repository.create(device_id, "Test Device", 18)
+    
+    stored = test_db.execute(text("SELECT typeof(device_id), length(device_id) FROM devices")).one()
+    assert tuple(stored) == ("blob", 16)
+    
+    # 大文字・ハイフンなしの表記でも同じデバイスとして検索できる
+    assert device_repository.find_by_id(device_id).device_id == device_id
+    assert device_repository.find_by_id(device_id.upper().replace("-", "")).device_id == device_id
+
+def test_compact_id_legacy_string(device_repository):
+    """UUIDとして解釈できない既存のIDがそのまま扱えることを確認"""
+    device_repository.create("legacy-device", "Legacy Device", 18)
+    
+    assert device_repository.find_by_id("legacy-device").device_id == "legacy-device"
+
+def test_update_device_conditional_on_version(device_repository, test_db):
+    """読み込み後に他のセッションが更新した場合、条件付きUPDATEが競合を検出することを確認"""
+    device_repository.create("test-device", "Test Device", 18)
+    
+    other_session = SessionLocal()
+    try:
+        other_repository = SQLAlchemyDeviceRepository(other_session)
+        stale_version = other_repository.find_by_id("test-device").version
+        
+        assert device_repository.update_device("test-device", device_name="First", expected_version=stale_version) is True
+        assert device_repository.find_by_id("test-device").version == stale_version + 1
+        
+        with pytest.raises(VersionConflictError):
+            other_repository.update_device("test-device", device_name="Second", expected_version=stale_version)
+        with pytest.raises(VersionConflictError):
+            other_repository.delete("test-device", expected_version=stale_version)
+        assert other_repository.update_device("non-existent", device_name="Second", expected_version=1) is False
+    finally:
+        other_session.close()
+    
+    test_db.expire_all()
+    assert device_repository.find_by_id("test-device").device_name == "First"
+
+def test_update_schedule_conditional_on_version(device_repository, schedule_repository):
+    """スケジュールの更新でバージョンが増え、古いバージョンを指定した更新が競合になることを確認"""
+    device_repository.create("test-device", "Test Device", 18)
+    schedule_repository.save(Schedule(schedule_id="test-schedule", device_id="test-device", schedule="07:00", is_on=True))
+    
+    assert schedule_repository.update("test-schedule", schedule="08:30", expected_version=1) is True
+    updated = schedule_repository.find_by_id("test-schedule")
+    assert (updated.schedule, updated.is_on, updated.version) == ("08:30", True, 2)
+    assert schedule_repository.find_all_with_devices()[0].version == 2
+    with pytest.raises(VersionConflictError):
+        schedule_repository.update("test-schedule", is_on=False, expected_version=1)
+    assert schedule_repository.update("non-existent", is_on=False) is False
+
+def test_change_log_keeps_latest_revision_per_entity(device_repository, schedule_repository, test_db):
+    """更新のたびにリビジョンが増え、エンティティごとに最新の変更だけが残ることを確認"""
+    change_repository = SQLAlchemyChangeLogRepository(test_db)
+    device_repository.create("test-device", "Test Device", 18)
+    schedule_repository.save(Schedule(schedule_id="test-schedule", device_id="test-device", schedule="07:00", is_on=True))
+    device_repository.update_device("test-device", device_name="Renamed")
+    schedule_repository.delete("test-schedule")
+    
+    changes = change_repository.find_since(0, 10)
+    assert [(c.entity_type, c.entity_id, c.deleted) for c in changes] == [
+        ("device", "test-device", False),
+        ("schedule", "test-schedule", True)
+    ]
+    assert changes[0].revision < changes[1].revision == change_repository.find_latest_revision()
+    assert test_db.query(ChangeLog).count() == 2
+    assert change_repository.find_since(changes[0].revision, 10) == changes[1:]
+
+def test_change_log_prunes_old_tombstones(device_repository, schedule_repository, test_db):
+    """保持期間を過ぎたトゥームストーンだけが削除され、その最大リビジョンが記録されることを確認"""
+    change_repository = SQLAlchemyChangeLogRepository(test_db)
+    device_repository.create("test-device", "Test Device", 18)
+    schedule_repository.save(Schedule(schedule_id="old-schedule", device_id="test-device", schedule="07:00", is_on=True))
+    schedule_repository.save(Schedule(schedule_id="new-schedule", device_id="test-device", schedule="08:00", is_on=True))
+    schedule_repository.delete("old-schedule")
+    schedule_repository.delete("new-schedule")
+    old = test_db.query(ChangeLog).filter(ChangeLog.entity_id == "old-schedule").one()
+    old.changed_at = datetime.now() - timedelta(days=40)
+    old_revision = old.revision
+    test_db.commit()
+    assert change_repository.find_pruned_revision() == 0
+    
+    assert change_repository.prune_tombstones(datetime.now() - timedelta(days=30)) == 1
+    test_db.commit()
+    
+    assert [(c.entity_id, c.deleted) for c in change_repository.find_since(0, 10)] == [
+        ("test-device", False), ("new-schedule", True)
+    ]
+    assert change_repository.find_pruned_revision() == old_revision
+    assert change_repository.prune_tombstones(datetime.now() - timedelta(days=30)) == 0
+
+def test_delete_device_cascades_schedules(device_repository, schedule_repository, test_db):
+    """デバイスの削除でスケジュールも削除され、両方の墓標が記録されることを確認"""
+    change_repository = SQLAlchemyChangeLogRepository(test_db)
+    device_repository.create("device-1", "Device 1", 18)
+    device_repository.create("device-2", "Device 2", 19)
+    schedule_repository.save(Schedule(schedule_id="schedule-1", device_id="device-1", schedule="07:00", is_on=True))
+    schedule_repository.save(Schedule(schedule_id="schedule-2", device_id="device-2", schedule="08:00", is_on=True))
+    
+    assert device_repository.delete_many(["device-1", "missing"]) == ["device-1"]
+    
+    test_db.expire_all()
+    assert [s.schedule_id for s in schedule_repository.find_all()] == ["schedule-2"]
+    tombstones = {(c.entity_type, c.entity_id) for c in change_repository.find_since(0, 10) if c.deleted}
+    assert tombstones == {("device", "device-1"), ("schedule", "schedule-1")}
+
+@pytest.mark.parametrize("delete_returning", [True, False])
+def test_delete_many_checks_expected_versions(device_repository, test_db, monkeypatch, delete_returning):
+    """バージョンが一致しないデバイスは削除されず、RETURNINGのないDBでも同じ結果になることを確認"""
+    monkeypatch.setattr(test_db.get_bind().dialect, "delete_returning", delete_returning)
+    change_repository = SQLAlchemyChangeLogRepository(test_db)
+    for i in range(3):
+        device_repository.create(f"device-{i}", f"Device {i}", 18 + i)
+    device_repository.update_device("device-1", device_name="Renamed")
+    
+    deleted_ids = device_repository.delete_many(["device-0", "device-1", "device-2"], expected_versions={"device-0": 1, "device-1": 1})
+    
+    assert sorted(deleted_ids) == ["device-0", "device-2"]
+    test_db.expire_all()
+    assert [d.device_id for d in device_repository.find_all()] == ["device-1"]
+    tombstones = {c.entity_id for c in change_repository.find_since(0, 10) if c.deleted}
+    assert tombstones == {"device-0", "device-2"}
+
+def test_repositories_scoped_by_site(test_db):
+    """サイトごとにデバイス・スケジュール・変更履歴が分かれ、GPIO番号はサイト内で一意であることを確認"""
+    site_a = SQLAlchemyDeviceRepository(test_db, site_id="site-a")
+    site_b = SQLAlchemyDeviceRepository(test_db, site_id="site-b")
+    site_a.create("device-a", "Device A", 18)
+    # 別のサイトでは同じGPIO番号を使える
+    site_b.create("device-b", "Device B", 18)
+    SQLAlchemyScheduleRepository(test_db, site_id="site-a").save(
+        Schedule(schedule_id="schedule-a", device_id="device-a", schedule="07:00", is_on=True)
+    )
+    
+    assert [d.device_id for d in site_a.find_all()] == ["device-a"]
+    assert site_a.find_by_id("device-b") is None
+    assert site_a.update_device("device-b", device_name="Renamed") is False
+    assert site_a.delete("device-b") is False
+    assert SQLAlchemyScheduleRepository(test_db, site_id="site-b").find_all() == []
+    assert [c.entity_id for c in SQLAlchemyChangeLogRepository(test_db, "site-b").find_since(0, 10)] == ["device-b"]
+    
+    with pytest.raises(IntegrityError):
+        site_a.create("device-c", "Device C", 18)
+    test_db.rollback()
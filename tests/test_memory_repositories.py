@@ -0,0 +1,339 @@
+import os
+import pytest
+from datetime import datetime, timedelta
+from application.repositories import ScheduleLoadRow, VersionConflictError
+from application.models import DeviceRegisterRequest, ScheduleCreateRequest
+from application.services import DeviceService, ScheduleService
+from hardware.gpio_controller import MockGPIOController
+from infrastructure.journal import JOURNAL_FILE, SNAPSHOT_FILE
+from infrastructure.memory_repositories import (
+    InMemoryChangeLogRepository, InMemoryDeviceRepository, InMemoryDeviceTagRepository, InMemoryScheduleRepository, MemoryStore,
+    memory_unit_of_work_scope, open_memory_store
+)
+from infrastructure.models import DEFAULT_SITE_ID, Schedule
+
+@pytest.fixture
+def store_dir(tmp_path):
+    return str(tmp_path / "store")
+
+@pytest.fixture
+def store(store_dir):
+    """ジャーナルで永続化するMemoryStoreのフィクスチャ"""
+    store = open_memory_store(store_dir)
+    yield store
+    store.close()
+
+def reopen(store: MemoryStore, store_dir: str, snapshot_threshold: int = 10000) -> MemoryStore:
+    store.close()
+    return open_memory_store(store_dir, snapshot_threshold)
+
+def test_device_repository_crud(store):
+    """デバイスの作成・取得・更新・削除とGPIO番号の一意性を確認"""
+    repository = InMemoryDeviceRepository(store)
+    repository.create("device-1", "Device 1", 18)
+    repository.create("device-2", "Device 2", 19)
+
+    assert repository.find_by_id("device-1").device_name == "Device 1"
+    assert [device.device_id for device in repository.find_all()] == ["device-1", "device-2"]
+    with pytest.raises(ValueError):
+        repository.create("device-3", "Device 3", 18)
+
+    assert repository.update_device("device-1", device_name="Renamed", gpio_number=20) is True
+    assert store.devices.get_unique(("site_id", "gpio_number"), (DEFAULT_SITE_ID, 20)).device_name == "Renamed"
+    assert store.devices.get_unique(("site_id", "gpio_number"), (DEFAULT_SITE_ID, 18)) is None
+
+    assert repository.delete("device-2") is True
+    assert repository.delete("device-2") is False
+    assert repository.find_by_id("device-2") is None
+
+def test_device_version_check(store):
+    """バージョンを指定した更新・削除で競合が検出されることを確認"""
+    repository = InMemoryDeviceRepository(store)
+    repository.create("device-1", "Device 1", 18)
+    assert repository.find_by_id("device-1").version == 1
+
+    assert repository.update_device("device-1", device_name="First", expected_version=1) is True
+    assert repository.find_by_id("device-1").version == 2
+    # updated_atのみの更新ではバージョンは変わらない
+    repository.update_timestamp("device-1")
+    assert repository.find_by_id("device-1").version == 2
+
+    with pytest.raises(VersionConflictError):
+        repository.update_device("device-1", device_name="Second", expected_version=1)
+    with pytest.raises(VersionConflictError):
+        repository.delete("device-1", expected_version=1)
+    assert repository.find_by_id("device-1").device_name == "First"
+    assert repository.delete("device-1", expected_version=2) is True
+
+def test_find_page_keyset(store):
+    """キーセットページネーションで全件を重複なく取得できることを確認"""
+    repository = InMemoryDeviceRepository(store)
+    for i in range(5):
+        repository.create(f"device-{i}", f"Device {i}", 2 + i)
+
+    first = repository.find_page(2)
+    second = repository.find_page(2, (first[-1].created_at, first[-1].device_id))
+    third = repository.find_page(2, (second[-1].created_at, second[-1].device_id))
+
+    assert [device.device_id for device in first + second + third] == [f"device-{i}" for i in range(5)]
+
+def test_search_by_name(store, store_dir):
+    """名前の索引で前方一致検索ができ、名前の変更・削除・再起動後も索引が一貫することを確認"""
+    repository = InMemoryDeviceRepository(store)
+    for i, name in enumerate(["Living Light", "living fan", "Kitchen", "Lobby"]):
+        repository.create(f"device-{i}", name, 2 + i)
+    
+    assert [d.device_name for d in repository.search_by_name("LIVING", 10)] == ["living fan", "Living Light"]
+    assert [d.device_name for d in repository.search_by_name("l", 2)] == ["living fan", "Living Light"]
+    repository.update_device("device-2", device_name="Living Kitchen")
+    repository.delete("device-1")
+    assert [d.device_id for d in repository.search_by_name("living", 10)] == ["device-2", "device-0"]
+    
+    store = reopen(store, store_dir)
+    try:
+        assert [d.device_id for d in InMemoryDeviceRepository(store).search_by_name("li", 10)] == ["device-2", "device-0"]
+    finally:
+        store.close()
+
+def test_schedule_repository_by_device(store):
+    """デバイスごとのスケジュール索引が保存・削除で更新されることを確認"""
+    repository = InMemoryScheduleRepository(store)
+    repository.save(Schedule(schedule_id="schedule-1", device_id="device-1", schedule="18:00", is_on=False))
+    repository.save(Schedule(schedule_id="schedule-2", device_id="device-1", schedule="07:00", is_on=True))
+    repository.save(Schedule(schedule_id="schedule-3", device_id="device-2", schedule="08:00", is_on=True))
+
+    assert [s.schedule for s in repository.find_by_device_id("device-1")] == ["07:00", "18:00"]
+    assert [s.schedule_id for s in repository.find_page_by_device_id("device-1", 1, ("07:00", "schedule-2"))] == ["schedule-1"]
+
+    assert repository.delete("schedule-2") is True
+    assert [s.schedule_id for s in repository.find_by_device_id("device-1")] == ["schedule-1"]
+    assert repository.find_by_id("schedule-3").created_at is not None
+
+    assert repository.update("schedule-1", schedule="06:00", expected_version=1) is True
+    updated = repository.find_by_id("schedule-1")
+    assert (updated.schedule, updated.is_on, updated.version) == ("06:00", False, 2)
+    with pytest.raises(VersionConflictError):
+        repository.update("schedule-1", is_on=True, expected_version=1)
+    assert repository.update("missing", is_on=True) is False
+
+def test_replay_restores_state(store, store_dir):
+    """再起動時にジャーナルを再生して同じ状態に戻ることを確認"""
+    devices = InMemoryDeviceRepository(store)
+    schedules = InMemoryScheduleRepository(store)
+    devices.create("device-1", "Device 1", 18)
+    devices.create("device-2", "Device 2", 19)
+    devices.update_device("device-1", device_name="Renamed")
+    devices.delete("device-2")
+    schedules.save(Schedule(schedule_id="schedule-1", device_id="device-1", schedule="07:00", is_on=True))
+    created_at = devices.find_by_id("device-1").created_at
+
+    store = reopen(store, store_dir)
+    try:
+        device = store.devices.get("device-1")
+        assert device.device_name == "Renamed"
+        assert device.created_at == created_at
+        assert store.devices.get("device-2") is None
+        assert [s.schedule_id for s in store.schedules.get_group("device_id", "device-1")] == ["schedule-1"]
+    finally:
+        store.close()
+
+def test_snapshot_compaction(store_dir):
+    """ジャーナルが閾値に達するとスナップショットに集約され、再生結果が変わらないことを確認"""
+    store = open_memory_store(store_dir, snapshot_threshold=3)
+    repository = InMemoryDeviceRepository(store)
+    for i in range(5):
+        repository.create(f"device-{i}", f"Device {i}", 2 + i)
+    repository.delete("device-0")
+
+    assert os.path.exists(os.path.join(store_dir, SNAPSHOT_FILE))
+    with open(os.path.join(store_dir, JOURNAL_FILE)) as f:
+        assert len(f.readlines()) < 3
+
+    store = reopen(store, store_dir, snapshot_threshold=3)
+    try:
+        assert sorted(store.devices.rows) == [f"device-{i}" for i in range(1, 5)]
+    finally:
+        store.close()
+
+def test_truncated_journal_record_ignored(store, store_dir):
+    """書き込み途中で停止した末尾の行を無視し、その後の追記が再生されることを確認"""
+    InMemoryDeviceRepository(store).create("device-1", "Device 1", 18)
+    store.close()
+    with open(os.path.join(store_dir, JOURNAL_FILE), "a") as f:
+        f.write('{"n": 2, "ops": [{"t": "devices", "put"')
+
+    store = open_memory_store(store_dir)
+    InMemoryDeviceRepository(store).create("device-2", "Device 2", 19)
+
+    store = reopen(store, store_dir)
+    try:
+        assert sorted(store.devices.rows) == ["device-1", "device-2"]
+    finally:
+        store.close()
+
+def test_commit_fails_when_journal_fsync_fails(store, monkeypatch):
+    """fsyncに失敗した場合、永続化を待つコミットが待ち続けずにエラーになることを確認"""
+    def failing_fsync(fd):
+        raise OSError(5, "Input/output error")
+    monkeypatch.setattr("infrastructure.journal.os.fsync", failing_fsync)
+
+    with pytest.raises(RuntimeError, match="Journal fsync failed"):
+        InMemoryDeviceRepository(store).create("device-1", "Device 1", 18)
+    with pytest.raises(RuntimeError, match="Journal fsync failed"):
+        InMemoryDeviceRepository(store).create("device-2", "Device 2", 19)
+    monkeypatch.undo()
+
+def test_change_log_read_inside_write_transaction(store):
+    """書き込み中のUnitOfWorkから変更履歴を読んでも待ち続けず、自分の変更を含めて読めることを確認"""
+    InMemoryDeviceRepository(store).create("device-1", "Device 1", 18)
+    before = InMemoryChangeLogRepository(store).find_latest_revision()
+
+    with memory_unit_of_work_scope(store) as unit_of_work:
+        unit_of_work.devices.update_device("device-1", device_name="Renamed")
+        assert unit_of_work.changes.find_latest_revision() == before + 1
+        assert [change.entity_id for change in unit_of_work.changes.find_since(before, 10)] == ["device-1"]
+        unit_of_work.commit()
+
+    assert InMemoryChangeLogRepository(store).find_latest_revision() == before + 1
+
+def test_directory_locked_by_other_store(store, store_dir):
+    """同じディレクトリを二重に開けないことを確認"""
+    with pytest.raises(RuntimeError):
+        open_memory_store(store_dir)
+
+def test_unit_of_work_rollback(store, store_dir):
+    """コミットしなかった変更や例外時の変更がメモリ上・ジャーナルの双方から取り消されることを確認"""
+    InMemoryDeviceRepository(store).create("device-1", "Device 1", 18)
+
+    with memory_unit_of_work_scope(store) as unit_of_work:
+        unit_of_work.devices.update_device("device-1", device_name="Uncommitted")
+        unit_of_work.devices.create("device-2", "Device 2", 19)
+
+    with pytest.raises(RuntimeError):
+        with memory_unit_of_work_scope(store) as unit_of_work:
+            unit_of_work.devices.delete("device-1")
+            raise RuntimeError("boom")
+
+    assert store.devices.get("device-1").device_name == "Device 1"
+    assert store.devices.get("device-2") is None
+
+    store = reopen(store, store_dir)
+    try:
+        assert sorted(store.devices.rows) == ["device-1"]
+    finally:
+        store.close()
+
+def test_services_on_memory_unit_of_work(store, store_dir):
+    """サービスがインメモリのUnitOfWork上で動作し、1リクエスト1行で永続化されることを確認"""
+    gpio_controller = MockGPIOController()
+    with memory_unit_of_work_scope(store) as unit_of_work:
+        device = DeviceService(unit_of_work.devices, gpio_controller, unit_of_work=unit_of_work).register_device(
+            DeviceRegisterRequest(device_name="Memory Device", gpio_number=18)
+        )
+    with memory_unit_of_work_scope(store) as unit_of_work:
+        schedule_service = ScheduleService(unit_of_work.schedules, unit_of_work.devices, unit_of_work=unit_of_work)
+        schedule_service.create_schedule(device.device_id, ScheduleCreateRequest(schedule="07:00", is_on=True))
+        schedules = schedule_service.get_schedules_by_device_id(device.device_id)
+
+    assert [s.schedule for s in schedules.schedules] == ["07:00"]
+    assert isinstance(device.created_at, datetime)
+    with open(os.path.join(store_dir, JOURNAL_FILE)) as f:
+        assert len(f.readlines()) == 2
+
+def test_change_log_recorded_and_replayed(store, store_dir):
+    """変更履歴がエンティティと同じトランザクションで記録され、ロールバック・再起動後も一貫することを確認"""
+    devices = InMemoryDeviceRepository(store)
+    devices.create("device-1", "Device 1", 18)
+    devices.create("device-2", "Device 2", 19)
+    devices.update_device("device-1", device_name="Renamed")
+    devices.delete("device-2")
+    with memory_unit_of_work_scope(store) as unit_of_work:
+        unit_of_work.devices.create("device-3", "Device 3", 20)
+
+    changes = InMemoryChangeLogRepository(store).find_since(0, 10)
+    assert [(c.entity_id, c.deleted) for c in changes] == [("device-1", False), ("device-2", True)]
+    latest = InMemoryChangeLogRepository(store).find_latest_revision()
+    assert latest == changes[-1].revision
+
+    store = reopen(store, store_dir)
+    try:
+        repository = InMemoryChangeLogRepository(store)
+        assert [(c.revision, c.entity_id) for c in repository.find_since(0, 10)] == [(c.revision, c.entity_id) for c in changes]
+        InMemoryDeviceRepository(store).create("device-4", "Device 4", 21)
+        assert repository.find_since(latest, 10)[0].revision > latest
+    finally:
+        store.close()
+
+def test_change_log_prunes_tombstones(store, store_dir):
+    """トゥームストーンの削除が再起動後も保たれ、削除した最新のリビジョンが再利用されないことを確認"""
+    devices = InMemoryDeviceRepository(store)
+    devices.create("device-1", "Device 1", 18)
+    devices.create("device-2", "Device 2", 19)
+    devices.delete("device-2")
+    tombstone = store.changes.get_unique(("entity_type", "entity_id"), ("device", "device-2"))
+
+    repository = InMemoryChangeLogRepository(store)
+    assert repository.prune_tombstones(datetime.now() - timedelta(days=1)) == 0
+    assert repository.prune_tombstones(datetime.now() + timedelta(seconds=1)) == 1
+    assert [c.entity_id for c in repository.find_since(0, 10)] == ["device-1"]
+    assert repository.find_pruned_revision() == tombstone.revision
+
+    store = reopen(store, store_dir)
+    try:
+        repository = InMemoryChangeLogRepository(store)
+        assert repository.find_pruned_revision() == tombstone.revision
+        InMemoryDeviceRepository(store).create("device-3", "Device 3", 20)
+        assert repository.find_since(0, 10)[-1].revision > tombstone.revision
+    finally:
+        store.close()
+
+def test_delete_device_cascades_schedules(store):
+    """デバイスの削除でスケジュールも同じトランザクションで削除されることを確認"""
+    devices = InMemoryDeviceRepository(store)
+    schedules = InMemoryScheduleRepository(store)
+    devices.create("device-1", "Device 1", 18)
+    devices.create("device-2", "Device 2", 19)
+    schedules.save(Schedule(schedule_id="schedule-1", device_id="device-1", schedule="07:00", is_on=True))
+    schedules.save(Schedule(schedule_id="schedule-2", device_id="device-2", schedule="08:00", is_on=True))
+
+    assert devices.delete_many(["device-1", "missing"]) == ["device-1"]
+    assert [s.schedule_id for s in schedules.find_all()] == ["schedule-2"]
+    assert schedules.find_all_with_devices() == [ScheduleLoadRow("schedule-2", "device-2", 19, "08:00", True, 1)]
+    assert store.changes.get_unique(("entity_type", "entity_id"), ("schedule", "schedule-1")).deleted is True
+
+def test_delete_many_checks_expected_versions(store):
+    """バージョンが一致しないデバイスはスケジュールも含めて削除されないことを確認"""
+    devices = InMemoryDeviceRepository(store)
+    schedules = InMemoryScheduleRepository(store)
+    devices.create("device-1", "Device 1", 18)
+    devices.create("device-2", "Device 2", 19)
+    devices.update_device("device-2", device_name="Renamed")
+    schedules.save(Schedule(schedule_id="schedule-2", device_id="device-2", schedule="08:00", is_on=True))
+
+    assert devices.delete_many(["device-1", "device-2"], expected_versions={"device-1": 1, "device-2": 1}) == ["device-1"]
+    assert [d.device_id for d in devices.find_all()] == ["device-2"]
+    assert [s.schedule_id for s in schedules.find_all()] == ["schedule-2"]
+
+def test_device_tags_index(store, store_dir):
+    """タグの転置索引で全タグを持つデバイスが選択され、デバイス削除・再起動後も一貫することを確認"""
+    devices = InMemoryDeviceRepository(store)
+    tags = InMemoryDeviceTagRepository(store)
+    for i in range(3):
+        devices.create(f"device-{i}", f"Device {i}", 18 + i)
+    tags.set_tags("device-0", ["floor2", "light"])
+    tags.set_tags("device-1", ["floor2", "light"])
+    tags.set_tags("device-1", ["floor2"])
+    tags.set_tags("device-2", ["light"])
+
+    assert [d.device_id for d in tags.find_devices_by_tags(["floor2", "light"])] == ["device-0"]
+    assert tags.find_tags("device-1") == ["floor2"]
+    devices.delete("device-0")
+    assert tags.find_devices_by_tags(["light"])[0].device_id == "device-2"
+
+    store = reopen(store, store_dir)
+    try:
+        tags = InMemoryDeviceTagRepository(store)
+        assert [d.device_id for d in tags.find_devices_by_tags(["light"])] == ["device-2"]
+        assert tags.find_tags("device-0") == []
+    finally:
+        store.close()
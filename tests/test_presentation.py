@@ -1,5 +1,8 @@
+import json
 from infrastructure.models import Device, Schedule
-from datetime import datetime
+from infrastructure.repository_factory import create_unit_of_work_scope
+from application.services import ChangeLogPruner
+from datetime import datetime, timedelta
 
 def test_health_check(client):
     """ヘルスチェックのテスト"""
@@ -530,6 +533,19 @@ def test_delete_schedule_success(client, test_db):
     # 検証
     assert response.status_code == 204
 
+def test_delete_schedule_succeeds_when_executor_removal_fails(client, test_db):
+    """スケジューラーからのジョブの削除に失敗しても、コミット済みのスケジュールの削除は成功を返す"""
+    from presentation.api import scheduler_leadership
+    test_db.add(Device(device_id="test-device", device_name="Test Device", gpio_number=18, created_at=datetime.now(), updated_at=datetime.now()))
+    test_db.add(Schedule(schedule_id="test-schedule", device_id="test-device", schedule="10:30", is_on=True, created_at=datetime.now(), updated_at=datetime.now()))
+    test_db.commit()
+    scheduler_leadership.executor.remove_schedule.side_effect = RuntimeError("Executor error")
+    
+    response = client.delete("/schedule/test-schedule")
+    
+    assert response.status_code == 204
+    assert client.get("/schedule/test-device").json()["schedules"] == []
+
 def test_delete_schedule_not_found(client):
     """存在しないスケジュール削除のテスト"""
     # 実行
@@ -538,3 +554,424 @@ def test_delete_schedule_not_found(client):
     # 検証
     assert response.status_code == 404
     assert "Schedule not found" in response.json()["detail"]
+
+def test_get_device_list_paginated(client, test_db):
+    """デバイス一覧のページネーションのテスト"""
+    for i in range(3):
+        test_db.add(Device(
+            device_id=f"device-{i}",
+            device_name=f"Device {i}",
+            gpio_number=18 + i,
+            created_at=datetime.now(),
+            updated_at=datetime.now()
+        ))
+    test_db.commit()
+    
+    # 1ページ目
+    response = client.get("/device/list", params={"limit": 2})
+    assert response.status_code == 200
+    data = response.json()
+    assert [d["device_id"] for d in data["devices"]] == ["device-0", "device-1"]
+    assert data["next_cursor"] is not None
+    
+    # 2ページ目（最終ページ）
+    response = client.get("/device/list", params={"limit": 2, "cursor": data["next_cursor"]})
+    assert response.status_code == 200
+    data = response.json()
+    assert [d["device_id"] for d in data["devices"]] == ["device-2"]
+    assert data["next_cursor"] is None
+
+def test_get_device_list_invalid_cursor(client):
+    """不正なカーソル指定のテスト"""
+    response = client.get("/device/list", params={"limit": 2, "cursor": "invalid"})
+    
+    assert response.status_code == 400
+    assert "Invalid cursor" in response.json()["detail"]
+
+def test_stream_device_list(client, test_db):
+    """デバイス一覧のNDJSONストリーミングのテスト"""
+    for i in range(3):
+        test_db.add(Device(
+            device_id=f"device-{i}",
+            device_name=f"Device {i}",
+            gpio_number=18 + i,
+            created_at=datetime.now(),
+            updated_at=datetime.now()
+        ))
+    test_db.commit()
+    
+    response = client.get("/device/list/stream", params={"batch_size": 2})
+    
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["device_id"] for line in lines] == ["device-0", "device-1", "device-2"]
+
+def test_get_schedules_paginated(client, test_db):
+    """スケジュール一覧のページネーションのテスト"""
+    test_db.add(Device(
+        device_id="test-device",
+        device_name="Test Device",
+        gpio_number=18,
+        created_at=datetime.now(),
+        updated_at=datetime.now()
+    ))
+    for i, time in enumerate(["10:00", "12:00", "18:00"]):
+        test_db.add(Schedule(
+            schedule_id=f"schedule-{i}",
+            device_id="test-device",
+            schedule=time,
+            is_on=True
+        ))
+    test_db.commit()
+    
+    response = client.get("/schedule/test-device", params={"limit": 2})
+    data = response.json()
+    assert [s["schedule"] for s in data["schedules"]] == ["10:00", "12:00"]
+    
+    response = client.get("/schedule/test-device", params={"limit": 2, "cursor": data["next_cursor"]})
+    data = response.json()
+    assert [s["schedule"] for s in data["schedules"]] == ["18:00"]
+    assert data["next_cursor"] is None
+
+def test_get_device_history(client, test_db):
+    """デバイスの状態履歴取得のテスト"""
+    device = Device(
+        device_id="test-device",
+        device_name="Test Device",
+        gpio_number=18,
+        created_at=datetime.now(),
+        updated_at=datetime.now()
+    )
+    test_db.add(device)
+    test_db.commit()
+    
+    client.post("/device/test-device/on")
+    client.post("/device/test-device/off")
+    
+    # 実行
+    response = client.get("/device/test-device/history")
+    
+    # 検証
+    assert response.status_code == 200
+    data = response.json()
+    assert data["device_id"] == "test-device"
+    assert [e["is_on"] for e in data["events"]] == [True, False]
+    assert all(e["source"] == "api" for e in data["events"])
+
+def test_get_device_history_not_found(client):
+    """存在しないデバイスの状態履歴取得のテスト"""
+    response = client.get("/device/non-existent/history")
+    
+    assert response.status_code == 404
+    assert "Device not found" in response.json()["detail"]
+
+def test_get_device_usage(client, test_db):
+    """デバイスの使用量取得のテスト"""
+    device = Device(
+        device_id="test-device",
+        device_name="Test Device",
+        gpio_number=18,
+        created_at=datetime.now(),
+        updated_at=datetime.now()
+    )
+    test_db.add(device)
+    test_db.commit()
+    
+    client.post("/device/test-device/on")
+    client.post("/device/test-device/off")
+    
+    # 実行
+    response = client.get("/device/test-device/usage", params={"granularity": "day"})
+    
+    # 検証（直近7日分のバケットが返り、当日に2回の切り替えが集計されている）
+    assert response.status_code == 200
+    data = response.json()
+    assert data["granularity"] == "day"
+    assert len(data["buckets"]) == 7
+    assert data["buckets"][-1]["switch_count"] == 2
+
+def test_get_device_usage_timezone_aware_start(client, test_db):
+    """タイムゾーン付きのstartを指定した使用量取得のテスト"""
+    test_db.add(Device(
+        device_id="test-device",
+        device_name="Test Device",
+        gpio_number=18,
+        created_at=datetime.now(),
+        updated_at=datetime.now()
+    ))
+    test_db.commit()
+    
+    response = client.get(
+        "/device/test-device/usage",
+        params={"granularity": "day", "start": (datetime.now() - timedelta(days=2)).strftime("%Y-%m-%dT%H:%M:%S+09:00")}
+    )
+    
+    assert response.status_code == 200
+    assert len(response.json()["buckets"]) >= 2
+
+def test_query_stats_headers(client, test_db):
+    """SQL発行数・DB時間がレスポンスヘッダーに付与されることを確認"""
+    device = Device(
+        device_id="test-device",
+        device_name="Test Device",
+        gpio_number=18,
+        created_at=datetime.now(),
+        updated_at=datetime.now()
+    )
+    test_db.add(device)
+    test_db.commit()
+    
+    response = client.get("/device/test-device/status")
+    
+    assert response.status_code == 200
+    assert int(response.headers["X-DB-Query-Count"]) >= 1
+    assert float(response.headers["X-DB-Time-Ms"]) >= 0
+    
+    # デバッグエンドポイントにエンドポイント別の累計が出る
+    response = client.get("/debug/queries")
+    assert response.status_code == 200
+    endpoints = response.json()["endpoints"]
+    assert endpoints["GET /device/{device_id}/status"]["queries"] >= 1
+    
+    # ルートに一致しないパスは1つのキーにまとめて集計される
+    unmatched = endpoints.get("<unmatched>", {"requests": 0})["requests"]
+    client.get("/no-such-path-1")
+    client.get("/no-such-path-2")
+    endpoints = client.get("/debug/queries").json()["endpoints"]
+    assert endpoints["<unmatched>"]["requests"] == unmatched + 2
+    assert not any("no-such-path" in key for key in endpoints)
+
+def test_debug_endpoints_disabled(client, monkeypatch):
+    """DEBUG_ENDPOINTS_ENABLEDがtrueでない場合、デバッグ用のエンドポイントは404になることを確認"""
+    monkeypatch.setenv("DEBUG_ENDPOINTS_ENABLED", "false")
+    
+    assert client.get("/debug/queries").status_code == 404
+    assert client.get("/debug/scheduler").status_code == 404
+
+def test_update_device_if_match(client, test_db):
+    """If-Match/ETagによる楽観的排他制御のテスト"""
+    device = Device(
+        device_id="test-device",
+        device_name="Test Device",
+        gpio_number=18,
+        created_at=datetime.now(),
+        updated_at=datetime.now()
+    )
+    test_db.add(device)
+    test_db.commit()
+    
+    etag = client.get("/device/test-device/status").headers["ETag"]
+    assert etag == '"1"'
+    
+    # 取得したETagを指定した更新は成功し、新しいETagが返る
+    response = client.put("/device/test-device", json={"device_name": "First"}, headers={"If-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["version"] == 2
+    assert response.headers["ETag"] == '"2"'
+    
+    # 古いETagを指定した更新・削除は412で拒否され、先の更新が残る
+    response = client.put("/device/test-device", json={"device_name": "Second"}, headers={"If-Match": etag})
+    assert response.status_code == 412
+    response = client.delete("/device/test-device", headers={"If-Match": etag})
+    assert response.status_code == 412
+    assert client.get("/device/test-device/status").json()["device_name"] == "First"
+    
+    # 弱いETagは強い比較で一致しないため412、リストはいずれかに一致すれば成功する
+    response = client.put("/device/test-device", json={"device_name": "Third"}, headers={"If-Match": 'W/"2"'})
+    assert response.status_code == 412
+    response = client.put("/device/test-device", json={"device_name": "Third"}, headers={"If-Match": 'W/"2", "1", "2"'})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"3"'
+    
+    # 不正な形式のIf-Matchは400
+    response = client.put("/device/test-device", json={"device_name": "Fourth"}, headers={"If-Match": "2"})
+    assert response.status_code == 400
+
+def test_delete_schedule_if_match(client, test_db):
+    """スケジュール削除でIf-Matchのバージョンが確認されることを確認"""
+    test_db.add(Device(device_id="test-device", device_name="Test Device", gpio_number=18))
+    test_db.commit()
+    test_db.add(Schedule(schedule_id="test-schedule", device_id="test-device", schedule="07:00", is_on=True))
+    test_db.commit()
+    
+    version = client.get("/schedule/test-device").json()["schedules"][0]["version"]
+    
+    response = client.delete("/schedule/test-schedule", headers={"If-Match": f'"{version + 1}"'})
+    assert response.status_code == 412
+    response = client.delete("/schedule/test-schedule", headers={"If-Match": f'"{version}"'})
+    assert response.status_code == 204
+
+def test_update_schedule(client, test_db):
+    """スケジュールの更新で新しいバージョンのETagが返り、古いバージョンの更新が拒否されることを確認"""
+    test_db.add(Device(device_id="test-device", device_name="Test Device", gpio_number=18))
+    test_db.commit()
+    test_db.add(Schedule(schedule_id="test-schedule", device_id="test-device", schedule="07:00", is_on=True))
+    test_db.commit()
+    
+    response = client.put("/schedule/test-schedule", json={"schedule": "07:30", "is_on": False}, headers={"If-Match": '"1"'})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == '"2"'
+    data = response.json()
+    assert (data["schedule"], data["is_on"], data["version"]) == ("07:30", False, 2)
+    assert client.get("/schedule/test-device").json()["schedules"][0]["schedule"] == "07:30"
+    
+    response = client.put("/schedule/test-schedule", json={"is_on": True}, headers={"If-Match": '"1"'})
+    assert response.status_code == 412
+    assert client.put("/schedule/test-schedule", json={}).status_code == 400
+    assert client.put("/schedule/test-schedule", json={"schedule": "7:3"}).status_code == 400
+    assert client.put("/schedule/non-existent", json={"is_on": True}).status_code == 404
+
+def test_changes_feed(client):
+    """前回のリビジョン以降の変更だけが返り、削除が墓標として返ることを確認"""
+    device_id = client.post("/device/register", json={"device_name": "Feed Device", "gpio_number": 18}).json()["device_id"]
+    schedule_id = client.post(f"/schedule/{device_id}", json={"schedule": "07:00", "is_on": True}).json()["schedule_id"]
+    
+    response = client.get("/changes")
+    assert response.status_code == 200
+    data = response.json()
+    assert [(c["entity_type"], c["entity_id"]) for c in data["changes"]] == [("device", device_id), ("schedule", schedule_id)]
+    assert data["changes"][0]["device"]["device_name"] == "Feed Device"
+    assert data["changes"][1]["schedule"]["schedule"] == "07:00"
+    assert data["has_more"] is False
+    revision = data["revision"]
+    
+    # 変更がなければ空でリビジョンは変わらない
+    assert client.get(f"/changes?since={revision}").json() == {"changes": [], "revision": revision, "has_more": False}
+    
+    client.delete(f"/schedule/{schedule_id}")
+    client.put(f"/device/{device_id}", json={"device_name": "Renamed"})
+    data = client.get(f"/changes?since={revision}&limit=1").json()
+    assert data["changes"][0]["entity_id"] == schedule_id
+    assert data["changes"][0]["deleted"] is True
+    assert data["changes"][0]["schedule"] is None
+    assert data["has_more"] is True
+    data = client.get(f"/changes?since={data['revision']}&limit=1").json()
+    assert data["changes"][0]["device"]["device_name"] == "Renamed"
+    assert data["has_more"] is False
+    
+    # サーバーより新しいリビジョンは再同期が必要
+    assert client.get(f"/changes?since={data['revision'] + 100}").status_code == 410
+
+def test_changes_feed_requires_resync_after_pruning(client, test_db):
+    """削除済みのトゥームストーンより前のリビジョンからの差分取得は410になることを確認"""
+    device_id = client.post("/device/register", json={"device_name": "Feed Device", "gpio_number": 18}).json()["device_id"]
+    schedule_id = client.post(f"/schedule/{device_id}", json={"schedule": "07:00", "is_on": True}).json()["schedule_id"]
+    revision = client.get("/changes").json()["changes"][0]["revision"]
+    client.delete(f"/schedule/{schedule_id}")
+    
+    pruner = ChangeLogPruner(create_unit_of_work_scope(), retention_days=0)
+    assert pruner.prune(datetime.now() + timedelta(seconds=1)) == 1
+    
+    assert client.get(f"/changes?since={revision}").status_code == 410
+    data = client.get("/changes").json()
+    assert [c["entity_id"] for c in data["changes"]] == [device_id]
+    assert client.get(f"/changes?since={data['revision']}").status_code == 200
+
+def test_search_devices(client, test_db):
+    """デバイス名の前方一致検索とパラメータの検証を確認"""
+    for i, name in enumerate(["Living Light", "living fan", "Kitchen"]):
+        test_db.add(Device(device_id=f"device-{i}", device_name=name, gpio_number=18 + i))
+    test_db.commit()
+    
+    response = client.get("/device/search?q=Liv")
+    assert response.status_code == 200
+    assert [d["device_id"] for d in response.json()["devices"]] == ["device-1", "device-0"]
+    assert len(client.get("/device/search?q=liv&limit=1").json()["devices"]) == 1
+    assert client.get("/device/search?q=").status_code == 422
+
+def test_expected_state(client, test_db):
+    """スケジュールから期待される状態が、スケジュールの作成・削除・デバイスの削除に追従することを確認"""
+    for i in range(2):
+        test_db.add(Device(device_id=f"device-{i}", device_name=f"Device {i}", gpio_number=18 + i))
+    test_db.commit()
+    test_db.add(Schedule(schedule_id="schedule-0", device_id="device-0", schedule="07:00", is_on=True))
+    test_db.commit()
+    client.post("/GPIO/18/off")
+    client.post("/GPIO/19/off")
+    
+    response = client.get("/device/device-0/expected?at=8:15")
+    assert response.status_code == 200
+    data = response.json()
+    assert (data["at"], data["expected_is_on"], data["schedule"], data["matches"]) == ("08:15", True, "07:00", False)
+    
+    schedule_id = client.post("/schedule/device-1", json={"schedule": "22:00", "is_on": False}).json()["schedule_id"]
+    client.post("/schedule/device-0", json={"schedule": "08:00", "is_on": False})
+    devices = client.get("/expected?at=08:15").json()["devices"]
+    assert [(d["device_id"], d["expected_is_on"], d["matches"]) for d in devices] == [("device-0", False, True), ("device-1", False, True)]
+    
+    client.delete(f"/schedule/{schedule_id}")
+    client.delete("/device/device-0")
+    assert client.get("/expected?at=08:15").json()["devices"] == []
+    assert client.get("/device/device-1/expected").json()["expected_is_on"] is None
+    assert client.get("/expected?at=24:00").status_code == 400
+    assert client.get("/device/missing/expected").status_code == 404
+
+def test_schedule_analysis(client, test_db):
+    """スケジュールの分析で競合と切り替えの多いデバイスが返されることを確認"""
+    test_db.add(Device(device_id="device-0", device_name="Device 0", gpio_number=18))
+    test_db.commit()
+    for i, (schedule, is_on) in enumerate([("07:00", True), ("07:00", False), ("08:00", True), ("09:00", False)]):
+        test_db.add(Schedule(schedule_id=f"schedule-{i}", device_id="device-0", schedule=schedule, is_on=is_on))
+    test_db.commit()
+    
+    response = client.get("/schedule/analysis?switch_threshold=2")
+    
+    assert response.status_code == 200
+    data = response.json()
+    assert data["devices"] == [{"device_id": "device-0", "gpio_number": 18, "schedules": 4, "switches": 2, "on_minutes": 60}]
+    assert data["conflicts"] == [{"device_id": "device-0", "schedule": "07:00", "schedule_ids": ["schedule-0", "schedule-1"]}]
+    assert data["frequent_switching"] == ["device-0"]
+    assert client.get("/schedule/analysis?switch_threshold=0").status_code == 422
+
+def test_bulk_delete_devices(client, test_db):
+    """複数デバイスの一括削除でスケジュールも削除され、存在しないIDが返されることを確認"""
+    for i in range(3):
+        test_db.add(Device(device_id=f"device-{i}", device_name=f"Device {i}", gpio_number=18 + i))
+    test_db.commit()
+    test_db.add(Schedule(schedule_id="schedule-0", device_id="device-0", schedule="07:00", is_on=True))
+    test_db.commit()
+    
+    response = client.post("/device/delete", json={"device_ids": ["device-0", "device-1", "missing"]})
+    
+    assert response.status_code == 200
+    data = response.json()
+    assert sorted(data["device_ids"]) == ["device-0", "device-1"]
+    assert data["not_found"] == ["missing"]
+    assert [d["device_id"] for d in client.get("/device/list").json()["devices"]] == ["device-2"]
+    assert client.get("/schedule/device-0").status_code == 404
+    assert test_db.query(Schedule).count() == 0
+    
+    assert client.post("/device/delete", json={"device_ids": []}).status_code == 422
+    
+    # バージョンが一致しないデバイスは削除されずconflictsで返る
+    response = client.post("/device/delete", json={"device_ids": ["device-2", "missing"], "expected_versions": {"device-2": 5, "missing": 1}})
+    data = response.json()
+    assert (data["device_ids"], data["not_found"], data["conflicts"]) == ([], ["missing"], ["device-2"])
+    response = client.post("/device/delete", json={"device_ids": ["device-2"], "expected_versions": {"device-2": 1}})
+    assert response.json()["device_ids"] == ["device-2"]
+
+def test_device_tags_and_group_control(client, test_db):
+    """タグの設定・選択・グループのON/OFFと、デバイス削除によるキャッシュの無効化を確認"""
+    for i in range(3):
+        test_db.add(Device(device_id=f"device-{i}", device_name=f"Device {i}", gpio_number=18 + i))
+    test_db.commit()
+    
+    response = client.put("/device/device-0/tags", json={"tags": ["light", "floor2"]})
+    assert response.status_code == 200
+    assert response.json() == {"device_id": "device-0", "tags": ["floor2", "light"]}
+    client.put("/device/device-1/tags", json={"tags": ["floor2"]})
+    assert client.get("/device/device-1/tags").json()["tags"] == ["floor2"]
+    
+    devices = client.get("/device/select?tags=floor2").json()["devices"]
+    assert [d["device_id"] for d in devices] == ["device-0", "device-1"]
+    
+    response = client.post("/group/on", json={"tags": ["floor2"]})
+    assert response.status_code == 200
+    assert [d["is_on"] for d in response.json()["devices"]] == [True, True]
+    assert client.get("/device/device-2/status").json()["is_on"] is False
+    
+    client.delete("/device/device-1")
+    devices = client.get("/device/select?tags=floor2").json()["devices"]
+    assert [d["device_id"] for d in devices] == ["device-0"]
+    assert client.post("/group/off", json={"tags": ["missing"]}).status_code == 404
@@ -0,0 +1,176 @@
+"""エンドポイントごとのSQL発行数・コミット数の上限（クエリバジェット）のテスト
+
+N+1クエリや不要なコミットが増えた場合にCIで検出するためのもの。
+上限を上げる場合は、増えた理由をレビューで確認すること。
+"""
+import threading
+import pytest
+from contextlib import contextmanager
+from datetime import datetime
+from unittest.mock import Mock
+from sqlalchemy import event
+from infrastructure.database import engine
+from infrastructure.models import Device, DeviceTag, Schedule
+from infrastructure.repositories import SQLAlchemyDeviceRepository, SQLAlchemyScheduleRepository
+from application.services import ScheduleExecutorService, TimingWheelScheduleExecutorService
+from hardware.gpio_controller import MockGPIOController
+
+# バックグラウンドスレッド（状態履歴の書き込みなど）のSQLは計測対象外
+IGNORED_THREADS = {"state-event-recorder"}
+
+class QueryCounter:
+    def __init__(self):
+        self.statements = []
+        self.commits = 0
+    
+    @property
+    def statement_count(self) -> int:
+        return len(self.statements)
+
+@contextmanager
+def count_queries():
+    """engineで発行されたSQL文とコミットを数える"""
+    counter = QueryCounter()
+    
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if threading.current_thread().name not in IGNORED_THREADS:
+            counter.statements.append(statement)
+    
+    def commit(conn):
+        if threading.current_thread().name not in IGNORED_THREADS:
+            counter.commits += 1
+    
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "commit", commit)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+        event.remove(engine, "commit", commit)
+
+def assert_query_budget(counter: QueryCounter, max_statements: int, max_commits: int) -> None:
+    statements = "\n".join(counter.statements)
+    assert counter.statement_count <= max_statements, \
+        f"{counter.statement_count} statements (budget {max_statements}):\n{statements}"
+    assert counter.commits <= max_commits, f"{counter.commits} commits (budget {max_commits})"
+
+@pytest.fixture
+def fleet(test_db):
+    """複数デバイスとスケジュールを持つテストデータ（件数に比例するクエリを検出するため）"""
+    for i in range(10):
+        test_db.add(Device(
+            device_id=f"device-{i}",
+            device_name=f"Device {i}",
+            gpio_number=2 + i,
+            created_at=datetime.now(),
+            updated_at=datetime.now()
+        ))
+    test_db.commit()
+    for i in range(10):
+        test_db.add(Schedule(schedule_id=f"schedule-{i}", device_id="device-0", schedule=f"{i:02d}:00", is_on=i % 2 == 0))
+    for i in range(5):
+        test_db.add(DeviceTag(tag="floor2", device_id=f"device-{i}"))
+        test_db.add(DeviceTag(tag="light", device_id=f"device-{i * 2}"))
+    test_db.commit()
+    return test_db
+
+# (method, url, json, 最大SQL文数, 最大コミット数)
+ROUTE_BUDGETS = [
+    ("GET", "/health", None, 0, 0),
+    ("POST", "/device/register", {"device_name": "New Device", "gpio_number": 30}, 5, 1),
+    ("GET", "/device/list", None, 1, 0),
+    ("GET", "/device/list?limit=5", None, 1, 0),
+    ("GET", "/device/list/stream", None, 1, 0),
+    ("GET", "/device/search?q=device", None, 1, 0),
+    ("GET", "/device/device-0/status", None, 1, 0),
+    ("GET", "/device/device-0/history", None, 2, 0),
+    ("GET", "/device/device-0/usage", None, 3, 0),
+    ("POST", "/device/device-0/on", None, 4, 1),
+    ("POST", "/device/device-0/off", None, 4, 1),
+    ("PUT", "/device/device-1", {"device_name": "Renamed"}, 4, 1),
+    ("PUT", "/device/device-1", {"gpio_number": 40}, 5, 1),
+    ("DELETE", "/device/device-9", None, 5, 1),
+    ("GET", "/device/select?tags=floor2&tags=light", None, 2, 0),
+    ("GET", "/device/device-0/tags", None, 2, 0),
+    ("PUT", "/device/device-1/tags", {"tags": ["floor3", "light"]}, 5, 1),
+    ("POST", "/group/on", {"tags": ["floor2"]}, 5, 1),
+    ("POST", "/group/off", {"tags": ["floor2"]}, 5, 1),
+    ("POST", "/device/delete", {"device_ids": ["device-0", "device-1", "missing"]}, 4, 1),
+    ("POST", "/GPIO/2/on", None, 1, 0),
+    ("POST", "/GPIO/2/off", None, 1, 0),
+    ("GET", "/GPIO/18/status", None, 0, 0),
+    ("POST", "/schedule/device-1", {"schedule": "10:00", "is_on": True}, 4, 1),
+    ("GET", "/schedule/device-0", None, 2, 0),
+    ("GET", "/schedule/device-0?limit=5", None, 2, 0),
+    ("GET", "/schedule/analysis", None, 1, 0),
+    ("PUT", "/schedule/schedule-0", {"schedule": "10:30"}, 4, 1),
+    ("DELETE", "/schedule/schedule-0", None, 4, 1),
+    ("GET", "/device/device-0/expected?at=07:30", None, 3, 0),
+    ("GET", "/expected", None, 2, 0),
+    ("GET", "/changes", None, 3, 0),
+    ("GET", "/changes?since=0&limit=5", None, 3, 0),
+    ("GET", "/debug/queries", None, 0, 0),
+    ("GET", "/debug/scheduler", None, 0, 0),
+]
+
+@pytest.mark.parametrize("method,url,json,max_statements,max_commits", ROUTE_BUDGETS)
+def test_route_query_budget(client, fleet, method, url, json, max_statements, max_commits):
+    """各エンドポイントのSQL発行数・コミット数が上限以内であることを確認"""
+    with count_queries() as counter:
+        response = client.request(method, url, json=json)
+    
+    assert response.status_code < 400, response.text
+    assert_query_budget(counter, max_statements, max_commits)
+
+def test_every_route_has_budget():
+    """全てのエンドポイントにクエリバジェットが設定されていることを確認"""
+    from presentation.api import app
+    
+    budgeted_paths = {(method, url.split("?")[0]) for method, url, *_ in ROUTE_BUDGETS}
+    for route in app.routes:
+        methods = getattr(route, "methods", None)
+        if not methods or route.path.startswith(("/docs", "/redoc", "/openapi")):
+            continue
+        pattern = route.path_regex
+        for method in methods - {"HEAD"}:
+            assert any(m == method and pattern.match(path) for m, path in budgeted_paths), \
+                f"No query budget for {method} {route.path}"
+
+@pytest.mark.parametrize("url", ["/device/device-0/history", "/device/device-0/usage"])
+def test_history_routes_use_one_connection(client, fleet, url):
+    """状態履歴・使用量の取得がデバイスの確認と同じ1つの接続で済むことを確認"""
+    checkouts = []
+    
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        if threading.current_thread().name not in IGNORED_THREADS:
+            checkouts.append(connection_record)
+    
+    event.listen(engine, "checkout", checkout)
+    try:
+        response = client.get(url)
+    finally:
+        event.remove(engine, "checkout", checkout)
+    
+    assert response.status_code == 200
+    assert len(checkouts) == 1
+
+def test_execute_schedule_error_path_query_budget(fleet):
+    """スケジュール実行のエラー時にデバイスを重複して取得しないことを確認"""
+    gpio_controller = Mock(spec=MockGPIOController)
+    gpio_controller.turn_on.side_effect = Exception("GPIO control failed")
+    executor = ScheduleExecutorService(SQLAlchemyDeviceRepository(fleet), gpio_controller)
+    
+    with count_queries() as counter:
+        executor._execute_schedule("device-0", 2, True)
+    
+    assert_query_budget(counter, 1, 0)
+
+def test_startup_schedule_load_query_budget(fleet):
+    """起動時のスケジュールの一括読み込みがスケジュール数によらず1回の問い合わせで済むことを確認"""
+    executor = TimingWheelScheduleExecutorService(None, MockGPIOController())
+    
+    with count_queries() as counter:
+        added, failed = executor.add_schedules(SQLAlchemyScheduleRepository(fleet).find_all_with_devices())
+    
+    assert (added, failed) == (fleet.query(Schedule).count(), 0)
+    assert_query_budget(counter, 1, 0)
@@ -1,11 +1,21 @@
+import time
 import pytest
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from unittest.mock import Mock, patch
-from datetime import datetime
-from application.services import ScheduleExecutorService
-from application.repositories import DeviceRepository
-from hardware.gpio_controller import GPIOController
+from datetime import datetime, timedelta
+import pytz
+from application.clock import VirtualClock
+from application.services import (
+    MINUTES_PER_DAY, MISFIRE_POLICY_SKIP, RESYNC_JOB_ID, RESYNC_NOW_JOB_ID, SCHEDULE_OUTCOME_APPLIED, SCHEDULE_OUTCOME_FAILED, SCHEDULE_OUTCOME_SUPERSEDED, WHEEL_TICK_JOB_ID,
+    ScheduleExecutorService, TimingWheelScheduleExecutorService
+)
+from application.repositories import DeviceRepository, ScheduleLoadRow
+from application.schedule_simulation import ScheduleSimulator
+from hardware.gpio_controller import GPIOController, MockGPIOController
 from infrastructure.models import Device
+from infrastructure.repositories import device_repository_scope
 
 
 class TestScheduleExecutorService:
@@ -118,6 +128,142 @@ class TestScheduleExecutorService:
         jobs = self.service.scheduler.get_jobs()
         assert len(jobs) == 0
     
+    def test_remove_device_schedules(self):
+        """削除されたデバイスのジョブだけがまとめて削除されることを確認"""
+        self.mock_device_repository.find_by_id.return_value = Device(device_id="device", device_name="Test Device", gpio_number=18)
+        
+        self.service.start()
+        self.service.add_schedule("schedule-1", "device-1", "07:00", True)
+        self.service.add_schedule("schedule-2", "device-1", "18:00", False)
+        self.service.add_schedule("schedule-3", "device-2", "07:00", True)
+        self.service.add_schedule("schedule-4", "device-3", "07:00", True)
+        
+        assert self.service.remove_device_schedules(["device-1", "device-2"]) == 3
+        assert [job.id for job in self.service.scheduler.get_jobs()] == ["schedule-4"]
+    
+    def test_add_schedules(self):
+        """取得済みのデバイスを使ってまとめて追加し、不正な時刻のスケジュールだけが失敗することを確認"""
+        rows = [
+            ScheduleLoadRow("schedule-1", "device-1", 18, "07:00", True),
+            ScheduleLoadRow("schedule-2", "device-1", 18, "25:00", False),
+            ScheduleLoadRow("schedule-3", "device-1", 18, "18:00", False)
+        ]
+        
+        assert self.service.add_schedules(rows) == (2, 1)
+        self.service.start()
+        
+        jobs = self.service.scheduler.get_jobs()
+        assert sorted(job.id for job in jobs) == ["schedule-1", "schedule-3"]
+        assert {job.id: job.args for job in jobs} == {"schedule-1": ("device-1", 18, True), "schedule-3": ("device-1", 18, False)}
+        self.mock_device_repository.find_by_id.assert_not_called()
+    
+    def test_reconcile_states(self):
+        """デバイスごとに現在時刻以前の直近のスケジュールの状態が1回のGPIO操作で反映されることを確認"""
+        rows = [
+            ScheduleLoadRow("schedule-1", "device-1", 18, "07:00", True),
+            ScheduleLoadRow("schedule-2", "device-1", 18, "18:00", False),
+            ScheduleLoadRow("schedule-3", "device-2", 19, "23:30", True),
+            ScheduleLoadRow("schedule-4", "device-3", 20, "12:00", True)
+        ]
+        self.mock_device_repository.find_by_ids.return_value = []
+        now = datetime(2026, 1, 1, 11, 0)
+        
+        outcomes = self.service.reconcile_states(rows, now)
+        
+        # device-2は前日の23:30、device-3は前日の12:00が直近
+        assert sorted(o.schedule_id for o in outcomes) == ["schedule-1", "schedule-3", "schedule-4"]
+        self.mock_gpio_controller.apply_states.assert_called_once_with({18: True, 19: True, 20: True})
+        
+        self.mock_gpio_controller.reset_mock()
+        outcomes = self.service.reconcile_states(rows, now, grace_minutes=12 * 60)
+        assert sorted(o.schedule_id for o in outcomes) == ["schedule-1", "schedule-3"]
+        assert self.service.reconcile_states(rows, now, policy=MISFIRE_POLICY_SKIP) == []
+        self.mock_gpio_controller.apply_states.assert_called_once_with({18: True, 19: True})
+    
+    def test_update_schedule_in_place(self):
+        """スケジュールの更新で同じジョブのトリガーと引数がその場で置き換えられることを確認"""
+        self.mock_device_repository.find_by_id.return_value = Device(device_id="device-1", device_name="Test Device", gpio_number=18)
+        self.service.start()
+        self.service.add_schedule("schedule-1", "device-1", "07:00", True, 1)
+        
+        self.service.update_schedule("schedule-1", "device-1", "08:30", False, 2)
+        
+        jobs = self.service.scheduler.get_jobs()
+        assert [job.id for job in jobs] == ["schedule-1"]
+        assert jobs[0].args == ("device-1", 18, False)
+        assert (jobs[0].next_run_time.hour, jobs[0].next_run_time.minute) == (8, 30)
+        assert self.service.registered == {"schedule-1": (2, 18)}
+    
+    def test_resync(self):
+        """DBの行とIDとバージョンで比較し、追加・置き換え・削除の差分だけが反映されることを確認"""
+        self.service.start()
+        self.service.add_schedules([
+            ScheduleLoadRow("schedule-1", "device-1", 18, "07:00", True, 1),
+            ScheduleLoadRow("schedule-2", "device-1", 18, "18:00", False, 1),
+            ScheduleLoadRow("schedule-3", "device-2", 19, "12:00", True, 1)
+        ])
+        rows = [
+            ScheduleLoadRow("schedule-1", "device-1", 18, "07:00", True, 1),
+            ScheduleLoadRow("schedule-2", "device-1", 18, "19:00", False, 2),
+            ScheduleLoadRow("schedule-4", "device-2", 19, "06:00", True, 1)
+        ]
+        
+        with patch.object(self.service.scheduler, "add_job", wraps=self.service.scheduler.add_job) as add_job:
+            assert self.service.resync(lambda: rows) == (1, 1, 1)
+        
+        assert sorted(call.kwargs["id"] for call in add_job.call_args_list) == ["schedule-2", "schedule-4"]
+        assert sorted(job.id for job in self.service.scheduler.get_jobs()) == ["schedule-1", "schedule-2", "schedule-4"]
+        assert self.service.registered["schedule-2"] == (2, 18)
+        assert self.service.resync(lambda: rows) == (0, 0, 0)
+        
+        # 読み込み中に登録・削除があった場合は反映しない
+        def loader():
+            self.service.remove_schedule("schedule-1")
+            return rows
+        assert self.service.resync(loader) is None
+        assert "schedule-1" not in self.service.registered
+        self.service.scheduler.shutdown(wait=False)
+    
+    def test_request_resync_without_interval(self):
+        """定期的なresyncが無効（0）でも、要求したresyncはすぐに1回実行されることを確認"""
+        assert self.service.request_resync() is False
+        rows = [ScheduleLoadRow("schedule-1", "device-1", 18, "07:00", True, 1)]
+        self.service.start_resync(lambda: rows, 0)
+        assert self.service.scheduler.get_job(RESYNC_JOB_ID) is None
+        
+        assert self.service.request_resync() is True
+        job = self.service.scheduler.get_job(RESYNC_NOW_JOB_ID)
+        job.func(*job.args)
+        assert self.service.registered == {"schedule-1": (1, 18)}
+    
+    def test_older_version_does_not_overwrite(self):
+        """並行する更新の登録が前後しても、古いバージョンで新しい登録を上書きしないことを確認"""
+        self.service.add_schedules([ScheduleLoadRow("schedule-1", "device-1", 18, "07:00", True, 3)])
+        self.service.add_schedules([ScheduleLoadRow("schedule-1", "device-1", 18, "08:00", False, 2)])
+        
+        assert self.service.registered["schedule-1"] == (3, 18)
+        assert self.service.scheduler.get_job("schedule-1").args == ("device-1", 18, True)
+    
+    def test_metrics_from_scheduler_events(self):
+        """実行・失敗がスケジューラーのイベントから集計されることを確認"""
+        self.service.start()
+        now = datetime.now(pytz.utc)
+        self.service.scheduler.add_job(func=lambda: None, trigger="date", run_date=now, id="job-ok")
+        self.service.scheduler.add_job(func=Mock(side_effect=Exception("boom")), trigger="date", run_date=now, id="job-error")
+        
+        deadline = time.monotonic() + 5
+        while self.service.metrics.snapshot()["counters"]["executed"] + self.service.metrics.snapshot()["counters"]["errors"] < 2:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        
+        metrics = self.service.get_metrics()
+        self.service.scheduler.shutdown(wait=False)
+        assert metrics["running"] is True
+        assert (metrics["counters"]["submitted"], metrics["counters"]["executed"], metrics["counters"]["errors"]) == (2, 1, 1)
+        assert metrics["dispatch_lag_ms"]["count"] == 2
+        assert metrics["execution_ms"]["count"] == 2
+        assert metrics["threadpool"]["max_workers"] == 10
+    
     def test_remove_schedule_not_found(self):
         """存在しないスケジュール削除時にエラーが発生することを確認"""
         schedule_id = str(uuid.uuid4())
@@ -170,6 +316,9 @@ class TestScheduleExecutorService:
         # GPIO制御が呼ばれていることを確認
         self.mock_gpio_controller.turn_on.assert_called_once_with(gpio_number)
         
+        # エラー時もデバイス情報の取得は1回だけ
+        self.mock_device_repository.find_by_id.assert_called_once_with(device_id)
+        
         # WARNINGログが出力されていることを確認
         mock_logger.warning.assert_called_once()
         warning_call_args = mock_logger.warning.call_args[0][0]
@@ -207,4 +356,279 @@ class TestScheduleExecutorService:
         
         for time_str in invalid_times:
             with pytest.raises(ValueError, match="Invalid time format"):
-                self.service._parse_time(time_str)
\ No newline at end of file
+                self.service._parse_time(time_str)
+
+class TestTimingWheelScheduleExecutorService:
+    """タイミングホイールによるスケジュール実行のテスト"""
+    
+    def setup_method(self):
+        self.mock_device_repository = Mock(spec=DeviceRepository)
+        self.mock_device_repository.find_by_id.side_effect = lambda device_id: Device(
+            device_id=device_id, device_name="Test Device", gpio_number=int(device_id.split("-")[1])
+        )
+        self.mock_device_repository.find_by_ids.side_effect = lambda device_ids: [
+            self.mock_device_repository.find_by_id(device_id) for device_id in sorted(device_ids)
+        ]
+        self.gpio_controller = MockGPIOController()
+        self.service = TimingWheelScheduleExecutorService(self.mock_device_repository, self.gpio_controller)
+    
+    def teardown_method(self):
+        if self.service.scheduler.running:
+            self.service.scheduler.shutdown(wait=False)
+    
+    def test_schedules_share_one_tick_job(self):
+        """スケジュールはスロットに登録され、スケジューラーのジョブはティック1つだけであることを確認"""
+        self.service.start()
+        self.service.add_schedule("schedule-1", "device-18", "07:00", True)
+        self.service.add_schedule("schedule-2", "device-19", "7:00", False)
+        self.service.add_schedule("schedule-3", "device-20", "23:59", True)
+        
+        assert [job.id for job in self.service.scheduler.get_jobs()] == [WHEEL_TICK_JOB_ID]
+        assert list(self.service.wheel[7 * 60]) == ["schedule-1", "schedule-2"]
+        assert list(self.service.wheel[MINUTES_PER_DAY - 1]) == ["schedule-3"]
+    
+    def test_dispatch_slot(self):
+        """スロットのスケジュールがまとめて実行され、置き換え・削除が反映されることを確認"""
+        self.service.add_schedule("schedule-1", "device-18", "07:00", True)
+        self.service.add_schedule("schedule-2", "device-19", "07:00", True)
+        self.service.add_schedule("schedule-2", "device-19", "08:00", True)
+        self.service.add_schedule("schedule-3", "device-20", "07:00", True)
+        self.service.remove_schedule("schedule-3")
+        
+        assert [o.schedule_id for o in self.service.dispatch(7 * 60)] == ["schedule-1"]
+        assert self.gpio_controller.get_status(18) is True
+        assert self.gpio_controller.get_status(19) is False
+        assert self.service.schedule_count() == 2
+        with pytest.raises(ValueError, match="Schedule not found"):
+            self.service.remove_schedule("schedule-3")
+        with pytest.raises(ValueError, match="Invalid time format"):
+            self.service.add_schedule("schedule-4", "device-18", "24:00", True)
+    
+    def test_older_version_does_not_overwrite_slot(self):
+        """古いバージョンの登録ではスロットが置き換わらないことを確認"""
+        self.service.add_schedules([ScheduleLoadRow("schedule-1", "device-1", 18, "07:00", True, 3)])
+        self.service.add_schedules([ScheduleLoadRow("schedule-1", "device-1", 18, "08:00", False, 2)])
+        
+        assert list(self.service.wheel[7 * 60]) == ["schedule-1"]
+        assert self.service.wheel[8 * 60] == {}
+    
+    def test_resync_replaces_slot(self):
+        """差分の反映で、バージョンやGPIO番号が変わったスケジュールのスロットが置き換えられることを確認"""
+        self.service.add_schedules([
+            ScheduleLoadRow("schedule-1", "device-18", 18, "07:00", True, 1),
+            ScheduleLoadRow("schedule-2", "device-19", 19, "07:00", True, 1)
+        ])
+        
+        assert self.service.resync(lambda: [
+            ScheduleLoadRow("schedule-1", "device-18", 18, "08:00", True, 2),
+            ScheduleLoadRow("schedule-2", "device-19", 21, "07:00", True, 1)
+        ]) == (0, 2, 0)
+        assert self.service.wheel[7 * 60] == {"schedule-2": ("device-19", 21, True)}
+        assert list(self.service.wheel[8 * 60]) == ["schedule-1"]
+        assert self.service.resync(lambda: []) == (0, 0, 2)
+        assert self.service.schedule_count() == 0 and self.service.registered == {}
+    
+    def test_remove_device_schedules(self):
+        """削除されたデバイスのスケジュールだけがまとめて外されることを確認"""
+        self.service.add_schedule("schedule-1", "device-18", "07:00", True)
+        self.service.add_schedule("schedule-2", "device-18", "18:00", False)
+        self.service.add_schedule("schedule-3", "device-19", "07:00", True)
+        
+        assert self.service.remove_device_schedules(["device-18", "device-99"]) == 2
+        assert list(self.service.wheel[7 * 60]) == ["schedule-3"]
+        assert self.service.wheel[18 * 60] == {}
+        assert "device-18" not in self.service.device_schedules
+    
+    def test_tick_catches_up_missed_minutes(self):
+        """ティックが遅れた分は遡って実行し、同じ分を二度実行しないことを確認"""
+        self.service.add_schedule("schedule-1", "device-18", "00:00", True)
+        self.service.add_schedule("schedule-2", "device-19", "00:01", True)
+        self.service.clock = VirtualClock(datetime(2026, 1, 1, 0, 1))
+        self.service._last_tick = self.service.clock.now() - timedelta(minutes=2)
+        
+        with patch.object(self.service, "_execute_schedules") as execute:
+            self.service._tick()
+            self.service._tick()
+        
+        assert [c.args for c in execute.call_args_list] == [
+            ([("schedule-1", "device-18", 18, True)], "00:00"),
+            ([("schedule-2", "device-19", 19, True)], "00:01")
+        ]
+    
+    @patch('application.services.logger')
+    def test_tick_bounds_catch_up_and_ignores_backward_jump(self, mock_logger):
+        """上限を超えた遅れは直近の分だけ実行して飛ばした範囲を警告し、時刻の巻き戻りは1日近い遅れとして扱わないことを確認"""
+        clock = VirtualClock(datetime(2026, 1, 1, 7, 0))
+        self.service.clock = clock
+        self.service.add_schedule("schedule-1", "device-18", "07:00", True)
+        self.service.add_schedule("schedule-2", "device-19", "07:09", True)
+        self.service._tick()
+        
+        with patch.object(self.service, "_execute_schedules") as execute:
+            clock.advance(timedelta(minutes=10))
+            self.service._tick()
+            assert [c.args[1] for c in execute.call_args_list] == ["07:06", "07:07", "07:08", "07:09", "07:10"]
+            warning = mock_logger.warning.call_args.args[0]
+            assert "2026-01-01 07:01 - 2026-01-01 07:05" in warning
+            
+            execute.reset_mock()
+            clock = VirtualClock(datetime(2026, 1, 1, 7, 7))
+            self.service.clock = clock
+            assert self.service._tick() == []
+            assert execute.call_count == 0
+            assert "Clock moved backward" in mock_logger.warning.call_args.args[0]
+            clock.advance(timedelta(minutes=1))
+            self.service._tick()
+            assert [c.args[1] for c in execute.call_args_list] == ["07:08"]
+    
+    @patch('application.services.logger')
+    def test_dispatch_batches_gpio_and_logs(self, mock_logger):
+        """同じ分のスケジュールが1回のGPIO操作・1行のログで実行され、同じピンは後のスケジュールが採用されることを確認"""
+        state_recorder = Mock()
+        self.service.state_recorder = state_recorder
+        self.service.add_schedule("schedule-1", "device-18", "18:00", True)
+        self.service.add_schedule("schedule-2", "device-19", "18:00", True)
+        self.service.add_schedule("schedule-3", "device-18", "18:00", False)
+        
+        with patch.object(self.gpio_controller, "apply_states", wraps=self.gpio_controller.apply_states) as apply_states:
+            outcomes = self.service.dispatch(18 * 60)
+        
+        apply_states.assert_called_once_with({18: False, 19: True})
+        assert [(o.schedule_id, o.outcome) for o in outcomes] == [
+            ("schedule-1", SCHEDULE_OUTCOME_SUPERSEDED), ("schedule-2", SCHEDULE_OUTCOME_APPLIED), ("schedule-3", SCHEDULE_OUTCOME_APPLIED)
+        ]
+        assert self.gpio_controller.get_status(18) is False
+        assert state_recorder.record.call_count == 2
+        self.mock_device_repository.find_by_ids.assert_called_once()
+        assert "schedules=3, pins=2" in mock_logger.info.call_args[0][0]
+        
+        with patch.object(self.gpio_controller, "apply_states", side_effect=Exception("bus error")):
+            outcomes = self.service.dispatch(18 * 60)
+        assert [o.outcome for o in outcomes] == [SCHEDULE_OUTCOME_SUPERSEDED, SCHEDULE_OUTCOME_FAILED, SCHEDULE_OUTCOME_FAILED]
+        assert outcomes[1].error == "bus error"
+        mock_logger.warning.assert_called_once()
+    
+    @patch('application.services.logger')
+    def test_dispatch_same_pin_is_independent_of_registration_order(self, mock_logger):
+        """同じ分に同じピンのON・OFFがある場合、登録順によらずschedule_idが大きいスケジュールが採用されることを確認"""
+        self.service.add_schedule("schedule-b", "device-18", "18:00", False)
+        self.service.add_schedule("schedule-a", "device-18", "18:00", True)
+        self.mock_device_repository.find_by_ids.side_effect = Exception("database is locked")
+        
+        outcomes = self.service.dispatch(18 * 60)
+        
+        assert [(o.schedule_id, o.outcome) for o in outcomes] == [
+            ("schedule-a", SCHEDULE_OUTCOME_SUPERSEDED), ("schedule-b", SCHEDULE_OUTCOME_APPLIED)
+        ]
+        assert self.gpio_controller.get_status(18) is False
+        # デバイス名を取得できなくてもスケジュールは実行し、失敗は警告として残す
+        assert "database is locked" in mock_logger.warning.call_args[0][0]
+
+class TestScheduleSimulator:
+    """仮想時間でのスケジュール実行のシミュレーションのテスト"""
+    
+    def test_clock_is_injected(self):
+        """実行サービスの時刻・タイムゾーンが注入した時計から取られることを確認"""
+        clock = VirtualClock(datetime(2026, 1, 1, 6, 59, 30))
+        service = TimingWheelScheduleExecutorService(None, MockGPIOController(), clock=clock)
+        
+        assert str(service.scheduler.timezone) == "Asia/Tokyo"
+        assert service.clock.now() == pytz.timezone('Asia/Tokyo').localize(datetime(2026, 1, 1, 6, 59, 30))
+        clock.advance(timedelta(seconds=30))
+        assert (service.clock.now().hour, service.clock.now().minute) == (7, 0)
+        with pytest.raises(ValueError):
+            clock.advance(timedelta(minutes=-1))
+    
+    def test_month_with_midnight_wrap(self):
+        """1か月分を早送りし、日付の変わり目をまたぐスケジュールの状態の変化が毎日記録されることを確認"""
+        simulator = ScheduleSimulator(datetime(2026, 1, 1, 12, 0))
+        simulator.load([
+            ScheduleLoadRow("schedule-1", "device-18", 18, "23:59", True),
+            ScheduleLoadRow("schedule-2", "device-18", 18, "00:00", False),
+            ScheduleLoadRow("schedule-3", "device-19", 19, "07:00", True),
+            ScheduleLoadRow("schedule-4", "device-19", 19, "07:00", False)
+        ])
+        
+        transitions = simulator.run_until(datetime(2026, 1, 31, 23, 59, 59))
+        
+        # 同じ分のschedule-3はschedule-4に置き換えられるため、device-19は一度もONにならない
+        assert {t.device_id for t in transitions} == {"device-18"}
+        assert len(transitions) == 30 * 2 + 1
+        assert [(t.ts.strftime("%m-%d %H:%M"), t.is_on) for t in transitions[:3]] == [
+            ("01-01 23:59", True), ("01-02 00:00", False), ("01-02 23:59", True)
+        ]
+        assert simulator.ticks == 30 * MINUTES_PER_DAY + 12 * 60
+        assert simulator.states() == {18: True}
+        assert simulator.gpio_controller.get_status(18) is True
+    
+    def test_dst_transitions(self):
+        """夏時間の切り替えで、飛ばされた時刻のスケジュールは実行されず、繰り返す時刻のスケジュールは2回実行されることを確認
+        
+        運用のAsia/Tokyoには夏時間がないため、タイムゾーンを差し替えて境界の挙動を固定する。
+        """
+        new_york = pytz.timezone("America/New_York")
+        rows = [
+            ScheduleLoadRow("schedule-1", "device-18", 18, "01:30", True),
+            ScheduleLoadRow("schedule-2", "device-18", 18, "01:45", False),
+            ScheduleLoadRow("schedule-3", "device-19", 19, "02:30", True),
+            ScheduleLoadRow("schedule-4", "device-19", 19, "02:45", False)
+        ]
+        spring = ScheduleSimulator(datetime(2026, 3, 8, 0, 0), new_york)
+        spring.load(rows, reconcile=False)
+        transitions = spring.run_until(datetime(2026, 3, 8, 4, 0))
+        assert [t.schedule_id for t in transitions] == ["schedule-1", "schedule-2"]
+        assert spring.ticks == 3 * 60 + 1
+        
+        fall = ScheduleSimulator(datetime(2026, 11, 1, 0, 0), new_york)
+        fall.load(rows, reconcile=False)
+        transitions = fall.run_until(datetime(2026, 11, 1, 4, 0))
+        assert [(t.schedule_id, t.ts.utcoffset()) for t in transitions] == [
+            ("schedule-1", timedelta(hours=-4)), ("schedule-2", timedelta(hours=-4)),
+            ("schedule-1", timedelta(hours=-5)), ("schedule-2", timedelta(hours=-5)),
+            ("schedule-3", timedelta(hours=-5)), ("schedule-4", timedelta(hours=-5))
+        ]
+
+class TestScheduleExecutorSessionScope:
+    """ジョブ実行ごとのセッション払い出しのテスト"""
+    
+    def test_each_execution_uses_own_repository(self):
+        """ジョブ実行ごとにファクトリからリポジトリが払い出されることを確認"""
+        opened = []
+        
+        @contextmanager
+        def repository_factory():
+            repository = Mock(spec=DeviceRepository)
+            repository.find_by_id.return_value = None
+            opened.append(repository)
+            yield repository
+        
+        service = ScheduleExecutorService(None, Mock(spec=GPIOController), repository_factory=repository_factory)
+        
+        service._execute_schedule("device-1", 18, True)
+        service._execute_schedule("device-1", 18, False)
+        
+        assert len(opened) == 2
+        assert opened[0] is not opened[1]
+    
+    def test_concurrent_executions_with_scoped_sessions(self, test_db):
+        """複数スレッドからの同時実行でもセッションが壊れないことを確認"""
+        device_ids = []
+        for i in range(8):
+            device_id = str(uuid.uuid4())
+            test_db.add(Device(device_id=device_id, device_name=f"Device {i}", gpio_number=2 + i))
+            device_ids.append(device_id)
+        test_db.commit()
+        
+        gpio_controller = MockGPIOController()
+        service = ScheduleExecutorService(None, gpio_controller, repository_factory=device_repository_scope)
+        
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            futures = [
+                pool.submit(service._execute_schedule, device_id, 2 + i, True)
+                for _ in range(5)
+                for i, device_id in enumerate(device_ids)
+            ]
+            for future in futures:
+                future.result()
+        
+        assert all(gpio_controller.get_status(2 + i) for i in range(8))